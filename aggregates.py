@@ -0,0 +1,165 @@
+"""
+running totals behind the overall report, kept in meta["aggregates"]
+
+    users_by_role   role -> number of users
+    defense_count   number of defenses
+    score_sum / score_count   over defenses with a numeric final_score
+    jury            teacher id (str, json keys) -> committee seats
+    jury_top        [[teacher id, seats]] of the TOP_K busiest teachers
+
+every insert/update/delete of a user or defense updates them in the same
+operation (database._apply_op / sqlite_backend.apply_ops), journal replay
+included, so reading them is O(1)
+databases without the block get it on first use (ensure), verify()
+recomputes everything from the records and lists the differences
+"""
+import heapq
+
+TOP_K = 10
+KEY = "aggregates"
+
+
+def empty():
+    return {"users_by_role": {}, "defense_count": 0, "score_sum": 0.0,
+            "score_count": 0, "jury": {}, "jury_top": []}
+
+
+def _score(d):
+    s = d.get("final_score")
+    return s if isinstance(s, (int, float)) and not isinstance(s, bool) else None
+
+def _seats(d):
+    seats = {}
+    for m in d.get("committee_members") or []:
+        if m.get("role") == "teacher" and m.get("id") is not None:
+            key = str(m["id"])
+            seats[key] = seats.get(key, 0) + 1
+    return seats
+
+def _rank(jury, limit):
+    best = heapq.nlargest(limit, ((c, -int(t)) for t, c in jury.items() if c > 0))
+    return [[-t, c] for c, t in best]
+
+
+def _bump(counter, key, delta):
+    n = counter.get(key, 0) + delta
+    if n:
+        counter[key] = n
+    else:
+        counter.pop(key, None)
+
+def _jury_changed(agg, changed):
+    """keep jury_top right after the seats of some teachers changed"""
+    jury = agg["jury"]
+    top = {t: c for t, c in agg["jury_top"]}
+    for t in changed:
+        if int(t) in top and jury.get(t, 0) < top[int(t)]:
+            # a top teacher lost seats: someone outside may overtake, rank again
+            agg["jury_top"] = _rank(jury, TOP_K)
+            return
+    floor = min(top.values()) if len(top) >= TOP_K else 0
+    for t in changed:
+        c = jury.get(t, 0)
+        if int(t) in top or c > floor:
+            top[int(t)] = c
+    ranked = sorted(([t, c] for t, c in top.items() if c > 0), key=lambda e: (-e[1], e[0]))
+    agg["jury_top"] = ranked[:TOP_K]
+
+def apply_change(agg, collection, old, new):
+    """update the totals for one record going from old to new (None = absent)"""
+    if collection == "users":
+        if old is not None:
+            _bump(agg["users_by_role"], old.get("role") or "unknown", -1)
+        if new is not None:
+            _bump(agg["users_by_role"], new.get("role") or "unknown", 1)
+    elif collection == "defenses":
+        changed = set()
+        for rec, sign in ((old, -1), (new, 1)):
+            if rec is None:
+                continue
+            agg["defense_count"] += sign
+            s = _score(rec)
+            if s is not None:
+                agg["score_sum"] += sign * s
+                agg["score_count"] += sign
+            for t, n in _seats(rec).items():
+                _bump(agg["jury"], t, sign * n)
+                changed.add(t)
+        if changed:
+            _jury_changed(agg, changed)
+
+
+def compute(data):
+    """the totals counted from scratch"""
+    agg = empty()
+    for u in data.get("users", []):
+        apply_change(agg, "users", None, u)
+    for d in data.get("defenses", []):
+        agg["defense_count"] += 1
+        s = _score(d)
+        if s is not None:
+            agg["score_sum"] += s
+            agg["score_count"] += 1
+        for t, n in _seats(d).items():
+            _bump(agg["jury"], t, n)
+    agg["jury_top"] = _rank(agg["jury"], TOP_K)
+    return agg
+
+def diff(stored, fresh):
+    """[(field, stored value, recomputed value)] where they disagree"""
+    out = []
+    for k in fresh:
+        a, b = stored.get(k), fresh[k]
+        if k == "score_sum":
+            same = a is not None and abs(a - b) < 1e-6
+        elif k == "jury_top":
+            # teachers tied on the last place may be listed either way
+            same = a is not None and [c for _, c in a] == [c for _, c in b]
+        else:
+            same = a == b
+        if not same:
+            out.append((k, a, b))
+    return out
+
+
+def ensure(db_path="db.json", tx=None):
+    """the stored totals, counted and stored first if the database has none"""
+    from database import read_meta, transaction, read_db
+    agg = read_meta(db_path, tx).get(KEY)
+    if agg is not None:
+        return agg
+    with transaction(db_path, tx) as tx:
+        agg = read_meta(db_path, tx).get(KEY)
+        if agg is None:
+            agg = compute(read_db(db_path, tx))
+            tx.apply({"op": "meta", "key": KEY, "value": agg})
+    return agg
+
+def rebuild(db_path="db.json"):
+    """count everything again and store it (e.g. after editing db.json by hand)"""
+    from database import transaction, read_db
+    with transaction(db_path) as tx:
+        agg = compute(read_db(db_path, tx))
+        tx.apply({"op": "meta", "key": KEY, "value": agg})
+    return agg
+
+def verify(db_path="db.json", fix=False):
+    """recount from the records and compare with the stored totals, [] means they agree"""
+    from database import read_meta, read_db, transaction
+    with transaction(db_path) as tx:
+        stored = read_meta(db_path, tx).get(KEY) or {}
+        fresh = compute(read_db(db_path, tx))
+        problems = diff(stored, fresh)
+        if problems and fix:
+            tx.apply({"op": "meta", "key": KEY, "value": fresh})
+    return problems
+
+
+if __name__ == "__main__":
+    import sys
+    db = sys.argv[1] if len(sys.argv) > 1 else "db.json"
+    problems = verify(db, fix="--fix" in sys.argv)
+    for field, stored, fresh in problems:
+        print(f"{field}: stored {stored!r}, recomputed {fresh!r}")
+    print("aggregates OK" if not problems else f"{len(problems)} field(s) differ")
+    raise SystemExit(1 if problems and "--fix" not in sys.argv else 0)
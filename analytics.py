@@ -0,0 +1,236 @@
+"""
+score analytics over defenses
+
+load_defenses() reads the defenses once into columns:
+    score          final_score, nan when missing
+    year           year of the defense date, -1 when unknown
+    advisor        advisor id of the student, -1 when none
+    seat_defense   one entry per teacher committee seat: row of the defense
+    seat_teacher   ... and id of the teacher sitting on it
+with numpy installed the columns are arrays and every statistic is computed
+with whole-array operations (sort once, reduce per group), without it the
+same numbers come from plain python lists
+percentiles use linear interpolation between the two nearest ranks, like
+numpy.percentile's default
+"""
+import bisect
+import datetime
+import math
+
+from database import read_db
+from timestamps import record_ord, MIN_ORD
+
+try:
+    import numpy as np
+except ImportError:  # the pure python versions below are used
+    np = None
+
+PERCENTILES = (10, 25, 50, 75, 90)
+# scores are out of 20, one bin per point by default
+DEFAULT_BINS = tuple(range(0, 21))
+
+
+def _score(d):
+    s = d.get("final_score")
+    return float(s) if isinstance(s, (int, float)) and not isinstance(s, bool) else math.nan
+
+
+class DefenseTable:
+    """the columns of load_defenses, numpy arrays or lists depending on use_numpy"""
+
+    def __init__(self, ids, score, year, advisor, seat_defense, seat_teacher, use_numpy):
+        self.use_numpy = use_numpy
+        if use_numpy:
+            self.ids = np.asarray(ids, dtype=np.int64)
+            self.score = np.asarray(score, dtype=np.float64)
+            self.year = np.asarray(year, dtype=np.int64)
+            self.advisor = np.asarray(advisor, dtype=np.int64)
+            self.seat_defense = np.asarray(seat_defense, dtype=np.int64)
+            self.seat_teacher = np.asarray(seat_teacher, dtype=np.int64)
+        else:
+            self.ids, self.score, self.year = ids, score, year
+            self.advisor, self.seat_defense, self.seat_teacher = advisor, seat_defense, seat_teacher
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def load_defenses(db_path="db.json", tx=None, use_numpy=None):
+    """read the defense columns in one pass (use_numpy=None: numpy when installed)"""
+    if use_numpy is None:
+        use_numpy = np is not None
+    elif use_numpy and np is None:
+        raise ValueError("numpy is not installed")
+    db = read_db(db_path, tx)
+    advisor_of = {u.get("id"): u.get("advisor_id") for u in db.get("users", []) if u.get("advisor_id") is not None}
+    years = {}
+    ids, score, year, advisor, seat_defense, seat_teacher = [], [], [], [], [], []
+    for row, d in enumerate(db.get("defenses", [])):
+        ids.append(d.get("id"))
+        score.append(_score(d))
+        o = record_ord(d)
+        if o not in years:
+            years[o] = datetime.date.fromordinal(o).year if o != MIN_ORD else -1
+        year.append(years[o])
+        aid = advisor_of.get(d.get("student_id"))
+        advisor.append(aid if isinstance(aid, int) else -1)
+        for m in d.get("committee_members") or []:
+            if m.get("role") == "teacher" and isinstance(m.get("id"), int):
+                seat_defense.append(row)
+                seat_teacher.append(m["id"])
+    return DefenseTable(ids, score, year, advisor, seat_defense, seat_teacher, use_numpy)
+
+
+"""grouped statistics"""
+
+def _stats_row(count, total, squares, lo, hi, pcts):
+    mean = total / count
+    return {"count": int(count), "mean": float(mean),
+            "std": float(math.sqrt(max(squares / count - mean * mean, 0.0))),
+            "min": float(lo), "max": float(hi),
+            **{f"p{q}": float(v) for q, v in zip(PERCENTILES, pcts)}}
+
+def _np_grouped(keys, values):
+    ok = ~np.isnan(values) & (keys >= 0)
+    keys, values = keys[ok], values[ok]
+    if not len(keys):
+        return {}
+    # sort by score, then stably by group: every group ends up contiguous and
+    # sorted; small dense group numbers let numpy use its radix sort
+    groups, dense = np.unique(keys, return_inverse=True)
+    order = np.argsort(values)
+    dense = dense[order].astype(np.uint16 if len(groups) <= 1 << 16 else np.int64)
+    order = order[np.argsort(dense, kind="stable")]
+    values = values[order]
+    count = np.bincount(dense, minlength=len(groups))
+    start = np.concatenate(([0], np.cumsum(count)[:-1]))
+    last = start + count - 1
+    sums = np.add.reduceat(values, start)
+    squares = np.add.reduceat(values * values, start)
+    pcts = []
+    for q in PERCENTILES:
+        pos = start + (count - 1) * (q / 100.0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        pcts.append((values[lo] + (values[hi] - values[lo]) * (pos - lo)).tolist())
+    cols = zip(groups.tolist(), count.tolist(), sums.tolist(), squares.tolist(),
+               values[start].tolist(), values[last].tolist(), zip(*pcts))
+    return {g: _stats_row(n, s, sq, lo, hi, p) for g, n, s, sq, lo, hi, p in cols}
+
+def _percentile(sorted_values, q):
+    pos = (len(sorted_values) - 1) * (q / 100.0)
+    lo = int(pos)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+def _py_grouped(keys, values):
+    groups = {}
+    for k, v in zip(keys, values):
+        if k >= 0 and not math.isnan(v):
+            groups.setdefault(k, []).append(v)
+    out = {}
+    for k in sorted(groups):
+        vs = sorted(groups[k])
+        out[k] = _stats_row(len(vs), sum(vs), sum(v * v for v in vs), vs[0], vs[-1],
+                            [_percentile(vs, q) for q in PERCENTILES])
+    return out
+
+def _grouped(table, keys, values):
+    return (_np_grouped if table.use_numpy else _py_grouped)(keys, values)
+
+
+def score_summary(table):
+    """count, mean, std, min, max and percentiles of every scored defense"""
+    keys = np.zeros(len(table), dtype=np.int64) if table.use_numpy else [0] * len(table)
+    return _grouped(table, keys, table.score).get(0)
+
+def by_advisor(table):
+    """advisor id -> score statistics of the defenses of their students"""
+    return _grouped(table, table.advisor, table.score)
+
+def by_jury_member(table):
+    """teacher id -> score statistics of the defenses they sat on"""
+    if table.use_numpy:
+        return _grouped(table, table.seat_teacher, table.score[table.seat_defense])
+    return _grouped(table, table.seat_teacher, [table.score[i] for i in table.seat_defense])
+
+def by_year(table):
+    """year -> score statistics of the defenses held that year"""
+    return _grouped(table, table.year, table.score)
+
+
+def histogram(table, bins=DEFAULT_BINS, by=None):
+    """
+    counts of scores per bin, bins are the edges (the last bin includes its
+    right edge, like numpy.histogram)
+    by=None gives one list of counts, by="year" / "advisor" a dict
+    key -> counts
+    """
+    edges = list(bins)
+    nbins = len(edges) - 1
+    if nbins < 1:
+        raise ValueError("at least two bin edges are needed")
+    if by is None:
+        keys = np.zeros(len(table), dtype=np.int64) if table.use_numpy else [0] * len(table)
+    elif by in ("year", "advisor"):
+        keys = getattr(table, by)
+    else:
+        raise ValueError("by must be None, 'year' or 'advisor'")
+
+    if table.use_numpy:
+        v, k = table.score, keys
+        ok = ~np.isnan(v) & (k >= 0) & (v >= edges[0]) & (v <= edges[-1])
+        v, k = v[ok], k[ok]
+        idx = np.minimum(np.searchsorted(np.asarray(edges, dtype=np.float64), v, side="right") - 1, nbins - 1)
+        groups, inverse = np.unique(k, return_inverse=True)
+        counts = np.bincount(inverse * nbins + idx, minlength=len(groups) * nbins).reshape(len(groups), nbins)
+        result = {int(g): counts[i].tolist() for i, g in enumerate(groups)}
+    else:
+        result = {}
+        for k, v in zip(keys, table.score):
+            if k < 0 or math.isnan(v) or not edges[0] <= v <= edges[-1]:
+                continue
+            i = min(bisect.bisect_right(edges, v) - 1, nbins - 1)
+            result.setdefault(k, [0] * nbins)[i] += 1
+        result = dict(sorted(result.items()))
+    if by is None:
+        return result.get(0, [0] * nbins)
+    return result
+
+
+def jury_vs_advisor(table):
+    """
+    teacher id -> mean score of the defenses they advised, of the ones they
+    judged, and advised minus judged (None where one side is missing)
+    """
+    advised = {k: s["mean"] for k, s in by_advisor(table).items()}
+    judged = {k: s["mean"] for k, s in by_jury_member(table).items()}
+    out = {}
+    for t in sorted(set(advised) | set(judged)):
+        a, j = advised.get(t), judged.get(t)
+        out[t] = {"advised_mean": a, "jury_mean": j,
+                  "difference": a - j if a is not None and j is not None else None}
+    return out
+
+
+def analytics_report(db_path="db.json", tx=None, use_numpy=None):
+    table = load_defenses(db_path, tx, use_numpy)
+    return {
+        "type": "analytics_report",
+        "engine": "numpy" if table.use_numpy else "python",
+        "defenses": len(table),
+        "summary": score_summary(table),
+        "histogram": {"edges": list(DEFAULT_BINS), "counts": histogram(table)},
+        "by_year": by_year(table),
+        "by_advisor": by_advisor(table),
+        "by_jury_member": by_jury_member(table),
+        "jury_vs_advisor": jury_vs_advisor(table),
+    }
+
+
+if __name__ == "__main__":
+    import json
+    import sys
+    db = sys.argv[1] if len(sys.argv) > 1 else "db.json"
+    report = analytics_report(db)
+    print(json.dumps({k: report[k] for k in ("engine", "defenses", "summary", "histogram", "by_year")}, indent=2))
@@ -0,0 +1,101 @@
+"""
+score analytics: numpy columns against the pure python fallback
+
+both engines run on the same generated database, load_defenses is timed
+once per engine, then each statistic on the loaded columns; the results
+are checked to agree
+
+run from the project root:
+    python -m benchmarks.analytics --defenses 200000 --teachers 2000
+"""
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+
+import analytics
+import database
+
+
+def _data(defenses, teachers, seed=1):
+    rnd = random.Random(seed)
+    now = "2025-01-01T00:00:00Z"
+    users = [{"id": i, "name": f"teacher{i}", "role": "teacher", "created_at": now}
+             for i in range(1, teachers + 1)]
+    records = []
+    for n in range(defenses):
+        sid = teachers + 1 + n
+        users.append({"id": sid, "name": f"student{sid}", "role": "student",
+                      "advisor_id": rnd.randint(1, teachers), "created_at": now})
+        committee = [{"id": t, "role": "teacher"} for t in rnd.sample(range(1, teachers + 1), 3)]
+        score = round(rnd.gauss(16, 2), 2) if rnd.random() < 0.95 else None
+        date = f"{rnd.randint(2015, 2025)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"
+        records.append({"id": n + 1, "student_id": sid, "date": date, "committee_members": committee,
+                        "final_score": None if score is None else max(0.0, min(20.0, score))})
+    return {"users": users, "files": [], "messages": [], "defenses": records}
+
+
+STATS = [
+    ("score_summary", analytics.score_summary),
+    ("histogram", analytics.histogram),
+    ("histogram by year", lambda t: analytics.histogram(t, by="year")),
+    ("by_year", analytics.by_year),
+    ("by_advisor", analytics.by_advisor),
+    ("by_jury_member", analytics.by_jury_member),
+    ("jury_vs_advisor", analytics.jury_vs_advisor),
+]
+
+
+def _close(a, b):
+    if isinstance(a, dict):
+        return a.keys() == b.keys() and all(_close(a[k], b[k]) for k in a)
+    if isinstance(a, list):
+        return len(a) == len(b) and all(_close(x, y) for x, y in zip(a, b))
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+    return a == b
+
+
+def _timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def run(defenses, teachers):
+    if analytics.np is None:
+        raise SystemExit("numpy is not installed, nothing to compare against")
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.json")
+        database.save_db(_data(defenses, teachers), db_path)
+        database.load_db_cached(db_path)
+        load_py, py = _timed(lambda: analytics.load_defenses(db_path, use_numpy=False))
+        load_np, vec = _timed(lambda: analytics.load_defenses(db_path, use_numpy=True))
+
+    rows = [("load_defenses", load_py, load_np, True)]
+    for name, fn in STATS:
+        t_py, r_py = _timed(lambda: fn(py))
+        t_np, r_np = _timed(lambda: fn(vec))
+        rows.append((name, t_py, t_np, _close(r_py, r_np)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--defenses", type=int, default=200000)
+    parser.add_argument("--teachers", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"  {'':<20}{'python ms':>12}{'numpy ms':>12}{'speedup':>10}  same")
+    total_py = total_np = 0.0
+    for name, t_py, t_np, same in run(args.defenses, args.teachers):
+        if name != "load_defenses":
+            total_py, total_np = total_py + t_py, total_np + t_np
+        print(f"  {name:<20}{t_py * 1000:>12.1f}{t_np * 1000:>12.1f}{t_py / t_np:>9.1f}x  {'yes' if same else 'NO'}")
+    print(f"  {'statistics total':<20}{total_py * 1000:>12.1f}{total_np * 1000:>12.1f}{total_py / total_np:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
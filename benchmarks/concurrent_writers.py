@@ -0,0 +1,81 @@
+"""
+stress test for concurrent writers on one database
+N processes send messages at the same time and we check that every single
+one of them is stored once with a unique id (no lost updates, no duplicates)
+
+run from the project root:
+    python -m benchmarks.concurrent_writers --procs 8 --per-proc 200
+    python -m benchmarks.concurrent_writers --journal
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+import database
+from message_system import send_message
+
+
+def _setup(db_path):
+    database.reset_db(db_path)
+    now = "2025-01-01T00:00:00Z"
+    for uid, role in ((1, "teacher"), (2, "student")):
+        # no password hashing needed for this test, insert the records directly
+        database.insert_record("users", {
+            "id": uid, "name": f"user{uid}", "role": role, "advisor_id": None,
+            "created_at": now, "last_login": None, "is_active": True
+        }, db_path)
+
+
+def _worker(args):
+    db_path, worker_no, count, journal = args
+    if journal:
+        database.set_journal_mode(True, db_path)
+    for i in range(count):
+        send_message(1, 2, f"worker {worker_no} message {i}", db_path=db_path)
+    return count
+
+
+def run(procs, per_proc, journal=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.json")
+        _setup(db_path)
+
+        started = time.perf_counter()
+        with multiprocessing.Pool(procs) as pool:
+            sent = sum(pool.map(_worker, [(db_path, w, per_proc, journal) for w in range(procs)]))
+        elapsed = time.perf_counter() - started
+
+        messages = database.load_db(db_path)["messages"]
+        ids = [m["id"] for m in messages]
+        texts = {m["text"] for m in messages}
+        return {
+            "processes": procs,
+            "journal": journal,
+            "sent": sent,
+            "stored": len(messages),
+            "unique_ids": len(set(ids)),
+            "unique_texts": len(texts),
+            "seconds": round(elapsed, 3),
+            "writes_per_second": round(sent / elapsed, 1) if elapsed else None,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--procs", type=int, default=4)
+    parser.add_argument("--per-proc", type=int, default=100)
+    parser.add_argument("--journal", action="store_true", help="use journal mode instead of full rewrites")
+    args = parser.parse_args()
+
+    result = run(args.procs, args.per_proc, args.journal)
+    for k, v in result.items():
+        print(f"{k}: {v}")
+    ok = result["sent"] == result["stored"] == result["unique_ids"] == result["unique_texts"]
+    print("OK, no lost updates" if ok else "FAILED, lost or duplicated writes")
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
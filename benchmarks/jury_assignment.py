@@ -0,0 +1,85 @@
+"""
+automatic jury assignment of a batch of pending defenses
+
+times assign_juries on a generated database (existing defenses give the
+teachers different starting loads) and checks the result: committee
+sizes, no advisor on their student's jury, capacities respected, and how
+evenly the load ends up spread (load / jury_capacity)
+
+run from the project root:
+    python -m benchmarks.jury_assignment --teachers 300 --pending 5000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import database
+from defense_manager import jury_load
+from jury_scheduler import assign_juries
+
+
+def _data(teachers, pending, existing, seed=1):
+    rnd = random.Random(seed)
+    now = "2025-01-01T00:00:00Z"
+    users = [{"id": i, "name": f"teacher{i}", "role": "teacher", "advisee_capacity": 1000,
+              "jury_capacity": rnd.choice([60, 90, 120, 150]), "created_at": now, "is_active": True}
+             for i in range(1, teachers + 1)]
+    defenses = []
+    for n in range(existing + pending):
+        sid = teachers + 1 + n
+        users.append({"id": sid, "name": f"student{sid}", "role": "student",
+                      "advisor_id": rnd.randint(1, teachers), "created_at": now, "is_active": True})
+        if n < existing:
+            committee = [{"id": t, "name": f"teacher{t}", "role": "teacher"}
+                         for t in rnd.sample(range(1, teachers // 2 + 1), 3)]
+            defenses.append({"id": n + 1, "student_id": sid, "date": "2024-06-01",
+                             "committee_members": committee, "final_score": 15})
+    pending_rows = [{"student_id": teachers + 1 + n, "date": "2025-06-01",
+                     "committee_size": rnd.choice([3, 3, 3, 5])} for n in range(existing, existing + pending)]
+    return {"users": users, "files": [], "messages": [], "defenses": defenses}, pending_rows
+
+
+def run(teachers, pending, existing):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.json")
+        data, rows = _data(teachers, pending, existing)
+        database.save_db(data, db_path)
+        database.load_db_cached(db_path)
+
+        started = time.perf_counter()
+        records = assign_juries(rows, db_path)
+        seconds = time.perf_counter() - started
+
+        db = database.load_db(db_path)
+        users = {u["id"]: u for u in db["users"]}
+        sizes = {r["student_id"]: r["committee_size"] for r in rows}
+        for r in records:
+            ids = [m["id"] for m in r["committee_members"]]
+            assert len(ids) == len(set(ids)) == sizes[r["student_id"]], r
+            assert users[r["student_id"]]["advisor_id"] not in ids, r
+        load = {tid: len(ids) for tid, ids in jury_load(db_path).items()}
+        fill = [load.get(t, 0) / users[t]["jury_capacity"] for t in users if users[t]["role"] == "teacher"]
+        assert max(fill) <= 1.0
+    return {
+        "teachers": teachers,
+        "pending_defenses": len(records),
+        "seats_assigned": sum(len(r["committee_members"]) for r in records),
+        "seconds (solve + one commit)": round(seconds, 3),
+        "load/capacity min..max": f"{min(fill):.3f}..{max(fill):.3f}",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--teachers", type=int, default=300)
+    parser.add_argument("--pending", type=int, default=5000)
+    parser.add_argument("--existing", type=int, default=2000, help="defenses already recorded")
+    args = parser.parse_args()
+    for k, v in run(args.teachers, args.pending, args.existing).items():
+        print(f"{k}: {v}")
+
+
+if __name__ == "__main__":
+    main()
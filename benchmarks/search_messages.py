@@ -0,0 +1,77 @@
+"""
+query latency of search_message: inverted index vs. scanning every text
+the messages are generated in memory, so the numbers are the search itself
+and not loading db.json
+
+run from the project root:
+    python -m benchmarks.search_messages --sizes 100000 1000000
+"""
+import argparse
+import random
+import time
+
+from message_system import MessageTextIndex, _text_matches, _tokens
+
+WORDS = ("thesis defense chapter draft review advisor meeting deadline proposal "
+         "abstract results method data figure table reference comment revision "
+         "پایان‌نامه دفاع فصل پیش‌نویس استاد جلسه مقاله نتایج").split()
+QUERIES = ["thesis", "draft review", "deadline proposal revision", "دفاع", "fig", "missingword"]
+
+
+def _messages(n, seed=1):
+    rnd = random.Random(seed)
+    # a long tail of rare words next to the common ones, like real texts
+    rare = [f"w{i}" for i in range(5000)]
+    msgs = []
+    for i in range(1, n + 1):
+        words = rnd.choices(WORDS, k=rnd.randint(5, 25)) + rnd.choices(rare, k=3)
+        msgs.append({"id": i, "sender_id": rnd.randint(1, 200), "receiver_id": rnd.randint(1, 200),
+                     "text": " ".join(words), "created_at": "2025-01-01T00:00:00Z"})
+    return msgs
+
+
+def _best_of(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(size, repeat=3):
+    msgs = _messages(size)
+    started = time.perf_counter()
+    idx = MessageTextIndex({"messages": msgs})
+    build = time.perf_counter() - started
+
+    rows = []
+    for q in QUERIES:
+        terms = _tokens(q)
+        indexed = _best_of(lambda: idx.search(terms), repeat)
+        scan = _best_of(lambda: [m for m in msgs if _text_matches(terms, m["text"])], 1)
+        # the old search: one casefolded substring test per message
+        needle = q.casefold()
+        substring = _best_of(lambda: [m for m in msgs if needle in m["text"].casefold()], 1)
+        hits = len(idx.search(terms))
+        rows.append((q, hits, indexed, scan, substring))
+    return build, rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        build, rows = run(size, args.repeat)
+        print(f"{size} messages, index built in {build:.2f}s")
+        print(f"  {'query':<28}{'hits':>9}{'indexed ms':>13}{'scan ms':>11}{'substring ms':>15}")
+        for q, hits, indexed, scan, substring in rows:
+            print(f"  {q:<28}{hits:>9}{indexed * 1000:>13.2f}{scan * 1000:>11.1f}{substring * 1000:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+latency of a password login against validating a session token
+
+run from the project root:
+    python -m benchmarks.sessions --users 20 --logins 5
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import database
+from session_manager import SessionManager
+from user_manager import authenticate_user, import_users
+
+
+def _timed(fn, n):
+    samples = []
+    for i in range(n):
+        started = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def _row(label, samples):
+    ms = [s * 1000 for s in samples]
+    return f"  {label:<34}{statistics.median(ms):>12.3f}{max(ms):>12.3f}{len(ms):>8}"
+
+
+def run(users, logins, validations):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.json")
+        database.reset_db(db_path)
+        rows = [{"name": f"user{i}", "role": "student", "password": f"pw{i}"} for i in range(users)]
+        import_users(rows, db_path)
+        mgr = SessionManager(db_path, secret=b"benchmark")
+
+        old = _timed(lambda i: authenticate_user(f"user{i % users}", f"pw{i % users}", db_path), logins)
+        new = _timed(lambda i: mgr.login(f"user{i % users}", f"pw{i % users}"), logins)
+        tokens = [mgr.issue(database.get_record("users", uid, db_path)) for uid in range(1, users + 1)]
+        check = _timed(lambda i: mgr.validate(tokens[i % users]), validations)
+        flush = _timed(lambda i: mgr.flush(), 1)
+        return [("authenticate_user (pbkdf2 + write)", old), ("session login (pbkdf2, buffered)", new),
+                ("token validation", check), ("flush buffered logins", flush)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--logins", type=int, default=5)
+    parser.add_argument("--validations", type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"  {'':<34}{'median ms':>12}{'max ms':>12}{'calls':>8}")
+    for label, samples in run(args.users, args.logins, args.validations):
+        print(_row(label, samples))
+
+
+if __name__ == "__main__":
+    main()
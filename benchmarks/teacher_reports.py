@@ -0,0 +1,87 @@
+"""
+all teacher reports: one single-pass batch against one report call per teacher
+
+the per-teacher loop is timed on a sample of teachers and scaled up to all
+of them, the old nested any() version of one report is timed on --legacy-users
+
+run from the project root:
+    python -m benchmarks.teacher_reports --teachers 1000 --students 50000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import database
+from report_generator import generate_all_teacher_reports, generate_teacher_report
+
+
+def _data(teachers, students, seed=1):
+    rnd = random.Random(seed)
+    now = "2025-01-01T00:00:00Z"
+    users = [{"id": i, "name": f"teacher{i}", "role": "teacher", "advisee_capacity": 100,
+              "jury_capacity": 1000, "created_at": now, "is_active": True}
+             for i in range(1, teachers + 1)]
+    defenses = []
+    for sid in range(teachers + 1, teachers + students + 1):
+        users.append({"id": sid, "name": f"student{sid}", "role": "student",
+                      "advisor_id": rnd.randint(1, teachers), "created_at": now, "is_active": True})
+        if rnd.random() < 0.6:
+            committee = [{"id": t, "name": f"teacher{t}", "role": "teacher"} for t in rnd.sample(range(1, teachers + 1), 3)]
+            defenses.append({"id": len(defenses) + 1, "student_id": sid, "date": "2025-06-01",
+                             "committee_members": committee, "final_score": rnd.randint(10, 20)})
+    return {"users": users, "files": [], "messages": [], "defenses": defenses}
+
+
+def _legacy_supervised(db, teacher_id):
+    # what generate_teacher_report used to do for supervised_defenses
+    users = db["users"]
+    return [d for d in db["defenses"] if any(u.get("id") == d.get("student_id") and u.get("advisor_id") == teacher_id for u in users)]
+
+
+def run(teachers, students, sample, legacy_users):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "db.json")
+        database.save_db(_data(teachers, students), db_path)
+        database.load_db_cached(db_path)
+
+        started = time.perf_counter()
+        reports = list(generate_all_teacher_reports(db_path))
+        batch = time.perf_counter() - started
+
+        ids = random.Random(2).sample(range(1, teachers + 1), min(sample, teachers))
+        started = time.perf_counter()
+        for tid in ids:
+            generate_teacher_report(tid, db_path)
+        per_teacher = (time.perf_counter() - started) / len(ids)
+
+        small = _data(max(1, legacy_users // 50), legacy_users)
+        started = time.perf_counter()
+        _legacy_supervised(small, 1)
+        legacy = time.perf_counter() - started
+
+    return {
+        "teachers": teachers,
+        "students": students,
+        "reports": len(reports),
+        "batch_seconds": round(batch, 3),
+        "per_teacher_call_ms": round(per_teacher * 1000, 2),
+        "per_teacher_loop_seconds_estimate": round(per_teacher * teachers, 1),
+        "legacy_one_report_seconds": f"{legacy:.2f} (at {legacy_users} students)",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--teachers", type=int, default=1000)
+    parser.add_argument("--students", type=int, default=50000)
+    parser.add_argument("--sample", type=int, default=20, help="teachers timed one by one")
+    parser.add_argument("--legacy-users", type=int, default=5000)
+    args = parser.parse_args()
+    for k, v in run(args.teachers, args.students, args.sample, args.legacy_users).items():
+        print(f"{k}: {v}")
+
+
+if __name__ == "__main__":
+    main()
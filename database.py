@@ -1,39 +1,772 @@
+import contextlib
+import copy
 import json
 import os
+import stat
+import tempfile
+import threading
+
+import aggregates
+import sqlite_backend
+
+try:
+    import fcntl
+except ImportError:  # windows: only threads of this process are serialized
+    fcntl = None
 
 DEFAULT_DB_PATH = "db.json"
+# db_path values starting with this are stored in sqlite (sqlite:///thesis.db)
+SQLITE_SCHEME = "sqlite:///"
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+# number of journal operations after which the journal is folded into db.json
+JOURNAL_COMPACT_EVERY = 1000
+
+_JOURNALED = set()
+# in-memory index kinds, see register_index
+_INDEX_TYPES = {}
+_COMMIT_LISTENERS = []
+_PROCESS_LOCKS = {}
+_PROCESS_LOCKS_GUARD = threading.Lock()
+_HELD = threading.local()
+
+
+def _empty_db():
+    return {
+        "users": [],
+        "files": [],
+        "messages": [],
+        "defenses": []
+    }
+
+
+def _sqlite_path(file_path):
+    if isinstance(file_path, str) and file_path.startswith(SQLITE_SCHEME):
+        return file_path[len(SQLITE_SCHEME):]
+    return None
+
+def _storage_path(file_path):
+    return _sqlite_path(file_path) or file_path
+
 
 def load_db(file_path=DEFAULT_DB_PATH):
     """
     load data
     if file didnt exist ,return empty structure
     """
+    sqlite_path = _sqlite_path(file_path)
+    if sqlite_path:
+        data = sqlite_backend.load(sqlite_path)
+        for coll in _empty_db():
+            data.setdefault(coll, [])
+        return data
     if not os.path.exists(file_path):
-        return {
-            "users": [],
-            "files": [],
-            "messages": [],
-            "defenses": []
-        }
-    with open(file_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        data = _empty_db()
+    else:
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    _replay_journal(data, file_path)
+    return data
 
 def save_db(data, file_path=DEFAULT_DB_PATH):
-    """save data as json"""
-    with open(file_path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+    """save data as json (full snapshot, the journal is not needed after it)"""
+    meta = _meta(data)
+    meta["snapshot_seq"] = meta["journal_seq"]
+    sqlite_path = _sqlite_path(file_path)
+    with db_lock(file_path):
+        if sqlite_path:
+            sqlite_backend.save(data, sqlite_path)
+        else:
+            _atomic_write_json(data, file_path)
+            _remove_journal(file_path)
+        # what we just wrote is the newest version, no need to parse it again
+        # (primed under the lock so no other writer can slip in between)
+        get_cached_db(file_path).prime(data)
+
+def _remove_journal(file_path):
+    try:
+        os.remove(_journal_path(file_path))
+    except FileNotFoundError:
+        pass
+
+def _atomic_write_json(data, file_path):
+    """
+    write to a temp file next to db.json, fsync and os.replace it
+    a crash leaves either the old or the new file, never a truncated one
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(file_path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.chmod(tmp_path, stat.S_IMODE(os.stat(file_path).st_mode))
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+def _process_lock(path):
+    with _PROCESS_LOCKS_GUARD:
+        lock = _PROCESS_LOCKS.get(path)
+        if lock is None:
+            lock = threading.Lock()
+            _PROCESS_LOCKS[path] = lock
+        return lock
+
+@contextlib.contextmanager
+def db_lock(file_path=DEFAULT_DB_PATH):
+    """
+    exclusive lock on a database for a whole read-modify-write
+    fcntl advisory lock on <db>.lock between processes, plus a thread lock
+    inside this process; re-entrant for the thread that holds it
+    reads made while holding it always see the latest data (the cache
+    revalidates with os.stat) and writes happen before it is released
+    """
+    path = os.path.abspath(_storage_path(file_path))
+    held = getattr(_HELD, "counts", None)
+    if held is None:
+        held = _HELD.counts = {}
+    if held.get(path):
+        held[path] += 1
+        try:
+            yield
+        finally:
+            held[path] -= 1
+        return
+
+    with _process_lock(path):
+        with open(path + LOCK_SUFFIX, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            held[path] = 1
+            try:
+                yield
+            finally:
+                held[path] = 0
+                if fcntl is not None:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
 def reset_db(file_path=DEFAULT_DB_PATH):
     """reset database """
-    data = {
-        "users": [],
-        "files": [],
-        "messages": [],
-        "defenses": []
-    }
-    save_db(data, file_path)
+    with db_lock(file_path):
+        save_db(_empty_db(), file_path)
+
+
+def _stat_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class CachedDB:
+    """
+    keep the parsed database of one file in memory
+    os.stat (mtime_ns + size + inode) is checked on every access and the
+    file (or its journal) is parsed again only when another process changed it
+    the returned document is shared, callers must not mutate it; the public
+    getters hand out copies of its records (detached)
+    indexes (register_index) are built lazily per loaded document and
+    dropped whenever the document is replaced
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.data = None
+        self.indexes = {}
+        self.hits = 0
+        self.misses = 0
+        self._stamp = None
+
+    def _current_stamp(self):
+        path = _storage_path(self.file_path)
+        return (_stat_stamp(path), _stat_stamp(_journal_path(path)))
+
+    def get(self):
+        # stat before reading: if the file changes while we parse, the stamp
+        # we keep is older than the data and the next access reloads it
+        stamp = self._current_stamp()
+        if self.data is not None and stamp == self._stamp:
+            self.hits += 1
+            return self.data
+        self.misses += 1
+        self.data = load_db(self.file_path)
+        self.indexes = {}
+        self._stamp = stamp
+        return self.data
+
+    def prime(self, data):
+        """store a document that was just written to disk"""
+        if data is not self.data:
+            self.indexes = {}
+        self.data = data
+        self._stamp = self._current_stamp()
+
+    def invalidate(self):
+        self.data = None
+        self.indexes = {}
+        self._stamp = None
+
+    def index(self, name):
+        idx = self.indexes.get(name)
+        if idx is None:
+            idx = _INDEX_TYPES[name](self.data)
+            self.indexes[name] = idx
+        return idx
+
+    def notify(self, collection, old, new):
+        """keep built indexes in step with one change of the cached document"""
+        for idx in self.indexes.values():
+            if idx.collection == collection:
+                idx.update(old, new)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "cached": self.data is not None}
+
+
+_CACHES = {}
+
+def get_cached_db(file_path=DEFAULT_DB_PATH):
+    """return the process wide cached handle of a database file"""
+    key = os.path.abspath(_storage_path(file_path))
+    handle = _CACHES.get(key)
+    if handle is None:
+        handle = CachedDB(file_path)
+        _CACHES[key] = handle
+    return handle
+
+def load_db_cached(file_path=DEFAULT_DB_PATH):
+    """like load_db but served from memory while the file is unchanged (read only)"""
+    return get_cached_db(file_path).get()
+
+def cache_stats(file_path=DEFAULT_DB_PATH):
+    return get_cached_db(file_path).stats()
+
+
+def _journal_path(file_path):
+    return file_path + JOURNAL_SUFFIX
+
+def _meta(data):
+    meta = data.setdefault("meta", {})
+    meta.setdefault("journal_seq", 0)
+    meta.setdefault("snapshot_seq", 0)
+    return meta
+
+def set_journal_mode(enabled=True, file_path=DEFAULT_DB_PATH):
+    """
+    in journal mode every mutation is appended to <db>.journal as one compact
+    json line instead of rewriting the whole db.json
+    load_db replays the journal and it is folded back into db.json every
+    JOURNAL_COMPACT_EVERY operations (or by compact_db)
+    """
+    if _sqlite_path(file_path):
+        raise ValueError("journal mode is only for json databases, sqlite has its own")
+    key = os.path.abspath(file_path)
+    if enabled:
+        _JOURNALED.add(key)
+    else:
+        _JOURNALED.discard(key)
+        if os.path.exists(_journal_path(file_path)):
+            compact_db(file_path)
+
+def is_journaled(file_path=DEFAULT_DB_PATH):
+    return os.path.abspath(file_path) in _JOURNALED
+
+def _find_index(records, record_id):
+    for i, r in enumerate(records):
+        if r.get("id") == record_id:
+            return i
+    raise KeyError(f"record with id {record_id} not found")
+
+def _sequences(data):
+    return data.setdefault("meta", {}).setdefault("sequences", {})
+
+def _bump_sequence(data, collection, value):
+    seqs = _sequences(data)
+    if isinstance(value, int) and value > seqs.get(collection, 0):
+        seqs[collection] = value
+
+def _apply_op(data, op):
+    """apply one operation in place, return (record before, record after)"""
+    old, new = _apply_record_op(data, op)
+    agg = data.get("meta", {}).get(aggregates.KEY)
+    if agg is not None and (old is not None or new is not None):
+        aggregates.apply_change(agg, op["coll"], old, new)
+    return old, new
+
+def _apply_record_op(data, op):
+    kind = op["op"]
+    if kind == "seq":
+        _bump_sequence(data, op["coll"], op["value"])
+        return None, None
+    if kind == "meta":
+        # the op keeps its own copy, later changes to the header must not leak into the journal
+        data.setdefault("meta", {})[op["key"]] = copy.deepcopy(op["value"])
+        return None, None
+    records = data.setdefault(op["coll"], [])
+    if kind == "insert":
+        # the caller keeps op["record"], the document gets its own copy
+        record = dict(op["record"])
+        records.append(record)
+        if op["coll"] in _sequences(data):
+            # records inserted with their own id must not be handed out again
+            _bump_sequence(data, op["coll"], record.get("id"))
+        return None, record
+    if kind == "update":
+        record = records[_find_index(records, op["id"])]
+        old = dict(record)
+        record.update(op["fields"])
+        return old, record
+    if kind == "delete":
+        i = _find_index(records, op["id"])
+        old = records[i]
+        del records[i]
+        return old, None
+    raise ValueError(f"unknown journal operation: {kind}")
+
+def _replay_journal(data, file_path):
+    path = _journal_path(file_path)
+    if not os.path.exists(path):
+        return
+    meta = _meta(data)
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.endswith("\n"):
+                # torn tail of a crashed append: never committed, the next
+                # append cuts it off (_trim_torn_tail)
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                op = json.loads(line)
+            except ValueError:
+                raise ValueError(f"corrupt journal {path}: line {line_no} is not valid json")
+            # ops up to snapshot's seq are already inside db.json
+            if op["seq"] <= meta["journal_seq"]:
+                continue
+            _apply_op(data, op)
+            meta["journal_seq"] = op["seq"]
+
+def _trim_torn_tail(path):
+    """cut the journal back to its last newline (caller holds the lock)"""
+    try:
+        f = open(path, "r+b")
+    except FileNotFoundError:
+        return
+    with f:
+        end = f.seek(0, 2)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - 4096)
+            f.seek(start)
+            chunk = f.read(pos - start)
+            nl = chunk.rfind(b"\n")
+            if nl >= 0:
+                pos = start + nl + 1
+                break
+            pos = start
+        if pos == end:
+            return
+        f.truncate(pos)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _persist_ops(ops, file_path, data):
+    """
+    write operations already applied to data (caller holds the lock)
+    journal mode: append them to the journal, cost is the size of the change
+    otherwise: rewrite db.json once for the whole list
+    """
+    if not is_journaled(file_path):
+        save_db(data, file_path)
+        return
+
+    meta = _meta(data)
+    lines = []
+    for op in ops:
+        meta["journal_seq"] += 1
+        lines.append(json.dumps(dict(op, seq=meta["journal_seq"]), ensure_ascii=False, separators=(",", ":")))
+    # a torn line left by a crash must not swallow the lines appended after it
+    _trim_torn_tail(_journal_path(file_path))
+    with open(_journal_path(file_path), "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    get_cached_db(file_path).prime(data)
+    if meta["journal_seq"] - meta["snapshot_seq"] >= JOURNAL_COMPACT_EVERY:
+        save_db(data, file_path)
+
+
+class Transaction:
+    """
+    unit of work on one database
+
+        with Transaction("db.json") as tx:
+            sid = add_user(..., tx=tx)
+            record_defense(sid, ..., tx=tx)
+
+    - db_lock is held from enter to exit
+    - json: the document is loaded (or revalidated) once, every read inside
+      works on that snapshot and insert/update/delete change it right away
+    - sqlite: operations run inside one sqlite transaction
+    - all operations are written together at exit: one save_db, one journal
+      append or one sqlite commit; if an exception leaves the block nothing
+      is written
+    entering the same transaction again (nested manager calls) is a no-op
+    """
+
+    def __init__(self, file_path=DEFAULT_DB_PATH):
+        self.file_path = file_path
+        self.ops = []
+        self._sqlite_path = _sqlite_path(file_path)
+        self._data = None
+        self._depth = 0
+        self._lock = None
+        self._after_commit = []
+        self._after_rollback = []
+        self.changes = []
+        self._version = None
+        self._indexes = {}
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._lock = db_lock(self.file_path)
+            self._lock.__enter__()
+            if _COMMIT_LISTENERS:
+                self._version = db_version(self.file_path)
+            if not self._sqlite_path:
+                # under the lock: reloads if another process wrote since our last read
+                self._data = get_cached_db(self.file_path).get()
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth > 0:
+            return False
+        callbacks, self._after_commit = self._after_commit, []
+        undo, self._after_rollback = self._after_rollback, []
+        changes, self.changes = self.changes, []
+        wrote = bool(self.ops)
+        try:
+            if exc_type is None:
+                self._commit()
+                if wrote and self._version is not None:
+                    # still under the lock: listeners see exactly this version of the file
+                    for listener in list(_COMMIT_LISTENERS):
+                        listener(self.file_path, changes, self._version)
+            else:
+                callbacks = undo
+                self._rollback()
+        finally:
+            self._data = None
+            self._version = None
+            self._indexes = {}
+            self._lock.__exit__(None, None, None)
+            self._lock = None
+        for fn in callbacks:
+            fn()
+        return False
+
+    def on_commit(self, fn):
+        """call fn() after the transaction is written and unlocked, dropped on rollback"""
+        self._after_commit.append(fn)
+
+    def on_rollback(self, fn):
+        """call fn() after the transaction is rolled back and unlocked (undo work done outside the database)"""
+        self._after_rollback.append(fn)
+
+    def _commit(self):
+        ops, self.ops = self.ops, []
+        if self._sqlite_path:
+            sqlite_backend.commit(self._sqlite_path)
+            if ops:
+                # queries go to sqlite directly, the full document is rebuilt only if asked for
+                get_cached_db(self.file_path).invalidate()
+            return
+        if not ops:
+            return
+        try:
+            _persist_ops(ops, self.file_path, self._data)
+        except BaseException:
+            get_cached_db(self.file_path).invalidate()
+            raise
+
+    def _rollback(self):
+        ops, self.ops = self.ops, []
+        if self._sqlite_path:
+            sqlite_backend.rollback(self._sqlite_path)
+        elif ops:
+            # the shared cached document already has our changes, drop it
+            get_cached_db(self.file_path).invalidate()
+
+    @property
+    def data(self):
+        """whole document as seen inside the transaction (read only)"""
+        if self._sqlite_path:
+            return load_db(self.file_path)
+        return self._data
+
+    def index(self, name):
+        """
+        index over what this transaction sees; json: the cached one (get_index),
+        sqlite: built from its collection on first use and kept in step with
+        the transaction's own writes until it ends
+        """
+        if not self._sqlite_path:
+            return get_index(name, self.file_path, self)
+        idx = self._indexes.get(name)
+        if idx is None:
+            cls = _INDEX_TYPES[name]
+            idx = self._indexes[name] = cls({cls.collection: self.find(cls.collection)})
+        return idx
+
+    def apply(self, op):
+        if self._sqlite_path:
+            changes = sqlite_backend.apply_ops([op], self._sqlite_path, commit=False)
+            for coll, old, new in changes:
+                for idx in self._indexes.values():
+                    if idx.collection == coll:
+                        idx.update(old, new)
+        else:
+            old, new = _apply_op(self._data, op)
+            changes = [(op["coll"], old, new)] if old is not None or new is not None else []
+            handle = get_cached_db(self.file_path)
+            if handle.data is self._data and changes:
+                handle.notify(op["coll"], old, new)
+        if _COMMIT_LISTENERS:
+            self.changes.extend(changes)
+        self.ops.append(op)
+
+    def insert(self, collection, record):
+        self.apply({"op": "insert", "coll": collection, "record": record})
+        return record
+
+    def update(self, collection, record_id, fields):
+        self.apply({"op": "update", "coll": collection, "id": record_id, "fields": fields})
+
+    def delete(self, collection, record_id):
+        self.apply({"op": "delete", "coll": collection, "id": record_id})
+
+    def find(self, collection, **filters):
+        if self._sqlite_path:
+            return sqlite_backend.find(self._sqlite_path, collection, filters)
+        return _scan(self._data, collection, filters)
+
+    def get(self, collection, record_id):
+        found = self.find(collection, id=record_id)
+        return found[0] if found else None
+
+    def count(self, collection, **filters):
+        if self._sqlite_path:
+            return sqlite_backend.count(self._sqlite_path, collection, filters)
+        return len(self.find(collection, **filters))
+
+    def max_id(self, collection):
+        if self._sqlite_path:
+            return sqlite_backend.max_id(self._sqlite_path, collection)
+        return _max_id(self._data, collection)
+
+    def allocate_ids(self, collection, count=1):
+        """
+        reserve count new ids from the collection's sequence in the header
+        ids only go up, ids of deleted records are never handed out again
+        """
+        if count < 1:
+            raise ValueError("count must be >= 1")
+        if self._sqlite_path:
+            last = sqlite_backend.sequence(self._sqlite_path, collection)
+        else:
+            last = _sequences(self._data).get(collection)
+        if last is None:
+            # first allocation on an old database: start after the biggest id
+            last = self.max_id(collection)
+        self.apply({"op": "seq", "coll": collection, "value": last + count})
+        return list(range(last + 1, last + count + 1))
+
+
+def transaction(file_path=DEFAULT_DB_PATH, tx=None):
+    """the given transaction (manager functions called with tx=...) or a new one"""
+    return tx if tx is not None else Transaction(file_path)
+
+def read_db(file_path=DEFAULT_DB_PATH, tx=None):
+    """whole document: the snapshot of tx, or the cached one (read only)"""
+    return tx.data if tx is not None else load_db_cached(file_path)
+
+def add_commit_listener(fn):
+    """
+    fn(file_path, changes, version) runs after every committed transaction of
+    this process, still under the lock; changes is [(collection, record
+    before, record after)], version the db_version the transaction started from
+    writes of other processes are not reported, compare db_version for those
+    """
+    _COMMIT_LISTENERS.append(fn)
+
+def db_version(file_path=DEFAULT_DB_PATH):
+    """opaque value that changes whenever the database is written (by any process)"""
+    path = _storage_path(file_path)
+    if _sqlite_path(file_path):
+        return (_stat_stamp(path), _stat_stamp(path + "-journal"), _stat_stamp(path + "-wal"))
+    return (_stat_stamp(path), _stat_stamp(_journal_path(path)))
+
+def read_meta(file_path=DEFAULT_DB_PATH, tx=None):
+    """the database header (sequences, aggregates, ...) without loading every table on sqlite (read only)"""
+    sqlite_path = _sqlite_path(file_path)
+    if sqlite_path:
+        return sqlite_backend.read_meta(sqlite_path)
+    return read_db(file_path, tx).get("meta", {})
+
+def allocate_ids(collection, count=1, file_path=DEFAULT_DB_PATH, tx=None):
+    """
+    reserve count ids of a collection (see Transaction.allocate_ids)
+    without tx the reservation is committed at once, useful for bulk imports
+    """
+    with transaction(file_path, tx) as tx:
+        return tx.allocate_ids(collection, count)
+
+def next_id(collection, file_path=DEFAULT_DB_PATH, tx=None):
+    return allocate_ids(collection, 1, file_path, tx)[0]
+
+def apply_ops(ops, file_path=DEFAULT_DB_PATH):
+    """apply insert/update/delete operations to the database and write them at once"""
+    with Transaction(file_path) as tx:
+        for op in ops:
+            tx.apply(op)
+
+def insert_record(collection, record, file_path=DEFAULT_DB_PATH, tx=None):
+    with transaction(file_path, tx) as tx:
+        return tx.insert(collection, record)
+
+def update_record(collection, record_id, fields, file_path=DEFAULT_DB_PATH, tx=None):
+    with transaction(file_path, tx) as tx:
+        tx.update(collection, record_id, fields)
+
+def delete_record(collection, record_id, file_path=DEFAULT_DB_PATH, tx=None):
+    with transaction(file_path, tx) as tx:
+        tx.delete(collection, record_id)
+
+def register_index(name, index_cls):
+    """
+    register an in-memory index kind for json databases
+    index_cls(data) builds it from a document, index_cls.collection names
+    the collection it covers and .update(old, new) is called for every change
+    of that collection (old is None on insert, new is None on delete)
+    """
+    _INDEX_TYPES[name] = index_cls
+
+def get_index(name, file_path=DEFAULT_DB_PATH, tx=None):
+    """
+    index over the current document (the snapshot of tx inside a transaction)
+    None for sqlite databases, they answer the same questions from sql indexes
+    """
+    if _sqlite_path(file_path):
+        return None
+    handle = get_cached_db(file_path)
+    if tx is None:
+        handle.get()  # revalidate before trusting the index
+    elif handle.data is not tx.data:
+        # snapshot that is not the cached one, index it on its own
+        return _INDEX_TYPES[name](tx.data)
+    return handle.index(name)
+
+def rebuild_index(name, file_path=DEFAULT_DB_PATH):
+    """throw away a built index and build it again from the current document"""
+    if _sqlite_path(file_path):
+        return None
+    handle = get_cached_db(file_path)
+    handle.get()
+    handle.indexes.pop(name, None)
+    return handle.index(name)
+
+def _field(record, name):
+    if name == "name_cf":
+        value = record.get("name")
+        return value.strip().casefold() if isinstance(value, str) else None
+    return record.get(name)
+
+def _scan(data, collection, filters):
+    items = filters.items()
+    return [r for r in data.get(collection, [])
+            if all(_field(r, k) == v for k, v in items)]
+
+def detached(records, file_path=DEFAULT_DB_PATH, tx=None):
+    """
+    records of the cached document as handed to callers outside a
+    transaction: shallow copies, so changing them can not reach the cache
+    (and the next commit); inside a transaction and on sqlite, whose rows
+    are built per query, they are returned as they are
+    """
+    if tx is not None or _sqlite_path(file_path):
+        return list(records)
+    return [dict(r) for r in records]
+
+def detached_record(record, file_path=DEFAULT_DB_PATH, tx=None):
+    """detached for one record (or None)"""
+    return record if record is None else detached([record], file_path, tx)[0]
+
+def _max_id(data, collection):
+    return max((r.get("id", 0) for r in data.get(collection, [])), default=0)
+
+def find_records(collection, file_path=DEFAULT_DB_PATH, tx=None, **filters):
+    """
+    records of a collection whose fields equal all filters
+    sqlite answers from its indexes, json scans the cached document
+    (or the snapshot of tx) and returns copies outside a transaction
+    filter 'name_cf' matches the stripped + casefolded name
+    """
+    if tx is not None:
+        return tx.find(collection, **filters)
+    sqlite_path = _sqlite_path(file_path)
+    if sqlite_path:
+        return sqlite_backend.find(sqlite_path, collection, filters)
+    return detached(_scan(load_db_cached(file_path), collection, filters), file_path)
+
+def get_record(collection, record_id, file_path=DEFAULT_DB_PATH, tx=None):
+    found = find_records(collection, file_path, tx=tx, id=record_id)
+    return found[0] if found else None
+
+def count_records(collection, file_path=DEFAULT_DB_PATH, tx=None, **filters):
+    if tx is not None:
+        return tx.count(collection, **filters)
+    sqlite_path = _sqlite_path(file_path)
+    if sqlite_path:
+        return sqlite_backend.count(sqlite_path, collection, filters)
+    return len(_scan(load_db_cached(file_path), collection, filters))
+
+def max_id(collection, file_path=DEFAULT_DB_PATH, tx=None):
+    if tx is not None:
+        return tx.max_id(collection)
+    sqlite_path = _sqlite_path(file_path)
+    if sqlite_path:
+        return sqlite_backend.max_id(sqlite_path, collection)
+    return _max_id(load_db_cached(file_path), collection)
+
+def mailbox_page(user_id, page_size, before=None, after=None, file_path=DEFAULT_DB_PATH):
+    """
+    sqlite: one page of a user's messages from the sql indexes, see
+    sqlite_backend.mailbox_page (json databases page with the mailbox index)
+    """
+    sqlite_path = _sqlite_path(file_path)
+    if not sqlite_path:
+        raise ValueError("mailbox_page is only for sqlite databases")
+    return sqlite_backend.mailbox_page(sqlite_path, user_id, page_size, before=before, after=after)
+
+def compact_db(file_path=DEFAULT_DB_PATH):
+    """fold the journal into a fresh db.json snapshot"""
+    with db_lock(file_path):
+        save_db(load_db_cached(file_path), file_path)
 
 
 if __name__ == "__main__":
     reset_db()
-    print("DB initialized:", load_db())
\ No newline at end of file
+    print("DB initialized:", load_db())
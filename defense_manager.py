@@ -1,12 +1,12 @@
+import bisect
 import datetime
-from database import load_db , save_db
+import heapq
+from database import transaction , read_db , insert_record , update_record , find_records , get_record , next_id , register_index , get_index , rebuild_index , detached , detached_record
 from pathlib import Path
+from timestamps import record_ord
 
-def _next_defense_id(db):
-    defs_ = db.get("defenses") or []
-    if not defs_:
-        return 1
-    return max(d.get("id" , 0) for d in defs_) + 1
+def _next_defense_id(db_path, tx=None):
+    return next_id("defenses", db_path, tx=tx)
 
 """convert to datetime.date"""
 def _parse_date(d):
@@ -29,14 +29,14 @@ def _parse_date(d):
         
     
     """normalize committee members for database"""
-def _normalize_committee(members, db_path="db.json"):
+def _normalize_committee(members, db_path="db.json", tx=None):
     if not isinstance(members, (list, tuple)):
         raise ValueError("committee_members must be a list")
     normalized = []
     from user_manager import get_user_by_id
     for item in members:
         if isinstance(item, (int)):
-            u = get_user_by_id(item , db_path = "db.json")
+            u = get_user_by_id(item , db_path, tx=tx)
             if not u:
                 raise ValueError(f"Committee member with id {item} not found.")
             if u.get("role") != "teacher":
@@ -56,7 +56,7 @@ def _normalize_committee(members, db_path="db.json"):
         elif isinstance(item, dict):
             if "id" in item and item["id"] is not None:
                 uid = item["id"]
-                u = get_user_by_id(uid, db_path)
+                u = get_user_by_id(uid, db_path, tx=tx)
                 if not u:
                     raise ValueError(f"Committee member with id {uid} not found.")
                 if u.get("role") != "teacher":
@@ -86,46 +86,103 @@ def _normalize_committee(members, db_path="db.json"):
         raise ValueError("Committee must include at least one member with role 'teacher'.")
     return normalized                
 
-def count_jury_assignments(teacher_id , db_path = "db.json"):
-    db = load_db(db_path)
-    cnt = 0
-    for d in db.get("defenses" , []):
-        for m in d.get("committee_members" , []):
-            if m.get("id") == teacher_id and m.get("role") == "teacher":
-                cnt +=1
-    return cnt
+def _jury_teacher_ids(defense):
+    return [m.get("id") for m in defense.get("committee_members") or []
+            if m.get("role") == "teacher" and m.get("id") is not None]
+
+
+class JuryIndex:
+    """
+    jury load of every teacher in one loaded snapshot: teacher id -> ids of
+    the defenses they sit on (a teacher listed twice counts twice)
+    built once per snapshot and kept up to date on every defense change
+    """
+    collection = "defenses"
+
+    def __init__(self, data):
+        self.defenses_of = {}
+        for d in data.get("defenses", []):
+            self._add(d)
+
+    def _add(self, d):
+        for tid in _jury_teacher_ids(d):
+            bisect.insort(self.defenses_of.setdefault(tid, []), d.get("id"))
+
+    def _remove(self, d):
+        for tid in _jury_teacher_ids(d):
+            ids = self.defenses_of.get(tid)
+            if ids and d.get("id") in ids:
+                ids.remove(d.get("id"))
+
+    def update(self, old, new):
+        if old is not None:
+            self._remove(old)
+        if new is not None:
+            self._add(new)
+
+    def count(self, teacher_id):
+        return len(self.defenses_of.get(teacher_id, ()))
+
+    def top(self, limit):
+        counts = ((tid, len(ids)) for tid, ids in self.defenses_of.items() if ids)
+        return heapq.nlargest(limit, counts, key=lambda x: x[1])
+
+register_index("jury", JuryIndex)
+
+def _jury_index(db_path, tx=None):
+    idx = get_index("jury", db_path, tx)
+    if idx is None:
+        # sqlite: committee members are not in columns, index the defenses
+        # once per transaction (once per call outside one)
+        if tx is not None:
+            return tx.index("jury")
+        idx = JuryIndex({"defenses": find_records("defenses", db_path)})
+    return idx
+
+def count_jury_assignments(teacher_id , db_path = "db.json", tx=None):
+    return _jury_index(db_path, tx).count(teacher_id)
+
+def jury_load(db_path="db.json", tx=None):
+    """teacher id -> list of defense ids the teacher is a jury member of"""
+    return {tid: list(ids) for tid, ids in _jury_index(db_path, tx).defenses_of.items() if ids}
+
+def top_jury_teachers(limit=10, db_path="db.json", tx=None):
+    """[(teacher id, assignments)] with the most loaded teachers first"""
+    return _jury_index(db_path, tx).top(limit)
+
+def rebuild_jury_counters(db_path="db.json"):
+    """recount the jury load from scratch (e.g. after editing db.json by hand)"""
+    rebuild_index("jury", db_path)
 """new defense for student"""
-def record_defense (student_id , date , committee_members , final_score , notes = None , recorded_by=None, db_path="db.json"):
-    db = load_db(db_path)
-    db.setdefault("defenses" , [])
-    
+def record_defense (student_id , date , committee_members , final_score , notes = None , recorded_by=None, db_path="db.json", tx=None):
     from user_manager import get_user_by_id
-    student = get_user_by_id(student_id , db_path)
+    with transaction(db_path, tx) as tx:
+        student = get_user_by_id(student_id , db_path, tx=tx)
     
-    if not student or student.get("role") != "student":
-        raise ValueError(f"Student with id {student_id} not found or not a student.")
+        if not student or student.get("role") != "student":
+            raise ValueError(f"Student with id {student_id} not found or not a student.")
 
-    for d in db.get("defenses" , []):
-        if d.get("student_id") == student_id:
-            raise ValueError(f"A defense record already exists for student id {student_id} (id={d.get('id')}).")    
+        existing = find_records("defenses", db_path, tx=tx, student_id=student_id)
+        if existing:
+            raise ValueError(f"A defense record already exists for student id {student_id} (id={existing[0].get('id')}).")    
 
-    defense_date = _parse_date(date)
-    """conver id/string/dict to list of it"""
-    normalized_committee = _normalize_committee(committee_members, db_path=db_path)
+        defense_date = _parse_date(date)
+        """conver id/string/dict to list of it"""
+        normalized_committee = _normalize_committee(committee_members, db_path=db_path, tx=tx)
     
-    teachers_in_new = {}
-    for cm in normalized_committee:
-        if cm.get("role") == "teacher" and cm.get("id") is not None:
-            teachers_in_new[cm["id"]] = teachers_in_new.get(cm["id"] , 0) + 1
-
-    for tid,add_count in teachers_in_new.items():
-        teacher = get_user_by_id(tid , db_path) 
-        if not teacher:
-            raise ValueError(f"Teacher id {tid} not found.")
-        current = count_jury_assignments(tid, db_path)   
-        cap = int(teacher.get("jury_capacity" , 10))         
-        if current + add_count > cap:
-            raise ValueError(f"Teacher id {tid} would exceed jury capacity ({current} + {add_count} > {cap}).")
+        teachers_in_new = {}
+        for cm in normalized_committee:
+            if cm.get("role") == "teacher" and cm.get("id") is not None:
+                teachers_in_new[cm["id"]] = teachers_in_new.get(cm["id"] , 0) + 1
+
+        for tid,add_count in teachers_in_new.items():
+            teacher = get_user_by_id(tid , db_path, tx=tx) 
+            if not teacher:
+                raise ValueError(f"Teacher id {tid} not found.")
+            current = count_jury_assignments(tid, db_path, tx=tx)   
+            cap = int(teacher.get("jury_capacity" , 10))         
+            if current + add_count > cap:
+                raise ValueError(f"Teacher id {tid} would exceed jury capacity ({current} + {add_count} > {cap}).")
                     
         if final_score is not None:
             try:
@@ -139,85 +196,76 @@ def record_defense (student_id , date , committee_members , final_score , notes
             final_score = None
 
         if recorded_by is not None:
-            rb = get_user_by_id(recorded_by , db_path)
+            rb = get_user_by_id(recorded_by , db_path, tx=tx)
             if not rb:
                raise ValueError(f"Recorded by user id {recorded_by} not found.") 
 
-        new_id = _next_defense_id(db)
+        new_id = _next_defense_id(db_path, tx)
         now = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
         record = {
             "id": new_id,
             "student_id": student_id,
             "date": defense_date.isoformat(),
+            "date_ord": defense_date.toordinal(),
             "committee_members": normalized_committee,
             "final_score": final_score,
             "notes": notes,
             "recorded_by": recorded_by,
             "recorded_at": now
         }
-        
-        db["defenses"].append(record)
-        save_db(db, db_path)
-        return record
+    
+        insert_record("defenses", record, db_path, tx=tx)
+    return record
 
 
-def list_defenses(db_path="db.json"):
-    db = load_db(db_path)
+def list_defenses(db_path="db.json", tx=None):
+    db = read_db(db_path, tx)
     defs_ = db.get("defenses" , [])
-    def _key_fn(d):
-        try:
-            return _parse_date(d.get("date"))
-        except Exception:
-            return datetime.date.min
-    return sorted(defs_, key=_key_fn, reverse=True)
+    return detached(sorted(defs_, key=record_ord, reverse=True), db_path, tx)
         
-def get_defense_by_id (defense_id , db_path = "db.json"):
-    db = load_db(db_path)
-    for d in db.get("defenses" , []):
-        if d.get("id") == defense_id:
-            return d
-        return None
+def get_defense_by_id (defense_id , db_path = "db.json", tx=None):
+    return get_record("defenses", defense_id, db_path, tx=tx)
 
-def list_defenses_by_student(student_id, db_path="db.json"):
-    db = load_db(db_path)
-    return [d for d in db.get("defenses", []) if d.get("student_id") == student_id]
+def list_defenses_by_student(student_id, db_path="db.json", tx=None):
+    return find_records("defenses", db_path, tx=tx, student_id=student_id)
 
 """edit defense for student"""
-def update_defense(defense_id, final_score=None, notes=None, committee_members=None, db_path="db.json"):
-    db = load_db(db_path)
-    found = None
-    for d in db.get("defenses" , []):
-        if d.get("id") == defense_id:
-            found = d
-            break
-    if not found:
-        raise ValueError(f"Defense with id {defense_id} not found.")
+def update_defense(defense_id, final_score=None, notes=None, committee_members=None, db_path="db.json", tx=None):
+    caller_tx = tx
+    with transaction(db_path, tx) as tx:
+        found = get_record("defenses", defense_id, db_path, tx=tx)
+        if not found:
+            raise ValueError(f"Defense with id {defense_id} not found.")
         
-    if committee_members is not None:
-        normalize = _normalize_committee(committee_members , db_path = db_path)
-        teachers_in_new = {}
-        for cm in normalize:
-            if cm.get("role") == "teacher" and cm.get("id") is not None:
-                teachers_in_new[cm["id"]] = teachers_in_new.get(cm["id"], 0) + 1        
+        fields = {}
+        if committee_members is not None:
+            normalize = _normalize_committee(committee_members , db_path = db_path, tx=tx)
+            teachers_in_new = {}
+            for cm in normalize:
+                if cm.get("role") == "teacher" and cm.get("id") is not None:
+                    teachers_in_new[cm["id"]] = teachers_in_new.get(cm["id"], 0) + 1        
         
-        from user_manager import get_user_by_id
-        for tid,add_count in teachers_in_new.items():
-            teacher = get_user_by_id(tid,db_path)
-            if not teacher:
-                raise ValueError(f"Teacher id {tid} not found.")
-            current = count_jury_assignments(tid , db_path) 
-            cap = int(teacher.get("jury_capacity", 10))
-            if current + add_count > cap:
-                raise ValueError(f"Teacher id {tid} would exceed jury capacity ({current} + {add_count} > {cap}).")
-            found["committee_members"] = normalize
+            from user_manager import get_user_by_id
+            for tid,add_count in teachers_in_new.items():
+                teacher = get_user_by_id(tid,db_path, tx=tx)
+                if not teacher:
+                    raise ValueError(f"Teacher id {tid} not found.")
+                # this defense's current committee is replaced, do not count it
+                current = count_jury_assignments(tid , db_path, tx=tx) - _jury_teacher_ids(found).count(tid)
+                cap = int(teacher.get("jury_capacity", 10))
+                if current + add_count > cap:
+                    raise ValueError(f"Teacher id {tid} would exceed jury capacity ({current} + {add_count} > {cap}).")
+            fields["committee_members"] = normalize
         if final_score is not None:
             try:
                 fs = float(final_score)
             except Exception:
-                if fs < 0 or fs > 20:
-                    raise ValueError("final score must be between 0 and 20")
-                found["final_score"] = fs
-            if notes is not None:
-                found["notes"]= notes
-            save_db(db , db_path)
-            return found
\ No newline at end of file
+                raise ValueError("final score must be a number")
+            if fs < 0 or fs > 20:
+                raise ValueError("final score must be between 0 and 20")
+            fields["final_score"] = fs
+        if notes is not None:
+            fields["notes"]= notes
+        if fields:
+            update_record("defenses", defense_id, fields, db_path, tx=tx)
+        return detached_record(get_record("defenses", defense_id, db_path, tx=tx), db_path, caller_tx)
@@ -1,101 +1,560 @@
-import shutil
 import datetime
+import hashlib
+import heapq
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from database import load_db, save_db
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+from file_metadata import enqueue as enqueue_metadata
+from database import transaction, read_db, insert_record, update_record, delete_record, find_records, get_record, next_id, register_index, get_index, detached
 
 ALLOWED_EXTS = {".pdf", ".jpg", ".jpeg"}
 UPLOADS_DIR = Path("uploads")
+CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409  # linux ioctl: clone a file's extents into another file
 
-def _next_file_id(db):
-    if not db["files"]:
-        return 1
-    return max(f["id"] for f in db["files"]) + 1
+def _upload_limit(value):
+    """THESIS_MAX_UPLOAD_BYTES: a number of bytes, empty / 0 / none for no limit"""
+    if value is None:
+        return 100 * 1024 * 1024
+    value = value.strip()
+    if value.lower() in ("", "0", "none"):
+        return None
+    return int(value)
+
+# bigger uploads are refused, None for no limit
+MAX_UPLOAD_BYTES = _upload_limit(os.environ.get("THESIS_MAX_UPLOAD_BYTES"))
+
+def _next_file_id(db_path, tx=None):
+    return next_id("files", db_path, tx=tx)
+
+
+"""
+upload store: file contents are kept once per sha256 under
+uploads/ab/cd/abcd... and a 'blobs' record counts the files using it
+"""
+
+class BlobIndex:
+    """sha256 -> blob record, for one loaded snapshot"""
+    collection = "blobs"
+
+    def __init__(self, data):
+        self.by_sha = {}
+        for b in data.get("blobs", []):
+            self.update(None, b)
+
+    def update(self, old, new):
+        if old is not None:
+            self.by_sha.pop(old.get("sha256"), None)
+        if new is not None:
+            self.by_sha[new.get("sha256")] = new
+
+register_index("blobs", BlobIndex)
+
+def _blob_by_sha(digest, db_path, tx=None):
+    idx = get_index("blobs", db_path, tx)
+    if idx is not None:
+        return idx.by_sha.get(digest)
+    found = find_records("blobs", db_path, tx=tx, sha256=digest)
+    return found[0] if found else None
+
+def _blob_path(digest):
+    return UPLOADS_DIR / digest[:2] / digest[2:4] / digest
 
-def register_file(file_path, description="", uploader_id=None, db_path="db.json"):
-    
-    p = Path(file_path)
-    if not p.exists():
-        raise FileNotFoundError(f"File not found: {file_path}")
 
-    ext = p.suffix.lower()
+"""
+ingest: the content decides the type, not the name
+"""
+MAGIC = {
+    "pdf": (b"%PDF-",),
+    "jpg": (b"\xff\xd8\xff",),
+}
+EXTS_OF = {"pdf": {".pdf"}, "jpg": {".jpg", ".jpeg"}}
+# bytes needed to tell the types apart
+MAGIC_BYTES = max(len(p) for prefixes in MAGIC.values() for p in prefixes)
+
+def _detect_type(head):
+    for kind, prefixes in MAGIC.items():
+        if head.startswith(prefixes):
+            return kind
+    raise ValueError("Unsupported file content: only PDF and JPEG files are accepted.")
+
+def _file_type(head, name):
+    """'pdf' / 'jpg' / 'jpeg' from the first bytes, checked against the name's extension"""
+    kind = _detect_type(head)
+    ext = Path(name).suffix.lower() if name else ""
+    if not ext:
+        return kind
     if ext not in ALLOWED_EXTS:
         raise ValueError(f"Invalid file type: {ext}. Allowed: {ALLOWED_EXTS}")
+    if ext not in EXTS_OF[kind]:
+        raise ValueError(f"File content is {kind.upper()} but the name ends with {ext}.")
+    return ext.lstrip(".")
+
+def _check_size(size, max_size):
+    if max_size is not None and size > max_size:
+        raise ValueError(f"File is too large: more than {max_size} bytes.")
+
+def _temp_file():
+    tmp_dir = UPLOADS_DIR / "tmp"
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=tmp_dir, suffix=".part")
+    return fd, Path(tmp)
+
+def _hash_file(path, max_size=None):
+    h = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+            size += len(chunk)
+            _check_size(size, max_size)
+    return h.hexdigest(), size
+
+def _reflink(fin, fout):
+    """copy on write clone (btrfs, xfs, ...), False where not supported"""
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+        return True
+    except OSError:
+        return False
+
+def _fast_copy(src, fout, size):
+    """copy a whole file into fout inside the kernel when possible"""
+    with open(src, "rb") as fin:
+        if _reflink(fin, fout):
+            return
+        done = 0
+        for name in ("copy_file_range", "sendfile"):
+            fn = getattr(os, name, None)
+            if fn is None:
+                continue
+            try:
+                while done < size:
+                    if name == "copy_file_range":
+                        n = fn(fin.fileno(), fout.fileno(), size - done)
+                    else:
+                        n = fn(fout.fileno(), fin.fileno(), done, size - done)
+                    if n == 0:
+                        break
+                    done += n
+                return
+            except OSError:
+                if done:
+                    raise
+        shutil.copyfileobj(fin, fout, CHUNK_SIZE)
+
+def _copy_verified(src, digest, size):
+    """
+    copy src into a temp file inside the kernel, then hash the copy: src may
+    have been rewritten since it was hashed (even at the same size) and the
+    blob stored under digest must hold exactly that content
+    """
+    fd, tmp = _temp_file()
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            _fast_copy(src, fout, size)
+            fout.flush()
+            os.fsync(fout.fileno())
+        if _hash_file(tmp) != (digest, size):
+            raise ValueError(f"File changed while it was uploaded: {src}")
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return tmp
+
+def _stage_path(src, name, max_size, db_path):
+    """hash a file (read only), copy it into a temp file only if its content is new"""
+    _check_size(src.stat().st_size, max_size)
+    with open(src, "rb") as f:
+        file_type = _file_type(f.read(MAGIC_BYTES), name)
+    digest, size = _hash_file(src, max_size)
+    tmp = None
+    if _blob_by_sha(digest, db_path) is None:
+        tmp = _copy_verified(src, digest, size)
+    return digest, size, file_type, tmp
+
+def _stage_stream(stream, name, max_size):
+    """write a binary stream into a temp file, hashing, size checking and type checking on the way"""
+    fd, tmp = _temp_file()
+    h = hashlib.sha256()
+    size = 0
+    file_type = None
+    head = b""
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                if file_type is None:
+                    # pipes and sockets may return less than the signature in one read
+                    head += chunk
+                    if len(head) >= MAGIC_BYTES:
+                        file_type = _file_type(head, name)
+                size += len(chunk)
+                _check_size(size, max_size)
+                h.update(chunk)
+                fout.write(chunk)
+            fout.flush()
+            os.fsync(fout.fileno())
+        if not head:
+            raise ValueError("File is empty.")
+        if file_type is None:
+            file_type = _file_type(head, name)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return h.hexdigest(), size, file_type, tmp
+
+def _store_blob(digest, size, tmp, src, db_path, tx):
+    """
+    blob record of a staged upload, its refcount already counting the new file
+    tmp is the staged copy, None when the content was already stored at
+    staging time (then src is copied here if that blob went away meanwhile)
+    """
+    blob = _blob_by_sha(digest, db_path, tx)
+    if blob is not None:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
+        update_record("blobs", blob["id"], {"refcount": blob.get("refcount", 0) + 1}, db_path, tx=tx)
+        return blob
+    if tmp is None:
+        tmp = _copy_verified(src, digest, size)
+    dst = _blob_path(digest)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(tmp, dst)
+    # no record will point to the file if the transaction does not commit
+    tx.on_rollback(lambda: _remove_unused_blob(digest, str(dst), db_path))
+    blob = {
+        "id": next_id("blobs", db_path, tx=tx),
+        "sha256": digest,
+        "stored_path": str(dst),
+        "size_bytes": size,
+        "refcount": 1,
+        "created_at": datetime.datetime.utcnow().isoformat() + "Z"
+    }
+    insert_record("blobs", blob, db_path, tx=tx)
+    return blob
 
-    db = load_db(db_path)
+def _remove_blob_file(path):
+    p = Path(path)
+    p.unlink(missing_ok=True)
+    # drop the shard directories once they are empty
+    for d in (p.parent, p.parent.parent):
+        try:
+            d.rmdir()
+        except OSError:
+            break
 
- 
-    if uploader_id is not None:
-        from user_manager import get_user_by_id
-        uploader = get_user_by_id(uploader_id, db_path)
-        if uploader is None:
-            raise ValueError(f"Uploader with id {uploader_id} not found.")
-        if not uploader.get("is_active", True):
-            raise ValueError(f"Uploader with id {uploader_id} is not active.")
+def _remove_unused_blob(digest, path, db_path):
+    """
+    after a delete commits (or a new blob is rolled back): remove a blob's
+    file unless the content was stored again meanwhile (same transaction,
+    another thread or process); the lock keeps registrations from replacing
+    the file while we look
+    """
+    with transaction(db_path) as tx:
+        if _blob_by_sha(digest, db_path, tx) is None:
+            _remove_blob_file(path)
 
-    new_id = _next_file_id(db)
-    stored_name = f"file_{new_id}_{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S')}{ext}"
-    stored_path = UPLOADS_DIR / stored_name
-    UPLOADS_DIR.mkdir(exist_ok=True)
+def upload_stats(db_path="db.json", tx=None):
+    """how much the content addressed store saves: files vs. bytes really on disk"""
+    db = read_db(db_path, tx)
+    files = db.get("files", [])
+    blobs = db.get("blobs", [])
+    logical = sum(f.get("size_bytes") or 0 for f in files)
+    # files stored before the blob store keep their own copy
+    stored = sum(b.get("size_bytes") or 0 for b in blobs)
+    stored += sum(f.get("size_bytes") or 0 for f in files if not f.get("sha256"))
+    return {
+        "files": len(files),
+        "blobs": len(blobs),
+        "logical_bytes": logical,
+        "stored_bytes": stored,
+        "bytes_saved": logical - stored,
+        "dedup_ratio": round(logical / stored, 3) if stored else 1.0
+    }
+
+def register_file(file_path, description="", uploader_id=None, db_path="db.json", tx=None, max_size=MAX_UPLOAD_BYTES):
+    """
+    store a file from disk, the type comes from its first bytes (pdf/jpeg)
+    new content is copied inside the kernel (reflink, copy_file_range or
+    sendfile), known content is only hashed
+    """
+    p = Path(file_path)
+    if not p.is_file():
+        raise FileNotFoundError(f"File not found: {file_path}")
+    staged = _stage_path(p, p.name, max_size, db_path)
+    return _register_staged(staged, p, p.name, description, uploader_id, db_path, tx)
 
-    shutil.copy2(p, stored_path)
-    size_bytes = stored_path.stat().st_size
+def register_stream(stream, original_name, description="", uploader_id=None, db_path="db.json", tx=None, max_size=MAX_UPLOAD_BYTES):
+    """
+    store a file read from a binary stream (an http upload, a pipe, ...)
+    the stream is read once, the size limit is enforced while reading
+    """
+    staged = _stage_stream(stream, original_name, max_size)
+    return _register_staged(staged, None, original_name, description, uploader_id, db_path, tx)
 
+def _check_uploader(uploader_id, db_path, tx=None):
+    if uploader_id is None:
+        return
+    from user_manager import get_user_by_id
+    uploader = get_user_by_id(uploader_id, db_path, tx=tx)
+    if uploader is None:
+        raise ValueError(f"Uploader with id {uploader_id} not found.")
+    if not uploader.get("is_active", True):
+        raise ValueError(f"Uploader with id {uploader_id} is not active.")
+
+def _insert_staged(new_id, staged, src, original_name, description, uploader_id, db_path, tx):
+    digest, size, file_type, tmp = staged
+    blob = _store_blob(digest, size, tmp, src, db_path, tx)
     record = {
         "id": new_id,
-        "original_name": p.name,
-        "stored_path": str(stored_path),
-        "file_type": ext.lstrip("."),
+        "original_name": Path(original_name).name if original_name else f"upload_{new_id}.{file_type}",
+        "stored_path": blob["stored_path"],
+        "sha256": digest,
+        "file_type": file_type,
         "description": description,
         "uploader_id": uploader_id,
-        "size_bytes": size_bytes,
+        "size_bytes": size,
         "registered_at": datetime.datetime.utcnow().isoformat() + "Z",
         "metadata": {}  
     }
+    insert_record("files", record, db_path, tx=tx)
+    # filled in by the metadata worker (file_metadata.py)
+    enqueue_metadata(new_id, db_path, tx=tx)
 
-    db["files"].append(record)
-    save_db(db, db_path)
+def _register_staged(staged, src, original_name, description, uploader_id, db_path, tx):
+    tmp = staged[3]
+    try:
+        with transaction(db_path, tx) as tx:
+            _check_uploader(uploader_id, db_path, tx)
+            new_id = _next_file_id(db_path, tx)
+            _insert_staged(new_id, staged, src, original_name, description, uploader_id, db_path, tx)
+    finally:
+        if tmp is not None:
+            tmp.unlink(missing_ok=True)
     return new_id
 
-def list_files(db_path="db.json"):
-    db = load_db(db_path)
-    return db["files"]
+def register_many(paths, description="", uploader_id=None, db_path="db.json", workers=None,
+                  progress=None, max_size=MAX_UPLOAD_BYTES, tx=None):
+    """
+    register many files at once: they are checked, hashed and copied on a
+    thread pool, the uploader is checked before staging (and again inside
+    the transaction) and all records are written in one transaction
+    progress(done, total, path, error) is called as each file is staged
+    a bad file does not stop the others, returns
+    {"registered": [(path, file id)], "errors": [(path, message)]}
+    """
+    paths = [Path(p) for p in paths]
+    _check_uploader(uploader_id, db_path, tx)
+    staged, errors = {}, []
+
+    def _stage(p):
+        if not p.is_file():
+            raise FileNotFoundError(f"File not found: {p}")
+        return _stage_path(p, p.name, max_size, db_path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_stage, p): p for p in paths}
+        for done, fut in enumerate(as_completed(futures), 1):
+            p = futures[fut]
+            error = None
+            try:
+                staged[p] = fut.result()
+            except (OSError, ValueError) as e:
+                error = str(e)
+                errors.append((str(p), error))
+            if progress is not None:
+                progress(done, len(paths), str(p), error)
+
+    registered = []
+    ok = [p for p in paths if p in staged]
+    try:
+        if ok:
+            with transaction(db_path, tx) as tx:
+                # the uploader may have gone while the files were staged
+                _check_uploader(uploader_id, db_path, tx)
+                ids = tx.allocate_ids("files", len(ok))
+                for p, new_id in zip(ok, ids):
+                    _insert_staged(new_id, staged[p], p, p.name, description, uploader_id, db_path, tx)
+                    registered.append((str(p), new_id))
+    finally:
+        for digest, size, file_type, tmp in staged.values():
+            if tmp is not None:
+                tmp.unlink(missing_ok=True)
+    errors.sort()
+    return {"registered": registered, "errors": errors}
+
+def register_directory(root, recursive=True, **kwargs):
+    """register_many over every pdf/jpg file below root (sorted by path)"""
+    root = Path(root)
+    if not root.is_dir():
+        raise FileNotFoundError(f"Directory not found: {root}")
+    pattern = "**/*" if recursive else "*"
+    paths = sorted(p for p in root.glob(pattern) if p.is_file() and p.suffix.lower() in ALLOWED_EXTS)
+    return register_many(paths, **kwargs)
+
+def list_files(db_path="db.json", tx=None):
+    db = read_db(db_path, tx)
+    return detached(db.get("files", []), db_path, tx)
+
+def _trigrams(text):
+    text = text.casefold() if isinstance(text, str) else ""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class FileIndex:
+    """
+    lookups over the file records of one loaded snapshot:
+    uploader id -> ids, file type -> ids, and trigram -> ids of the
+    casefolded original_name / description for substring searches
+    """
+    collection = "files"
+
+    def __init__(self, data):
+        self.by_id = {}
+        self.by_uploader = {}
+        self.by_type = {}
+        self.name_grams = {}
+        self.desc_grams = {}
+        for f in data.get("files", []):
+            self._add(f)
+
+    @staticmethod
+    def _indexed(f):
+        return (f.get("uploader_id"), f.get("file_type"), f.get("original_name"), f.get("description"))
+
+    def _add(self, f):
+        fid = f.get("id")
+        self.by_id[fid] = f
+        self.by_uploader.setdefault(f.get("uploader_id"), set()).add(fid)
+        self.by_type.setdefault(f.get("file_type"), set()).add(fid)
+        for g in _trigrams(f.get("original_name")):
+            self.name_grams.setdefault(g, set()).add(fid)
+        for g in _trigrams(f.get("description")):
+            self.desc_grams.setdefault(g, set()).add(fid)
+
+    def _remove(self, f):
+        fid = f.get("id")
+        self.by_id.pop(fid, None)
+        self.by_uploader.get(f.get("uploader_id"), set()).discard(fid)
+        self.by_type.get(f.get("file_type"), set()).discard(fid)
+        for g in _trigrams(f.get("original_name")):
+            self.name_grams.get(g, set()).discard(fid)
+        for g in _trigrams(f.get("description")):
+            self.desc_grams.get(g, set()).discard(fid)
+
+    def update(self, old, new):
+        if old is not None and new is not None and self._indexed(old) == self._indexed(new):
+            # e.g. metadata filled in: nothing indexed changed
+            self.by_id[new.get("id")] = new
+            return
+        if old is not None:
+            self._remove(old)
+        if new is not None:
+            self._add(new)
+
+    def candidates(self, file_type=None, uploader_id=None, name_contains=None, description_contains=None):
+        """ids that can match, None means every file; substrings still need checking"""
+        sets = []
+        if file_type is not None:
+            sets.append(self.by_type.get(file_type, set()))
+        if uploader_id is not None:
+            sets.append(self.by_uploader.get(uploader_id, set()))
+        for text, grams in ((name_contains, self.name_grams), (description_contains, self.desc_grams)):
+            for g in _trigrams(text):
+                sets.append(grams.get(g, set()))
+        if not sets:
+            return None
+        sets.sort(key=len)
+        result = set(sets[0])
+        for s in sets[1:]:
+            if not result:
+                break
+            result &= s
+        return result
+
+register_index("files", FileIndex)
+
+SORT_KEYS = {
+    "id": lambda f: f.get("id") or 0,
+    "size": lambda f: f.get("size_bytes") or 0,
+    "registered_at": lambda f: f.get("registered_at") or "",
+}
+
+def find_files(db_path="db.json", file_type=None, uploader_id=None, original_name_contains=None, tx=None,
+               description_contains=None, sort_by="id", descending=False, limit=None, offset=0):
+    """
+    files matching every given filter, the *_contains filters are
+    case-insensitive substring tests
+    sort_by is one of SORT_KEYS, limit/offset select a page of the result
+    """
+    if sort_by not in SORT_KEYS:
+        raise ValueError(f"sort_by must be one of {sorted(SORT_KEYS)}")
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("limit and offset must be >= 0")
+    name_q = original_name_contains.casefold() if original_name_contains is not None else None
+    desc_q = description_contains.casefold() if description_contains is not None else None
+
+    idx = get_index("files", db_path, tx)
+    if idx is not None:
+        ids = idx.candidates(file_type, uploader_id, name_q, desc_q)
+        # type/uploader sets are exact, trigram sets only narrow the substring tests below
+        records = idx.by_id.values() if ids is None else (idx.by_id[i] for i in ids)
+    else:
+        filters = {}
+        if file_type is not None:
+            filters["file_type"] = file_type
+        if uploader_id is not None:
+            filters["uploader_id"] = uploader_id
+        records = find_records("files", db_path, tx=tx, **filters)
 
-def find_files(db_path="db.json", file_type=None, uploader_id=None, original_name_contains=None):
-    db = load_db(db_path)
-    files = db.get("files", []) or []
     results = []
-    for f in files:
-        if file_type is not None and f.get("file_type") != file_type:
+    for f in records:
+        if name_q is not None and name_q not in (f.get("original_name") or "").casefold():
             continue
-        if uploader_id is not None and f.get("uploader_id") != uploader_id:
+        if desc_q is not None and desc_q not in (f.get("description") or "").casefold():
             continue
-        if original_name_contains is not None:
-            name = f.get("original_name") or ""
-            if original_name_contains.lower() not in name.lower():
-                continue
         results.append(f)
-    return results
-
-def get_file_by_id(file_id, db_path="db.json"):
-    db = load_db(db_path)
-    for f in db["files"]:
-        if f["id"] == file_id:
-            return f
-    return None
-
-def delete_file(file_id, db_path="db.json", delete_from_disk=False):
-    db = load_db(db_path)
-    for i, f in enumerate(db["files"]):
-        if f["id"] == file_id:
-            if delete_from_disk:
-                try:
-                    Path(f["stored_path"]).unlink(missing_ok=True)
-                except Exception:
-                    pass
-            del db["files"][i]
-            save_db(db, db_path)
-            return True
-    return False
+
+    key = SORT_KEYS[sort_by]
+    if limit is not None and offset + limit < len(results):
+        pick = heapq.nlargest if descending else heapq.nsmallest
+        results = pick(offset + limit, results, key=key)
+    else:
+        results.sort(key=key, reverse=descending)
+    end = None if limit is None else offset + limit
+    return detached(results[offset:end], db_path, tx)
+
+def get_file_by_id(file_id, db_path="db.json", tx=None):
+    return get_record("files", file_id, db_path, tx=tx)
+
+def delete_file(file_id, db_path="db.json", delete_from_disk=False, tx=None):
+    """
+    remove a file record, the stored content goes with the last file using it
+    delete_from_disk only matters for files stored before the blob store
+    """
+    with transaction(db_path, tx) as tx:
+        f = get_record("files", file_id, db_path, tx=tx)
+        if f is None:
+            return False
+        delete_record("files", file_id, db_path, tx=tx)
+        blob = _blob_by_sha(f["sha256"], db_path, tx) if f.get("sha256") else None
+        if blob is not None:
+            if blob.get("refcount", 0) > 1:
+                update_record("blobs", blob["id"], {"refcount": blob["refcount"] - 1}, db_path, tx=tx)
+            else:
+                delete_record("blobs", blob["id"], db_path, tx=tx)
+                tx.on_commit(lambda: _remove_unused_blob(blob["sha256"], blob["stored_path"], db_path))
+        elif delete_from_disk:
+            tx.on_commit(lambda: Path(f["stored_path"]).unlink(missing_ok=True))
+    return True
 
 if __name__ == "__main__":
     from database import reset_db
@@ -0,0 +1,430 @@
+"""
+metadata of uploaded files, filled in the background after upload
+
+register_file only queues a 'jobs' record (in the same transaction as the
+file record), a MetadataWorker picks queued jobs up in batches, extracts
+them on a thread pool and writes the results of a batch into the files'
+"metadata" fields in one transaction
+parsing only reads headers: the pdf version line, the trailer and the few
+objects it points to (catalog, page tree root, info dict), and the jpeg
+markers up to the frame header; a file is never read into memory whole
+a claimed job is 'running' with a lease (claimed_by host:pid, lease_until
+epoch seconds); only jobs whose lease ran out are given to another worker
+"""
+import datetime
+import os
+import re
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from database import transaction, find_records, get_record, insert_record, update_record, delete_record, next_id
+
+JOB_KIND = "file_metadata"
+MAX_ATTEMPTS = 3
+# seconds a worker may hold a claimed job, extraction only reads headers
+LEASE_SECONDS = 600
+TAIL_BYTES = 64 * 1024
+OBJECT_BYTES = 8 * 1024
+SCAN_CHUNK = 1024 * 1024
+
+_WORKERS = set()
+_WORKERS_LOCK = threading.Lock()
+
+
+def _now():
+    return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+
+
+"""pdf"""
+
+_REF = rb"(\d+)\s+(\d+)\s+R"
+
+def _ref(text, key):
+    m = None
+    for m in re.finditer(rb"/" + key + rb"\s+" + _REF, text):
+        pass
+    return int(m.group(1)) if m else None
+
+def _read_object(f, offset):
+    """the dictionary text of the object starting at offset"""
+    f.seek(offset)
+    chunk = f.read(OBJECT_BYTES)
+    end = chunk.find(b"endobj")
+    return chunk if end < 0 else chunk[:end]
+
+def _xref_offsets(f, startxref, wanted):
+    """
+    byte offsets of the wanted object numbers from classic xref tables
+    (following /Prev), {} for xref streams which keep objects compressed
+    """
+    found = {}
+    seen = set()
+    pos = startxref
+    while pos is not None and pos not in seen and len(found) < len(wanted):
+        seen.add(pos)
+        f.seek(pos)
+        if f.read(4) != b"xref":
+            break
+        f.readline()
+        while True:
+            line = f.readline().strip()
+            m = re.match(rb"(\d+)\s+(\d+)$", line)
+            if not m:
+                break
+            first, count = int(m.group(1)), int(m.group(2))
+            section = f.tell()
+            for num in wanted:
+                if num not in found and first <= num < first + count:
+                    f.seek(section + 20 * (num - first))
+                    entry = f.read(20).split()
+                    if len(entry) >= 3 and entry[2] == b"n":
+                        found[num] = int(entry[0])
+            f.seek(section + 20 * count)
+        # 'line' now starts the trailer of this section
+        trailer = line + f.read(2048)
+        prev = re.search(rb"/Prev\s+(\d+)", trailer)
+        pos = int(prev.group(1)) if prev else None
+    return found
+
+def _pdf_string(raw):
+    """decode a pdf literal (...) or hex <...> string"""
+    if raw.startswith(b"<"):
+        data = bytes.fromhex(re.sub(rb"\s", b"", raw[1:-1]).decode("ascii") or "")
+    else:
+        body = raw[1:-1]
+        out = bytearray()
+        i = 0
+        escapes = {ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t", ord("b"): b"\b", ord("f"): b"\f"}
+        while i < len(body):
+            c = body[i]
+            if c == 0x5C and i + 1 < len(body):  # backslash
+                nxt = body[i + 1]
+                if nxt in escapes:
+                    out += escapes[nxt]
+                    i += 2
+                elif 0x30 <= nxt <= 0x37:
+                    m = re.match(rb"[0-7]{1,3}", body[i + 1:i + 4])
+                    out.append(int(m.group(0), 8) & 0xFF)
+                    i += 1 + len(m.group(0))
+                elif nxt in (0x0A, 0x0D):
+                    i += 2
+                else:
+                    out.append(nxt)
+                    i += 2
+            else:
+                out.append(c)
+                i += 1
+        data = bytes(out)
+    if data.startswith(b"\xfe\xff"):
+        return data[2:].decode("utf-16-be", "replace")
+    try:
+        # not what the spec says (pdfdocencoding), but what many producers write
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return data.decode("latin-1")
+
+def _title(info):
+    m = re.search(rb"/Title\s*(\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>)", info, re.S)
+    return _pdf_string(m.group(1)) if m else None
+
+def _scan_page_count(f):
+    """fallback for compressed xref: biggest /Count of a /Type /Pages node, read in chunks"""
+    f.seek(0)
+    best = None
+    carry = b""
+    for chunk in iter(lambda: f.read(SCAN_CHUNK), b""):
+        buf = carry + chunk
+        for m in re.finditer(rb"/Type\s*/Pages\b", buf):
+            window = buf[max(0, m.start() - 512):m.end() + 512]
+            c = re.search(rb"/Count\s+(\d+)", window)
+            if c:
+                best = max(best or 0, int(c.group(1)))
+        carry = buf[-1024:]
+    return best
+
+def pdf_metadata(path):
+    """{"pdf_version", "pages", "title"} from the header, trailer and catalog of a pdf"""
+    md = {"pdf_version": None, "pages": None, "title": None}
+    with open(path, "rb") as f:
+        m = re.match(rb"%PDF-(\d+\.\d+)", f.read(16))
+        if m:
+            md["pdf_version"] = m.group(1).decode("ascii")
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(max(0, size - TAIL_BYTES))
+        tail = f.read()
+        sx = re.findall(rb"startxref\s+(\d+)", tail)
+        root, info = _ref(tail, b"Root"), _ref(tail, b"Info")
+        offsets = {}
+        if sx and root is not None:
+            offsets = _xref_offsets(f, int(sx[-1]), [n for n in (root, info) if n is not None])
+        if root in offsets:
+            pages = _ref(_read_object(f, offsets[root]), b"Pages")
+            if pages is not None:
+                more = _xref_offsets(f, int(sx[-1]), [pages])
+                if pages in more:
+                    c = re.search(rb"/Count\s+(\d+)", _read_object(f, more[pages]))
+                    md["pages"] = int(c.group(1)) if c else None
+        if info in offsets:
+            md["title"] = _title(_read_object(f, offsets[info]))
+        if md["pages"] is None:
+            md["pages"] = _scan_page_count(f)
+    return md
+
+
+"""jpeg"""
+
+# start of frame markers, the ones that carry the image size
+_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def jpeg_metadata(path):
+    """{"width", "height", "components"} from the jpeg frame header"""
+    md = {"width": None, "height": None, "components": None}
+    with open(path, "rb") as f:
+        if f.read(2) != b"\xff\xd8":
+            raise ValueError("not a jpeg file")
+        while True:
+            if f.read(1) != b"\xff":
+                break
+            b = f.read(1)
+            while b == b"\xff":  # fill bytes
+                b = f.read(1)
+            if not b:
+                break
+            marker = b[0]
+            if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                continue
+            if marker == 0xD9 or marker == 0xDA:
+                # end of image / start of scan: no frame header before the data
+                break
+            length = int.from_bytes(f.read(2), "big")
+            if marker in _SOF:
+                seg = f.read(6)
+                md["height"] = int.from_bytes(seg[1:3], "big")
+                md["width"] = int.from_bytes(seg[3:5], "big")
+                md["components"] = seg[5]
+                break
+            f.seek(length - 2, 1)
+    return md
+
+
+def extract_metadata(file_record):
+    """metadata dict of a stored file, read from its header only"""
+    path = file_record["stored_path"]
+    if file_record.get("file_type") == "pdf":
+        md = pdf_metadata(path)
+    else:
+        md = jpeg_metadata(path)
+    md["extracted_at"] = _now()
+    return md
+
+
+"""job queue"""
+
+def enqueue(file_id, db_path="db.json", tx=None):
+    """queue metadata extraction of a file (call inside the transaction that adds the file)"""
+    job = {
+        "id": next_id("jobs", db_path, tx=tx),
+        "kind": JOB_KIND,
+        "file_id": file_id,
+        "status": "pending",
+        "attempts": 0,
+        "error": None,
+        "created_at": _now(),
+        "finished_at": None
+    }
+    insert_record("jobs", job, db_path, tx=tx)
+    if tx is not None:
+        tx.on_commit(wake)
+    else:
+        wake()
+    return job["id"]
+
+def _owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _expired(job, now):
+    return job.get("lease_until") is None or job["lease_until"] <= now
+
+def _claim(db_path, limit):
+    """
+    lease up to limit pending jobs (and running ones whose lease ran out) to
+    this process, return them as they were before
+    """
+    now = int(time.time())
+    with transaction(db_path) as tx:
+        jobs = find_records("jobs", db_path, tx=tx, status="pending")[:limit]
+        if len(jobs) < limit:
+            stale = [j for j in find_records("jobs", db_path, tx=tx, status="running") if _expired(j, now)]
+            jobs += stale[:limit - len(jobs)]
+        # copies: on json the records are the live ones update_record changes
+        jobs = [dict(j) for j in jobs]
+        claimed = []
+        for job in jobs:
+            if job.get("attempts", 0) >= MAX_ATTEMPTS:
+                # its worker died on the last attempt
+                update_record("jobs", job["id"], {"status": "failed", "error": "lease expired",
+                                                  "finished_at": _now()}, db_path, tx=tx)
+                continue
+            update_record("jobs", job["id"], {"status": "running", "attempts": job.get("attempts", 0) + 1,
+                                              "claimed_by": _owner(), "lease_until": now + LEASE_SECONDS},
+                         db_path, tx=tx)
+            claimed.append(job)
+    return claimed
+
+def _still_ours(job, db_path, tx):
+    """False if the lease ran out and another worker claimed the job since"""
+    current = get_record("jobs", job["id"], db_path, tx=tx)
+    return (current is not None and current.get("status") == "running"
+            and current.get("claimed_by") == _owner()
+            and current.get("attempts") == job.get("attempts", 0) + 1)
+
+def _extract(job, db_path):
+    """(job, metadata, error) of one claimed job, runs outside the database lock"""
+    f = get_record("files", job["file_id"], db_path)
+    md, error = None, None
+    if f is not None:
+        try:
+            md = extract_metadata(f)
+        except (OSError, ValueError, IndexError) as e:
+            error = f"{type(e).__name__}: {e}"
+    return job, md, error
+
+def _store(results, db_path):
+    """write the results of a batch in one transaction, returns their statuses"""
+    statuses = []
+    with transaction(db_path) as tx:
+        for job, md, error in results:
+            if not _still_ours(job, db_path, tx):
+                statuses.append("lost")
+                continue
+            if md is not None and get_record("files", job["file_id"], db_path, tx=tx) is not None:
+                update_record("files", job["file_id"], {"metadata": md}, db_path, tx=tx)
+            if error is None:
+                # finished jobs are not kept, the queue only holds work and failures
+                delete_record("jobs", job["id"], db_path, tx=tx)
+                statuses.append("done")
+                continue
+            status = "pending" if job.get("attempts", 0) + 1 < MAX_ATTEMPTS else "failed"
+            update_record("jobs", job["id"], {"status": status, "error": error, "finished_at": _now(),
+                                              "claimed_by": None, "lease_until": None}, db_path, tx=tx)
+            statuses.append(status)
+    return statuses
+
+def recover_jobs(db_path="db.json"):
+    """
+    put jobs left 'running' by a stopped process back in the queue, only
+    those whose lease ran out: another process may still be working on the rest
+    """
+    now = int(time.time())
+    with transaction(db_path) as tx:
+        stale = [j for j in find_records("jobs", db_path, tx=tx, status="running") if _expired(j, now)]
+        for job in stale:
+            update_record("jobs", job["id"], {"status": "pending", "claimed_by": None, "lease_until": None},
+                          db_path, tx=tx)
+    return len(stale)
+
+def process_pending(db_path="db.json", workers=4, limit=None):
+    """
+    run queued jobs now and wait for them, returns {status: count}
+    jobs are claimed in batches of up to limit (64), extracted on a thread
+    pool and each batch is written back in one transaction
+    """
+    counts = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            jobs = _claim(db_path, limit or 64)
+            if not jobs:
+                break
+            results = list(pool.map(lambda j: _extract(j, db_path), jobs))
+            for status in _store(results, db_path):
+                counts[status] = counts.get(status, 0) + 1
+            if limit is not None:
+                break
+    return counts
+
+def queue_stats(db_path="db.json"):
+    """
+    {status: count} of the queued jobs, plus "worker_error": the last error
+    of a running worker of this database when its last run failed
+    """
+    counts = {}
+    for job in find_records("jobs", db_path):
+        counts[job.get("status")] = counts.get(job.get("status"), 0) + 1
+    with _WORKERS_LOCK:
+        workers = [w for w in _WORKERS if w.db_path == db_path]
+    for w in workers:
+        if w.last_error is not None:
+            counts["worker_error"] = w.last_error
+    return counts
+
+
+class MetadataWorker:
+    """
+    background thread draining the job queue of one database
+    woken right after a file is registered, polls every poll_interval
+    seconds for jobs queued by other processes
+    a failed run is retried at the next poll; errors counts them and
+    last_error describes the latest one until a run succeeds
+    """
+
+    def __init__(self, db_path="db.json", workers=2, poll_interval=5.0):
+        self.db_path = db_path
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._event = threading.Event()
+        self._stop = False
+        self._thread = None
+        self.errors = 0
+        self.last_error = None
+
+    def start(self):
+        recover_jobs(self.db_path)
+        self._thread = threading.Thread(target=self._loop, name="metadata-worker", daemon=True)
+        self._thread.start()
+        with _WORKERS_LOCK:
+            _WORKERS.add(self)
+        return self
+
+    def stop(self, wait=True):
+        self._stop = True
+        self._event.set()
+        with _WORKERS_LOCK:
+            _WORKERS.discard(self)
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        self._event.set()
+
+    def _loop(self):
+        while not self._stop:
+            try:
+                process_pending(self.db_path, workers=self.workers)
+                self.last_error = None
+            except Exception as e:
+                # a broken run must not kill the worker, the jobs stay queued
+                self.errors += 1
+                self.last_error = f"{_now()} {type(e).__name__}: {e}"
+            self._event.wait(self.poll_interval)
+            self._event.clear()
+
+
+def wake():
+    """tell running workers that jobs were queued"""
+    with _WORKERS_LOCK:
+        workers = list(_WORKERS)
+    for w in workers:
+        w.wake()
+
+def start_worker(db_path="db.json", workers=2, poll_interval=5.0):
+    return MetadataWorker(db_path, workers=workers, poll_interval=poll_interval).start()
+
+
+if __name__ == "__main__":
+    import sys
+    db = sys.argv[1] if len(sys.argv) > 1 else "db.json"
+    recover_jobs(db)
+    print("processed:", process_pending(db))
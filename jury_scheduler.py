@@ -0,0 +1,200 @@
+"""
+automatic jury assignment for a batch of defenses
+
+the batch is a min-cost flow problem:
+    source -> defense         capacity = committee size
+    defense -> teacher        capacity 1, every active teacher except the
+                              student's advisor
+    teacher -> sink           one edge per free jury seat, the k-th seat of
+                              a teacher costs (load + k) / jury_capacity
+the seat costs grow with the load, so the cheapest flow spreads the seats
+in proportion to each teacher's capacity
+it is solved by successive shortest paths: every defense -> teacher edge
+costs nothing, so the shortest augmenting path from a defense ends at the
+cheapest teacher reachable from it through alternating assigned/free
+edges; usually that teacher is eligible directly, when it is the advisor
+or already on the committee a seat of another defense in the batch is
+handed over (the path is found by bfs, _path)
+"""
+import datetime
+import heapq
+from collections import deque
+
+from database import transaction, read_db
+from defense_manager import _parse_date, jury_load
+
+DEFAULT_COMMITTEE_SIZE = 3
+
+
+def read_pending(path):
+    """pending defenses from a .csv (header: student_id,date[,committee_size,notes]) or .jsonl file"""
+    from user_manager import read_user_rows
+    pending = []
+    for row in read_user_rows(path):
+        if row.get("_error"):
+            raise ValueError(row["_error"])
+        item = {"student_id": row.get("student_id"), "date": row.get("date")}
+        for k in ("committee_size", "notes"):
+            if row.get(k) not in (None, ""):
+                item[k] = row[k]
+        pending.append(item)
+    return pending
+
+
+def _int(value, what):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{what} must be an integer")
+
+
+class _Assignment:
+    """seats of the batch while they are being handed out"""
+
+    def __init__(self, teachers, load, blocked):
+        self.cap = {t["id"]: int(t.get("jury_capacity", 10)) for t in teachers}
+        self.load = {tid: load.get(tid, 0) for tid in self.cap}
+        self.blocked = blocked  # defense -> teachers it cannot take (advisor, members)
+        self.members = [[] for _ in blocked]
+        self.seats_of = {}  # teacher -> batch defenses they sit on
+        self.heap = [(self._cost(tid), tid, self.load[tid]) for tid in self.cap if self.load[tid] < self.cap[tid]]
+        heapq.heapify(self.heap)
+
+    def _cost(self, tid):
+        return (self.load[tid] + 1) / self.cap[tid]
+
+    def _seat(self, d, tid):
+        self.members[d].append(tid)
+        self.blocked[d].add(tid)
+        self.seats_of.setdefault(tid, set()).add(d)
+
+    def _unseat(self, d, tid):
+        self.members[d].remove(tid)
+        self.blocked[d].discard(tid)
+        self.seats_of[tid].discard(d)
+
+    def _path(self, d, target):
+        """
+        [(teacher, from defense, to defense)] moves that let d take one more
+        seat and target fill one more, [] if target can sit on d directly,
+        None if target is not reachable from d
+        """
+        if target not in self.blocked[d]:
+            return []
+        parent = {d: None}
+        queue = deque([d])
+        while queue:
+            x = queue.popleft()
+            for y, zs in self.seats_of.items():
+                if y in self.blocked[x]:
+                    continue
+                for z in zs:
+                    if z in parent:
+                        continue
+                    # y may leave z for x
+                    parent[z] = (y, x)
+                    if target not in self.blocked[z]:
+                        moves = []
+                        while parent[z] is not None:
+                            y, prev = parent[z]
+                            moves.append((y, z, prev))
+                            z = prev
+                        return moves[::-1]
+                    queue.append(z)
+        return None
+
+    def add_seat(self, d):
+        """give defense d one more jury member, False if no teacher can be reached"""
+        skipped = []
+        try:
+            while self.heap:
+                cost, tid, load = heapq.heappop(self.heap)
+                if load != self.load[tid]:
+                    continue  # stale entry
+                moves = self._path(d, tid)
+                if moves is None:
+                    skipped.append((cost, tid, load))
+                    continue
+                last = d
+                for y, src, dst in moves:
+                    self._unseat(src, y)
+                    self._seat(dst, y)
+                    last = src
+                self._seat(last, tid)
+                self.load[tid] += 1
+                if self.load[tid] < self.cap[tid]:
+                    heapq.heappush(self.heap, (self._cost(tid), tid, self.load[tid]))
+                return True
+            return False
+        finally:
+            for entry in skipped:
+                heapq.heappush(self.heap, entry)
+
+
+def assign_juries(pending, db_path="db.json", committee_size=DEFAULT_COMMITTEE_SIZE,
+                  recorded_by=None, dry_run=False, tx=None):
+    """
+    record a batch of defenses with their committees chosen automatically
+    pending: [{"student_id", "date", "committee_size" (optional), "notes" (optional)}]
+    the student's advisor is never on their jury, no teacher goes over
+    jury_capacity and the load is balanced against it (see module doc)
+    everything is written in one transaction, nothing if any defense can not
+    be staffed (ValueError); dry_run only returns the records
+    returns the new defense records in the order of pending
+    """
+    with transaction(db_path, tx) as tx:
+        db = read_db(db_path, tx)
+        users = {u.get("id"): u for u in db.get("users", [])}
+        has_defense = {d.get("student_id") for d in db.get("defenses", [])}
+        if recorded_by is not None and recorded_by not in users:
+            raise ValueError(f"Recorded by user id {recorded_by} not found.")
+        teachers = [u for u in db.get("users", [])
+                    if u.get("role") == "teacher" and u.get("is_active", True) and int(u.get("jury_capacity", 10)) > 0]
+
+        items, blocked, seen = [], [], set()
+        for i, p in enumerate(pending):
+            sid = _int(p.get("student_id"), f"pending[{i}]: student_id")
+            student = users.get(sid)
+            if not student or student.get("role") != "student":
+                raise ValueError(f"pending[{i}]: student with id {sid} not found or not a student.")
+            if sid in has_defense or sid in seen:
+                raise ValueError(f"pending[{i}]: a defense already exists for student id {sid}.")
+            seen.add(sid)
+            size = _int(p.get("committee_size", committee_size), f"pending[{i}]: committee_size")
+            if size < 1:
+                raise ValueError(f"pending[{i}]: committee_size must be at least 1")
+            items.append((sid, _parse_date(p.get("date")), size, p.get("notes")))
+            blocked.append({student.get("advisor_id")} - {None})
+
+        demand = sum(size for _, _, size, _ in items)
+        current = {tid: len(ids) for tid, ids in jury_load(db_path, tx).items()}
+        plan = _Assignment(teachers, current, blocked)
+        free = sum(plan.cap[t] - plan.load[t] for t in plan.cap if plan.load[t] < plan.cap[t])
+        if demand > free:
+            raise ValueError(f"not enough jury capacity: {demand} seats needed, {free} free")
+        for d, (sid, _, size, _) in enumerate(items):
+            for _ in range(size):
+                if not plan.add_seat(d):
+                    raise ValueError(f"no teacher left who can sit on the jury of student id {sid}")
+
+        now = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        records = []
+        for (sid, date, _, notes), members in zip(items, plan.members):
+            records.append({
+                "id": None,
+                "student_id": sid,
+                "date": date.isoformat(),
+                "date_ord": date.toordinal(),
+                "committee_members": [{"id": tid, "name": users[tid].get("name"), "role": "teacher"}
+                                      for tid in sorted(members)],
+                "final_score": None,
+                "notes": notes,
+                "recorded_by": recorded_by,
+                "recorded_at": now
+            })
+        if dry_run or not records:
+            return records
+        for record, new_id in zip(records, tx.allocate_ids("defenses", len(records))):
+            record["id"] = new_id
+            tx.insert("defenses", record)
+    return records
@@ -1,14 +1,19 @@
+import argparse
 import json
+import os
 import traceback
 
 from database import load_db, save_db
-from user_manager import add_user, list_users, get_user_by_id, change_advisor, set_teacher_capacity
-from file_manager import register_file, list_files, get_file_by_id, find_files, delete_file
+from user_manager import add_user, list_users, get_user_by_id, change_advisor, set_teacher_capacity, import_users
+from file_metadata import start_worker, queue_stats
+from file_manager import register_file, list_files, get_file_by_id, find_files, delete_file, upload_stats
 from message_system import send_message, list_messages
 from defense_manager import record_defense, list_defenses, get_defense_by_id, update_defense
-from report_generator import generate_teacher_report, generate_student_report, generate_overall_report, report_to_text, export_report
+from jury_scheduler import assign_juries, read_pending
+from report_generator import generate_teacher_report, generate_student_report, generate_overall_report, report_to_text, export_report, export_all_reports, export_student_reports
 
-DB_DEFAULT = "db.json"
+# a sqlite database can be used with THESIS_DB=sqlite:///thesis.db
+DB_DEFAULT = os.environ.get("THESIS_DB", "db.json")
 
 
 def _print_json(obj):
@@ -67,6 +72,20 @@ def create_user():
     pause()
 
 
+def _print_import_result(res):
+    print("created:", len(res["created"]), "errors:", len(res["errors"]))
+    for row_no, err in res["errors"]:
+        print(f"  row {row_no}: {err}")
+
+
+def import_users_interactive():
+    path = input("csv or jsonl file: ").strip()
+    workers = _input_int("worker processes (enter for all cores): ", allow_empty=True)
+    res = import_users(path, db_path=DB_DEFAULT, workers=workers)
+    _print_import_result(res)
+    pause()
+
+
 def change_user_advisor():
     sid = _input_int("student id: ")
     tid = _input_int("new teacher id: ")
@@ -95,12 +114,10 @@ def show_files():
 
 def register_file_interactive():
     path = input("file path: ").strip()
-    ft = input("file type (pdf/jpg): ").strip()
     desc = input("description (optional): ").strip()
     uploader = input("uploader id (enter for none): ").strip()
     uploader_id = int(uploader) if uploader else None
-    uploads_dir = input("uploads dir (enter for default behavior): ").strip() or None
-    fid = register_file(path, ft, description=desc, uploader_id=uploader_id, db_path=DB_DEFAULT, uploads_dir=uploads_dir)
+    fid = register_file(path, description=desc, uploader_id=uploader_id, db_path=DB_DEFAULT)
     print("registered file id:", fid)
     pause()
 
@@ -117,12 +134,17 @@ def find_files_interactive():
 
 def delete_file_interactive():
     fid = _input_int("file id to delete: ")
-    remove = input("also remove physical file? (y/N): ").strip().lower() == "y"
-    delete_file(fid, db_path=DB_DEFAULT, remove_file=remove)
+    remove = input("also remove physical file of an old upload? (y/N): ").strip().lower() == "y"
+    delete_file(fid, db_path=DB_DEFAULT, delete_from_disk=remove)
     print("deleted (or marked)")
     pause()
 
 
+def show_upload_stats():
+    _print_json({**upload_stats(db_path=DB_DEFAULT), "metadata_queue": queue_stats(DB_DEFAULT)})
+    pause()
+
+
 def send_message_interactive():
     sid = _input_int("sender id: ")
     rid = _input_int("receiver id: ")
@@ -218,7 +240,31 @@ def overall_report_interactive():
     pause()
 
 
+def export_reports_interactive():
+    kind = input("reports (all/students/teachers/overall) [all]: ").strip() or "all"
+    fmt = input("format (jsonl/csv/text) [jsonl]: ").strip() or "jsonl"
+    out = input("output file: ").strip()
+    n = export_all_reports(out, format=fmt, kind=kind, db_path=DB_DEFAULT)
+    print(n, "reports written to", out)
+    pause()
+
+
+def _print_batch_result(res):
+    print(f"{res['reports']} student reports written to {res['output']} "
+          f"in {res['seconds']}s ({res['reports_per_second']} reports/s)")
+
+
+def export_student_reports_interactive():
+    fmt = input("format (json/text) [json]: ").strip() or "json"
+    out = input("output directory, or a .zip file for one archive: ").strip()
+    res = export_student_reports(out, format=fmt, db_path=DB_DEFAULT, archive=out.lower().endswith(".zip"))
+    _print_batch_result(res)
+    pause()
+
+
 def main():
+    # fills in file metadata in the background after uploads
+    start_worker(DB_DEFAULT)
     while True:
         try:
             print("\n=== Project Interactive Menu ===")
@@ -239,6 +285,10 @@ def main():
             print("15) teacher report (text)")
             print("16) student report (text)")
             print("17) overall report (text)")
+            print("18) import users from csv/jsonl")
+            print("19) upload storage stats (dedup, metadata queue)")
+            print("20) export reports (jsonl/csv/text)")
+            print("21) export every student report (one file each or a zip)")
             print("0) exit")
             choice = input("choose: ").strip()
             if choice == "1":
@@ -275,6 +325,14 @@ def main():
                 student_report_interactive()
             elif choice == "17":
                 overall_report_interactive()
+            elif choice == "18":
+                import_users_interactive()
+            elif choice == "19":
+                show_upload_stats()
+            elif choice == "20":
+                export_reports_interactive()
+            elif choice == "21":
+                export_student_reports_interactive()
             elif choice == "0":
                 print("bye")
                 break
@@ -286,5 +344,52 @@ def main():
             pause()
 
 
-if __name__ == "__main__":
+def cli(argv=None):
+    """non interactive commands, the menu is shown when none is given"""
+    parser = argparse.ArgumentParser(description="thesis management system")
+    sub = parser.add_subparsers(dest="command")
+    imp = sub.add_parser("import-users", help="bulk import users from a csv or jsonl file")
+    imp.add_argument("path")
+    imp.add_argument("--workers", type=int, default=None, help="hashing processes (default: all cores)")
+    exp = sub.add_parser("export-reports", help="stream reports to a file as jsonl, csv or text")
+    exp.add_argument("out", help="output file, - for stdout")
+    exp.add_argument("--kind", choices=["all", "students", "teachers", "overall"], default="all")
+    exp.add_argument("--format", choices=["jsonl", "csv", "text"], default="jsonl")
+    bat = sub.add_parser("export-student-reports", help="write every student report into a directory or a zip archive")
+    bat.add_argument("out", help="output directory (or archive path with --archive)")
+    bat.add_argument("--format", choices=["json", "text"], default="json")
+    bat.add_argument("--archive", action="store_true", help="write one compressed zip file instead of a directory")
+    bat.add_argument("--workers", type=int, default=None, help="writer processes (default: all cores)")
+    jur = sub.add_parser("assign-juries", help="record a batch of defenses with automatically chosen juries")
+    jur.add_argument("path", help="csv or jsonl file: student_id, date[, committee_size, notes]")
+    jur.add_argument("--size", type=int, default=3, help="committee size when a row gives none")
+    jur.add_argument("--dry-run", action="store_true", help="print the assignment without recording it")
+    args = parser.parse_args(argv)
+
+    if args.command == "import-users":
+        res = import_users(args.path, db_path=DB_DEFAULT, workers=args.workers)
+        _print_import_result(res)
+        return 1 if res["errors"] else 0
+    if args.command == "export-reports":
+        n = export_all_reports(args.out, format=args.format, kind=args.kind, db_path=DB_DEFAULT)
+        if args.out != "-":
+            print(n, "reports written to", args.out)
+        return 0
+    if args.command == "export-student-reports":
+        res = export_student_reports(args.out, format=args.format, db_path=DB_DEFAULT,
+                                     workers=args.workers, archive=args.archive)
+        _print_batch_result(res)
+        return 0
+    if args.command == "assign-juries":
+        records = assign_juries(read_pending(args.path), db_path=DB_DEFAULT,
+                                committee_size=args.size, dry_run=args.dry_run)
+        for r in records:
+            print(r["id"], r["student_id"], r["date"], [m["id"] for m in r["committee_members"]])
+        print(len(records), "defenses", "planned" if args.dry_run else "recorded")
+        return 0
     main()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(cli())
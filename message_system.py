@@ -1,134 +1,329 @@
+import bisect
 import datetime
+import re
 from pathlib import Path
-from database import load_db, save_db
+from database import transaction, read_db, insert_record, update_record, find_records, get_record, next_id, register_index, get_index, detached, mailbox_page
+from timestamps import to_epoch, record_ts
 
 MAX_MESSAGE_LENGTH = 20000
 
-def _next_messsage_id(db):
-    msgs = db.get("message") or []
-    if not msgs:
-        return 1
-    return max(m["id"] for m in msgs) + 1
-
-"""convert time input types to standard objects"""
-def _parse_iso(dt):
-    if dt is None:
-        return None
-    if isinstance(dt, datetime.datetime):
-        return dt
-    s = str(dt).rstrip("Z")
-    
-    try:
-       return datetime.datetime.fromisoformat(s)
-    except Exception:
-       try:
-           return datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S")
-       except Exception:
-           raise ValueError(f"Cannot parse datetime: {dt}")
+def _next_messsage_id(db_path, tx=None):
+    return next_id("messages", db_path, tx=tx)
+
+
+def _mailbox_key(m):
+    """sort key of a message inside a mailbox: (created_ts, id)"""
+    return (record_ts(m), m.get("id"))
+
+
+class MailboxIndex:
+    """
+    mailbox of every user in one loaded snapshot: user id -> (created_ts, id)
+    keys of the messages they sent or received, oldest first
+    built once per snapshot and kept up to date on every message change,
+    send_message only appends to the two mailboxes involved
+    """
+    collection = "messages"
+
+    def __init__(self, data):
+        self.by_id = {}
+        self.boxes = {}
+        for m in data.get("messages", []):
+            self.by_id[m.get("id")] = m
+            key = _mailbox_key(m)
+            for uid in self._owners(m):
+                self.boxes.setdefault(uid, []).append(key)
+        for box in self.boxes.values():
+            box.sort()
+
+    @staticmethod
+    def _owners(m):
+        return {m.get("sender_id"), m.get("receiver_id")}
+
+    def update(self, old, new):
+        if old is not None:
+            self.by_id.pop(old.get("id"), None)
+            key = _mailbox_key(old)
+            for uid in self._owners(old):
+                box = self.boxes.get(uid, [])
+                i = bisect.bisect_left(box, key)
+                if i < len(box) and box[i] == key:
+                    del box[i]
+        if new is not None:
+            self.by_id[new.get("id")] = new
+            key = _mailbox_key(new)
+            for uid in self._owners(new):
+                bisect.insort(self.boxes.setdefault(uid, []), key)
+
+    def newest_first(self, user_id):
+        for key in reversed(self.boxes.get(user_id, ())):
+            yield self.by_id[key[1]]
+
+    def page(self, user_id, page_size, before=None, after=None):
+        """(messages newest first, has older, has newer)"""
+        box = self.boxes.get(user_id, [])
+        if before is not None:
+            end = bisect.bisect_left(box, _mailbox_key(self._cursor(before)))
+            start = max(0, end - page_size)
+        elif after is not None:
+            start = bisect.bisect_right(box, _mailbox_key(self._cursor(after)))
+            end = min(len(box), start + page_size)
+        else:
+            end = len(box)
+            start = max(0, end - page_size)
+        msgs = [self.by_id[key[1]] for key in reversed(box[start:end])]
+        return msgs, start > 0, end < len(box)
+
+    def _cursor(self, message_id):
+        m = self.by_id.get(message_id)
+        if m is None:
+            raise ValueError(f"message with id {message_id} not found")
+        return m
+
+register_index("mailbox", MailboxIndex)
+
+
+_TOKEN_RE = re.compile(r"\w+")
+# arabic letters that persian keyboards also produce, folded to the persian form
+_FOLD = str.maketrans({"\u064a": "\u06cc", "\u0649": "\u06cc", "\u0643": "\u06a9", "\u0629": "\u0647"})
+
+def _tokens(text):
+    """casefolded unicode words of a text (\\w covers persian letters too)"""
+    if not isinstance(text, str):
+        return []
+    return _TOKEN_RE.findall(text.casefold().translate(_FOLD))
+
+
+class MessageTextIndex:
+    """
+    inverted index of message texts: token -> set of message ids
+    'vocab' is the sorted list of known tokens so a search term can match
+    every token it is a prefix of ("thes" finds "thesis")
+    """
+    collection = "messages"
+
+    def __init__(self, data):
+        self.by_id = {}
+        self.postings = {}
+        for m in data.get("messages", []):
+            self._add(m)
+        self.vocab = sorted(self.postings)
+
+    def _add(self, m):
+        self.by_id[m.get("id")] = m
+        new_tokens = []
+        for tok in set(_tokens(m.get("text"))):
+            ids = self.postings.get(tok)
+            if ids is None:
+                ids = self.postings[tok] = set()
+                new_tokens.append(tok)
+            ids.add(m.get("id"))
+        return new_tokens
+
+    def update(self, old, new):
+        if old is not None:
+            self.by_id.pop(old.get("id"), None)
+            for tok in set(_tokens(old.get("text"))):
+                ids = self.postings.get(tok)
+                if ids is not None:
+                    ids.discard(old.get("id"))
+                    # empty postings stay in vocab, they just match nothing
+        if new is not None:
+            for tok in self._add(new):
+                bisect.insort(self.vocab, tok)
+
+    def _term_ids(self, term):
+        i = bisect.bisect_left(self.vocab, term)
+        ids = set()
+        while i < len(self.vocab) and self.vocab[i].startswith(term):
+            ids |= self.postings[self.vocab[i]]
+            i += 1
+        return ids
+
+    def search(self, terms):
+        """ids of the messages containing every term (smallest postings first)"""
+        if not terms:
+            return set()
+        sets = sorted((self._term_ids(t) for t in set(terms)), key=len)
+        result = sets[0]
+        for s in sets[1:]:
+            if not result:
+                break
+            result = result & s
+        return result
+
+register_index("message_text", MessageTextIndex)
+
+def _text_matches(terms, text):
+    """scan version of MessageTextIndex.search for a single text"""
+    if not isinstance(text, str):
+        return False
+    folded = text.casefold().translate(_FOLD)
+    if not all(t in folded for t in terms):
+        return False
+    words = _TOKEN_RE.findall(folded)
+    return all(any(w.startswith(t) for w in words) for t in terms)
          
            
-def send_message(sender_id, receiver_id, text, db_path="db.json"):
+def send_message(sender_id, receiver_id, text, db_path="db.json", tx=None):
     if not isinstance(text, str) or not text.strip():
         raise ValueError("text should be string and non-empty")
     if len(text) > MAX_MESSAGE_LENGTH:
         raise ValueError(f"its too long max character is {MAX_MESSAGE_LENGTH}")
         
-    db = load_db(db_path)
-    db.setdefault("messages" , [])    
-    
     from user_manager import get_user_by_id
-    sender = get_user_by_id(sender_id , db_path)
-    receiver = get_user_by_id(receiver_id , db_path)
+    with transaction(db_path, tx) as tx:
+        sender = get_user_by_id(sender_id , db_path, tx=tx)
+        receiver = get_user_by_id(receiver_id , db_path, tx=tx)
     
-    if not sender:
-        raise ValueError("sender with id {sender_id} not found")
-    if not receiver:
-        raise ValueError("receiver with id {receiver_id} not found")   
-    if not sender.get("is_active" , True):
-        raise ValueError("sender with id {sender_id} isnt active")
-    if not receiver.get("is_active" , True):
-        raise ValueError("receiver with id {receiver_id} isnt active")
-        """now in world clock"""
-    new_id = _next_messsage_id(db)
-    now = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        if not sender:
+            raise ValueError("sender with id {sender_id} not found")
+        if not receiver:
+            raise ValueError("receiver with id {receiver_id} not found")   
+        if not sender.get("is_active" , True):
+            raise ValueError("sender with id {sender_id} isnt active")
+        if not receiver.get("is_active" , True):
+            raise ValueError("receiver with id {receiver_id} isnt active")
+            """now in world clock"""
+        new_id = _next_messsage_id(db_path, tx)
+        now_dt = datetime.datetime.utcnow().replace(microsecond=0)
     
-    record = {
-        "id": new_id,
-        "sender_id": sender_id,
-        "receiver_id": receiver_id,
-        "text": text,
-        "created_at": now,
-        "is_read": False,
-        "read_at": None
-    }
-    db["message"].append(record)
-    save_db(db , db_path)
+        record = {
+            "id": new_id,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "text": text,
+            "created_at": now_dt.isoformat() + "Z",
+            "created_ts": to_epoch(now_dt),
+            "is_read": False,
+            "read_at": None,
+            "read_ts": None
+        }
+        insert_record("messages", record, db_path, tx=tx)
     return record
 
-def list_messages(user_id = None , db_path = "db.json" , limit = None , since = None):
+def list_messages(user_id = None , db_path = "db.json" , limit = None , since = None, tx=None):
     
-    db = load_db(db_path)
-    msgs = db("messages" , [])
-    since_dt = _parse_iso(since) if since else None
+    idx = get_index("mailbox", db_path, tx) if user_id is not None else None
+    if idx is not None:
+        # mailbox is already ordered, stop as soon as we have enough
+        since_ts = to_epoch(since) if since else None
+        results = []
+        for m in idx.newest_first(user_id):
+            if limit is not None and len(results) >= limit:
+                break
+            if since_ts is not None and record_ts(m) <= since_ts:
+                break
+            results.append(m)
+        return detached(results, db_path, tx)
+
+    if user_id is not None:
+        sent = find_records("messages", db_path, tx=tx, sender_id=user_id)
+        received = [m for m in find_records("messages", db_path, tx=tx, receiver_id=user_id)
+                    if m.get("sender_id") != user_id]
+        msgs = sent + received
+    else:
+        msgs = read_db(db_path, tx).get("messages" , [])
+    since_ts = to_epoch(since) if since else None
     
     results = []
     for m in msgs:
-        if user_id is not None:
-            if not (m.get("sender_id") == user_id or m.get("receiver_id") == user_id):
-                continue
-        if since_dt is not None:
-            m_dt = _parse_iso(m.get("craeted_at"))
-            if m_dt is None or m_dt <= since_dt:
-                continue
+        if since_ts is not None and record_ts(m) <= since_ts:
+            continue
         results.append(m)
             
-    results.sort(key=lambda x: _parse_iso(m.get("created_at")) or datetime.datetime.min , reverse = True)
+    results.sort(key=_mailbox_key, reverse = True)
     if limit is not None:
-        return results[:limit]  
-    return results     
+        results = results[:limit]
+    return detached(results, db_path, tx)
 
-def search_message(query , db_path = "db.json" , sender_id = None , receiver_id = None , since = None , until = None):
+def list_messages_page(user_id, db_path="db.json", page_size=20, before=None, after=None, tx=None):
+    """
+    one page of a user's mailbox, newest first, in O(page) time
+    before / after are message ids used as cursors: the page holds the
+    messages just older than 'before' or just newer than 'after'
+    returns {"messages": [...], "older": cursor, "newer": cursor}, a cursor
+    is None when there is nothing more in that direction
+    """
+    if page_size < 1:
+        raise ValueError("page_size must be >= 1")
+    if before is not None and after is not None:
+        raise ValueError("use either before or after, not both")
+
+    idx = get_index("mailbox", db_path, tx)
+    if idx is not None:
+        msgs, has_older, has_newer = idx.page(user_id, page_size, before=before, after=after)
+        msgs = detached(msgs, db_path, tx)
+    else:
+        cursor_id = before if before is not None else after
+        cursor_key = None
+        if cursor_id is not None:
+            cursor = get_record("messages", cursor_id, db_path, tx=tx)
+            if cursor is None:
+                raise ValueError(f"message with id {cursor_id} not found")
+            cursor_key = (cursor.get("created_at"), cursor.get("id"))
+        msgs, has_older, has_newer = mailbox_page(
+            user_id, page_size,
+            before=cursor_key if before is not None else None,
+            after=cursor_key if after is not None else None, file_path=db_path)
+    return {
+        "messages": msgs,
+        "older": msgs[-1]["id"] if msgs and has_older else None,
+        "newer": msgs[0]["id"] if msgs and has_newer else None
+    }
+
+def search_message(query , db_path = "db.json" , sender_id = None , receiver_id = None , since = None , until = None, tx=None):
     
+    """
+    messages containing every word of the query (casefolded, each word may be
+    the beginning of a longer word), newest first
+    """
     if not isinstance(query, str) or not query.strip():
         raise ValueError("search should be non-empty string")
             
-        
-        """ casefold for convert lowercase"""
-    q = query.strip().casefold()  
-    since_dt = _parse_iso(since) if since else None
-    until_dt = _parse_iso(until) if until else None
-    db = load_db(db_path)
+    terms = _tokens(query)
+    if not terms:
+        return []
+    since_ts = to_epoch(since) if since else None
+    until_ts = to_epoch(until) if until else None
+    filters = {}
+    if sender_id is not None:
+        filters["sender_id"] = sender_id
+    if receiver_id is not None:
+        filters["receiver_id"] = receiver_id
+
+    idx = get_index("message_text", db_path, tx)
+    if idx is not None:
+        candidates = [idx.by_id[i] for i in idx.search(terms)]
+        candidates = [m for m in candidates if all(m.get(k) == v for k, v in filters.items())]
+    else:
+        candidates = [m for m in find_records("messages", db_path, tx=tx, **filters)
+                      if _text_matches(terms, m.get("text"))]
+
     results = []
-            
-    for m in db.get("message" , []):
-        if sender_id is not None and m.get("sender_id") != sender_id:
+    for m in candidates:
+        m_ts = record_ts(m)
+        if since_ts is not None and m_ts <= since_ts:
             continue
-        if receiver_id is not None and m.get("receiver_id") != receiver_id:
-            continue    
-            
-        m_dt = _parse_iso(m.get("created_at"))  
-        if since_dt and (m_dt is None or m_dt <= since_dt):
+        if until_ts is not None and m_ts >= until_ts:
             continue
-        if until_dt and (m_dt is None or m_dt >= until_dt):
-          continue 
-      
-        text = (m.get("text") or "").casefold()
-        if q in text:
-            results.append(m)
+        results.append(m)
         
-        results.sort(key= lambda x: _parse_iso(x.get("created_at")) or datetime.datetime.min , reverse=True)
-        return results
+    results.sort(key=_mailbox_key, reverse=True)
+    return detached(results, db_path, tx)
         
-def mark_message_read(message_id , db_path = "db.json"):
-    db = load_db(db_path)
-    for m in db.get("message" , []):
-        if m.get("id") == message_id:
-            if not m.get("is_read" , False): 
-                m["is_read"] = True
-                m["read_at"] =  datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-                save_db(db , db_path)
-            return True
+def mark_message_read(message_id , db_path = "db.json", tx=None):
+    m = get_record("messages", message_id, db_path, tx=tx)
+    if m is None:
         return False
+    if not m.get("is_read" , False): 
+        now_dt = datetime.datetime.utcnow().replace(microsecond=0)
+        update_record("messages", message_id, {
+            "is_read": True,
+            "read_at": now_dt.isoformat() + "Z",
+            "read_ts": to_epoch(now_dt)
+        }, db_path, tx=tx)
+    return True
 """this function didnt delete message just throw error"""
 def delete_message_attempt(message_id, db_path="db.json"):     
     raise PermissionError("Messages are non-deletable in this system.")
\ No newline at end of file
@@ -1,33 +1,58 @@
+import copy
+import csv
 import datetime
+import io
 import json
-from database import load_db
+import os
+import sys
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from database import read_db, transaction, add_commit_listener, db_version, _storage_path
 
 def _now_iso():
     return datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
-def generate_teacher_report(teacher_id, db_path="db.json"):
-    db = load_db(db_path)
-    from user_manager import get_user_by_id
-    
-    teacher = get_user_by_id(teacher_id , db_path)
-    if not teacher or teacher.get("role") != "teacher":
-        raise ValueError("teacher not found")
-        
-    users = db.get("users" , [])
-    defenses = db.get("defenses" , [])
-    advisees = [u for u in users if u.get("role") == "student" 
-                and u.get("advisor_id") == teacher_id]
-    
-    jury_assignments = []
-    
-    for d in defenses:
-        for m in d.get("committee_members" , []):
-            jury_assignments.append({"defense_id" : d.get("id"),
-                             "student_id" : d.get("student_id"),
-                             "date" : d.get("date"),
-                             "final_score" : d.get("final_score")})
-    """defenses list for students"""
-    supervised_defenses = [d for d in defenses if any(u.get("id") == d.get("student_id") and u.get("advisor_id") == teacher_id for u in users)]
+def _teacher_reports(db, teachers):
+    """
+    reports of the given teacher records from one pass over users and one
+    over defenses (hash joins: student -> advisor, committee member -> teacher)
+    """
+    wanted = {t["id"]: t for t in teachers}
+    advisees = {tid: [] for tid in wanted}
+    advisor_of = {}
+    for u in db.get("users", []):
+        aid = u.get("advisor_id")
+        if aid is None:
+            continue
+        advisor_of[u.get("id")] = aid
+        if aid in advisees and u.get("role") == "student":
+            advisees[aid].append(u)
+
+    jury = {tid: [] for tid in wanted}
+    supervised = {tid: [] for tid in wanted}
+    for d in db.get("defenses", []):
+        entry = None
+        for m in d.get("committee_members") or []:
+            tid = m.get("id")
+            if m.get("role") == "teacher" and tid in jury:
+                if entry is None:
+                    entry = {"defense_id": d.get("id"),
+                             "student_id": d.get("student_id"),
+                             "date": d.get("date"),
+                             "final_score": d.get("final_score")}
+                jury[tid].append(entry)
+        aid = advisor_of.get(d.get("student_id"))
+        if aid in supervised:
+            supervised[aid].append(d)
+
+    generated_at = _now_iso()
+    for tid, teacher in wanted.items():
+        yield _teacher_report(teacher, advisees[tid], jury[tid], supervised[tid], generated_at)
+
+def _teacher_report(teacher, advisees, jury_assignments, supervised_defenses, generated_at):
     """values of final score"""
     scores = [d.get("final_score") for d in supervised_defenses if isinstance(d.get("final_score"), (int, float))]
     """average of scores"""
@@ -40,7 +65,7 @@ def generate_teacher_report(teacher_id, db_path="db.json"):
     remaining = cap - used
     
     return {
-        "generated_at": _now_iso(),
+        "generated_at": generated_at,
         "type": "teacher_report",
         "teacher": {"id": teacher["id"], "name": teacher.get("name")},
         "advisee_capacity": cap,
@@ -56,107 +81,472 @@ def generate_teacher_report(teacher_id, db_path="db.json"):
         "supervised_avg_score": avg_score
     }
 
-def generate_student_report(student_id, db_path="db.json"):
-    db = load_db(db_path)
+"""report cache"""
+
+class ReportCache:
+    """
+    bounded lru of generated reports, keyed by (database, report type, subject id)
+    every entry remembers the database version it was built from and what
+    it depends on, (what, user id) pairs like ("jury", 3); a commit drops
+    only the entries depending on something it touched (see _touched), a
+    write by another process (the version moved without a commit of ours)
+    drops everything of that database
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # key -> (version, deps, report)
+        self._versions = {}  # database -> version the entries are valid for
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def _sync(self, db, version):
+        """forget the entries of db if it was written behind our back"""
+        if self._versions.get(db) != version:
+            self._drop(db, lambda key, deps: True)
+            self._versions[db] = version
+
+    def _drop(self, db, doomed):
+        for key in [k for k, (_, deps, _) in self._entries.items() if k[0] == db and doomed(k, deps)]:
+            del self._entries[key]
+            self.invalidations += 1
+
+    def get(self, db_path, kind, subject, build):
+        """the cached report, or build() -> (report, deps) stored and returned"""
+        db = _db_key(db_path)
+        key = (db, kind, subject)
+        version = db_version(db_path)
+        with self._lock:
+            self._sync(db, version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[2])
+            self.misses += 1
+        report, deps = build()
+        with self._lock:
+            # a write while we were building: the report may already be stale, don't keep it
+            if db_version(db_path) == version and self._versions.get(db) == version:
+                self._entries[key] = (version, frozenset(deps), copy.deepcopy(report))
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return report
+
+    def committed(self, db_path, changes, before):
+        """commit listener: drop the reports the changes can show up in"""
+        db = _db_key(db_path)
+        touched = set()
+        totals = False
+        for coll, old, new in changes:
+            touched |= _touched(coll, old, new)
+            totals = totals or coll in ("users", "defenses")
+        with self._lock:
+            self._sync(db, before)
+            self._drop(db, lambda key, deps: (totals and key[1] == "overall_report") or not deps.isdisjoint(touched))
+            # what is left was not affected by this commit: valid for the new version too
+            after = db_version(db_path)
+            for key, (version, deps, report) in self._entries.items():
+                if key[0] == db:
+                    self._entries[key] = (after, deps, report)
+            self._versions[db] = after
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations}
+
+
+def _db_key(db_path):
+    return os.path.abspath(_storage_path(db_path))
+
+def _touched(coll, old, new):
+    """
+    what a change of one record can alter:
+        ("user", id)       the user record itself
+        ("advisees", id)   who the teacher advises
+        ("defense", id)    the defense of the student
+        ("jury", id)       the defenses the teacher sits on
+        ("files", id)      the uploads of the user
+    the advisor of a student whose defense changed is not listed: teacher
+    reports depend on ("defense", s) of each of their advisees instead
+    """
+    touched = set()
+    for rec in (old, new):
+        if rec is None:
+            continue
+        if coll == "users":
+            touched.add(("user", rec.get("id")))
+            touched.add(("advisees", rec.get("advisor_id")))
+        elif coll == "defenses":
+            touched.add(("defense", rec.get("student_id")))
+            touched.update(("jury", m.get("id")) for m in rec.get("committee_members") or [])
+        elif coll == "files":
+            touched.add(("files", rec.get("uploader_id")))
+    return {t for t in touched if t[1] is not None}
+
+
+_CACHE = ReportCache(int(os.environ.get("THESIS_REPORT_CACHE_SIZE", "256")))
+add_commit_listener(_CACHE.committed)
+
+def report_cache_stats():
+    return _CACHE.stats()
+
+def clear_report_cache():
+    _CACHE.clear()
+
+
+def generate_teacher_report(teacher_id, db_path="db.json", tx=None):
+    """cached per database version unless called inside a transaction"""
+    if tx is None:
+        return _CACHE.get(db_path, "teacher_report", teacher_id, lambda: _build_teacher_report(teacher_id, db_path))
+    return _build_teacher_report(teacher_id, db_path, tx)[0]
+
+def _build_teacher_report(teacher_id, db_path="db.json", tx=None):
+    db = read_db(db_path, tx)
     from user_manager import get_user_by_id
-    student = get_user_by_id(student_id, db_path)
+    
+    teacher = get_user_by_id(teacher_id , db_path, tx=tx)
+    if not teacher or teacher.get("role") != "teacher":
+        raise ValueError("teacher not found")
+    report = next(_teacher_reports(db, [teacher]))
+    deps = {("user", teacher_id), ("advisees", teacher_id), ("jury", teacher_id)}
+    for s in report["advisees"]:
+        deps.update((("user", s["id"]), ("defense", s["id"])))
+    return report, deps
+
+def generate_all_teacher_reports(db_path="db.json", tx=None):
+    """
+    yield the report of every teacher (in id order), all of them built from
+    a single pass over users and defenses instead of one pass per teacher
+    """
+    db = read_db(db_path, tx)
+    teachers = sorted((u for u in db.get("users", []) if u.get("role") == "teacher"), key=lambda u: u.get("id"))
+    yield from _teacher_reports(db, teachers)
+
+def generate_student_report(student_id, db_path="db.json", tx=None):
+    """cached per database version unless called inside a transaction"""
+    if tx is None:
+        return _CACHE.get(db_path, "student_report", student_id, lambda: _build_student_report(student_id, db_path))
+    return _build_student_report(student_id, db_path, tx)[0]
+
+def _build_student_report(student_id, db_path="db.json", tx=None):
+    db = read_db(db_path, tx)
+    from user_manager import get_user_by_id
+    student = get_user_by_id(student_id, db_path, tx=tx)
 
     if not student or student.get("role") != "student":
         raise ValueError("student not found")
         
-        advisor = None
-        if student.get("advisor_id") is not None:
-            advisor = get_user_by_id(student.get("advisor_id"), db_path)
-        
-        defense_record = next((d for d in db.get("defenses", []) if d.get("student_id") == student_id), None)
-        student_files = [f for f in db.get("files", []) if f.get("uploader_id") == student_id]
+    report = next(_student_reports(db, [student]))
+    deps = {("user", student_id), ("defense", student_id), ("files", student_id)}
+    if report["advisor"] is not None:
+        deps.add(("user", report["advisor"]["id"]))
+    return report, deps
 
-        return {
-        "generated_at": _now_iso(),
-        "type": "student_report",
-        "student": {"id": student["id"], "name": student.get("name")},
-        "advisor": {"id": advisor.get("id"), "name": advisor.get("name")} if advisor else None,
-        "defense": defense_record,
-        "files": [{"id": f.get("id"), "original_name": f.get("original_name"), "file_type": f.get("file_type")} for f in student_files]
-    }
+def _student_reports(db, students):
+    """
+    reports of the given student records, advisors, defenses and files
+    looked up in maps built from one pass over each collection
+    """
+    wanted = {s["id"]: s for s in students}
+    advisor_ids = {s.get("advisor_id") for s in students} - {None}
+    advisors = {u.get("id"): u for u in db.get("users", []) if u.get("id") in advisor_ids}
+    defense_of = {}
+    for d in db.get("defenses", []):
+        sid = d.get("student_id")
+        if sid in wanted and sid not in defense_of:
+            defense_of[sid] = d
+    files_of = {sid: [] for sid in wanted}
+    for f in db.get("files", []):
+        if f.get("uploader_id") in files_of:
+            files_of[f["uploader_id"]].append(f)
 
-def generate_overall_report(db_path="db.json"):
-    db = load_db(db_path)
-    users = db.get("users", [])
-    defenses = db.get("defenses", [])
-    total_users = len(users)
-    total_teachers = sum(1 for u in users if u.get("role") == "teacher")
-    total_students = sum(1 for u in users if u.get("role") == "student")
-    total_defenses = len(defenses)
-    scores = [d.get("final_score") for d in defenses if isinstance(d.get("final_score"), (int, float))]
-    avg_score = (sum(scores) / len(scores)) if scores else None
-    
-    teacher_counts = {}
-    for d in defenses:
-        for m in d.get("committee_members"):
-            if m.get("role") == "teacher" and m.get("id") is not None:
-                teacher_counts[m["id"]] = teacher_counts.get(m["id"], 0) + 1
-    top_teachers = sorted(teacher_counts.items(), key=lambda x: x[1], reverse=True)[:10]
+    generated_at = _now_iso()
+    for sid, student in wanted.items():
+        advisor = advisors.get(student.get("advisor_id"))
+        yield {
+            "generated_at": generated_at,
+            "type": "student_report",
+            "student": {"id": student["id"], "name": student.get("name")},
+            "advisor": {"id": advisor.get("id"), "name": advisor.get("name")} if advisor else None,
+            "defense": defense_of.get(sid),
+            "files": [{"id": f.get("id"), "original_name": f.get("original_name"), "file_type": f.get("file_type")} for f in files_of[sid]]
+        }
+
+def generate_all_student_reports(db_path="db.json", tx=None):
+    """yield the report of every student (in id order) from one pass over each collection"""
+    db = read_db(db_path, tx)
+    students = sorted((u for u in db.get("users", []) if u.get("role") == "student"), key=lambda u: u.get("id"))
+    yield from _student_reports(db, students)
+
+def generate_overall_report(db_path="db.json", tx=None):
+    """built from the running totals in the database header (aggregates.py), no scan"""
+    if tx is None:
+        return _CACHE.get(db_path, "overall_report", None, lambda: (_build_overall_report(db_path), ()))
+    return _build_overall_report(db_path, tx)
+
+def _build_overall_report(db_path="db.json", tx=None):
+    import aggregates
+    agg = aggregates.ensure(db_path, tx)
+    by_role = agg["users_by_role"]
+    score_count = agg["score_count"]
+    avg_score = (agg["score_sum"] / score_count) if score_count else None
     
     return {
         "generated_at": _now_iso(),
         "type": "overall_report",
-        "total_users": total_users,
-        "total_teachers": total_teachers,
-        "total_students": total_students,
-        "total_defenses": total_defenses,
+        "total_users": sum(by_role.values()),
+        "total_teachers": by_role.get("teacher", 0),
+        "total_students": by_role.get("student", 0),
+        "total_defenses": agg["defense_count"],
         "average_defense_score": avg_score,
-        "top_teachers_by_jury_assignments": [{"teacher_id": t, "assignments": c} for t, c in top_teachers]
+        "top_teachers_by_jury_assignments": [{"teacher_id": t, "assignments": c} for t, c in agg["jury_top"]]
     }
 """convert dictionary report to string"""
 def report_to_text(report):
-    t = []
+    return "\n".join(iter_report_text(report))
+
+def iter_report_text(report):
+    """the lines of report_to_text one at a time"""
     typ = report.get("type" , "report")
-    t.append(f"report typ: {typ}")
-    t.append(f"generated at: {report.get('generated_at')}")
+    yield f"report typ: {typ}"
+    yield f"generated at: {report.get('generated_at')}"
     
     if typ == "teacher_report":
-        t.append(f"teacher: {report['teacher']['name']} id: {report['teacher']['id']}")
-        t.append(f"Advisees: {report.get('advisees_count')} (remaining: {report.get('advisees_remaining')})")
+        yield f"teacher: {report['teacher']['name']} id: {report['teacher']['id']}"
+        yield f"Advisees: {report.get('advisees_count')} (remaining: {report.get('advisees_remaining')})"
        
         for s in report.get("advisees", []):
-            t.append(f" - {s.get('id')}: {s.get('name')} (defense_date: {s.get('defense_date')})")
+            yield f" - {s.get('id')}: {s.get('name')} (defense_date: {s.get('defense_date')})"
 
-        t.append(f"Jury assignments: {report.get('jury_assignments_count')}")
+        yield f"Jury assignments: {report.get('jury_assignments_count')}"
         for j in report.get("jury_assignments", []):
-            t.append(f" - defense {j.get('defense_id')} student {j.get('student_id')} date {j.get('date')} score {j.get('final_score')}")
-        t.append(f"Supervised defenses: {report.get('supervised_defenses_count')}")
-        t.append(f"Supervised average score: {report.get('supervised_avg_score')}")
+            yield f" - defense {j.get('defense_id')} student {j.get('student_id')} date {j.get('date')} score {j.get('final_score')}"
+        yield f"Supervised defenses: {report.get('supervised_defenses_count')}"
+        yield f"Supervised average score: {report.get('supervised_avg_score')}"
     elif typ == "student_report":
         st = report.get("student", {})
-        t.append(f"Student: {st.get('name')} (id: {st.get('id')})")
+        yield f"Student: {st.get('name')} (id: {st.get('id')})"
         adv = report.get("advisor")
         if adv:
-            t.append(f"Advisor: {adv.get('name')} (id: {adv.get('id')})")
+            yield f"Advisor: {adv.get('name')} (id: {adv.get('id')})"
         if report.get("defense"):
             d = report.get("defense")
-            t.append(f"Defense id: {d.get('id')} date: {d.get('date')} final_score: {d.get('final_score')}")
+            yield f"Defense id: {d.get('id')} date: {d.get('date')} final_score: {d.get('final_score')}"
         else:
-            t.append("No defense recorded.")
-        t.append("Files:")
+            yield "No defense recorded."
+        yield "Files:"
         for f in report.get("files", []):
-            t.append(f" - {f.get('id')} {f.get('original_name')} ({f.get('file_type')})")
+            yield f" - {f.get('id')} {f.get('original_name')} ({f.get('file_type')})"
     else:
-        t.append(json.dumps(report, ensure_ascii=False, indent=2))
-    return "\n".join(t)
+        yield from json.dumps(report, ensure_ascii=False, indent=2).splitlines()
+
+
+"""streaming export"""
+
+# one csv row per report: scalar fields, lists as ';' separated ids
+CSV_COLUMNS = {
+    "teacher_report": ["teacher_id", "teacher_name", "advisee_capacity", "advisees_count", "advisees_remaining",
+                       "advisee_ids", "jury_assignments_count", "jury_defense_ids",
+                       "supervised_defenses_count", "supervised_avg_score"],
+    "student_report": ["student_id", "student_name", "advisor_id", "advisor_name", "defense_id",
+                       "defense_date", "final_score", "file_ids"],
+    "overall_report": ["total_users", "total_teachers", "total_students", "total_defenses",
+                       "average_defense_score", "top_teacher_ids"],
+}
+REPORT_TYPES = {"all": ["overall_report", "teacher_report", "student_report"], "students": ["student_report"],
+                "teachers": ["teacher_report"], "overall": ["overall_report"]}
+EXPORT_FORMATS = ("json", "jsonl", "csv", "text")
+TEXT_CHUNK_LINES = 1000
+
+def _ids(items, key="id"):
+    return ";".join(str(i.get(key)) for i in items)
+
+def csv_row(report):
+    """the flat csv row of a report"""
+    typ = report.get("type")
+    row = {"type": typ, "generated_at": report.get("generated_at")}
+    if typ == "teacher_report":
+        row.update(teacher_id=report["teacher"]["id"], teacher_name=report["teacher"].get("name"),
+                   advisee_ids=_ids(report.get("advisees", [])),
+                   jury_defense_ids=_ids(report.get("jury_assignments", []), "defense_id"))
+    elif typ == "student_report":
+        adv = report.get("advisor") or {}
+        d = report.get("defense") or {}
+        row.update(student_id=report["student"]["id"], student_name=report["student"].get("name"),
+                   advisor_id=adv.get("id"), advisor_name=adv.get("name"), defense_id=d.get("id"),
+                   defense_date=d.get("date"), final_score=d.get("final_score"),
+                   file_ids=_ids(report.get("files", [])))
+    elif typ == "overall_report":
+        row["top_teacher_ids"] = _ids(report.get("top_teachers_by_jury_assignments", []), "teacher_id")
+    for col in CSV_COLUMNS.get(typ, []):
+        if col not in row:
+            row[col] = report.get(col)
+    return row
+
+def csv_header(types):
+    """columns of a csv holding reports of the given types"""
+    header = ["type", "generated_at"]
+    for typ in types:
+        header += [c for c in CSV_COLUMNS[typ] if c not in header]
+    return header
+
+def write_reports(reports, out, format="jsonl", types=None):
+    """
+    write reports to an open text file as they come out of the iterable
+    (a generator keeps memory flat however many reports there are)
+        jsonl  one compact json document per line
+        csv    one row per report, see CSV_COLUMNS; types picks the columns,
+               by default those of the first report
+        text   report_to_text of each report, blank line in between, written
+               TEXT_CHUNK_LINES lines at a time
+    returns the number of reports written
+    """
+    fmt = format.lower()
+    if fmt not in ("jsonl", "csv", "text"):
+        raise ValueError("unsupported streaming format, use 'jsonl', 'csv' or 'text'")
+    count = 0
+    writer = None
+    for report in reports:
+        if fmt == "jsonl":
+            out.write(json.dumps(report, ensure_ascii=False, separators=(",", ":")))
+            out.write("\n")
+        elif fmt == "csv":
+            if writer is None:
+                header = csv_header(types or [report.get("type")])
+                writer = csv.DictWriter(out, fieldnames=header, extrasaction="ignore")
+                writer.writeheader()
+            writer.writerow(csv_row(report))
+        else:
+            if count:
+                out.write("\n")
+            chunk = []
+            for line in iter_report_text(report):
+                chunk.append(line)
+                if len(chunk) >= TEXT_CHUNK_LINES:
+                    out.write("\n".join(chunk) + "\n")
+                    chunk = []
+            if chunk:
+                out.write("\n".join(chunk) + "\n")
+        count += 1
+    return count
+
+def iter_reports(kind="all", db_path="db.json", tx=None):
+    """
+    reports to export: "students", "teachers", "overall" or "all" (the
+    overall report, then every teacher, then every student)
+    """
+    if kind not in REPORT_TYPES:
+        raise ValueError("unknown report kind, use 'all', 'students', 'teachers' or 'overall'")
+    if kind in ("all", "overall"):
+        yield generate_overall_report(db_path, tx)
+    if kind in ("all", "teachers"):
+        yield from generate_all_teacher_reports(db_path, tx)
+    if kind in ("all", "students"):
+        yield from generate_all_student_reports(db_path, tx)
+
+def export_all_reports(out_path, format="jsonl", kind="all", db_path="db.json"):
+    """stream the reports of kind into out_path ('-' for stdout), returns how many were written"""
+    reports = iter_reports(kind, db_path)
+    if out_path == "-":
+        return write_reports(reports, sys.stdout, format, types=REPORT_TYPES[kind])
+    with open(out_path, "w", encoding="utf-8", newline="" if format == "csv" else None) as f:
+        return write_reports(reports, f, format, types=REPORT_TYPES[kind])
         
 def export_report(report, format="json", out_path=None):
     fmt = format.lower()
-    if fmt == "json":
-        s = json.dumps(report, ensure_ascii=False, indent=4)
-    elif fmt == "text":
-        s = report_to_text(report)
-    else:
-        raise ValueError("unsupported format, use 'json' or 'text'")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError("unsupported format, use 'json', 'jsonl', 'csv' or 'text'")
 
     if out_path:
-        with open(out_path, "w", encoding="utf-8") as f:
-            f.write(s)
+        with open(out_path, "w", encoding="utf-8", newline="" if fmt == "csv" else None) as f:
+            if fmt == "json":
+                # json.dump writes the encoder's chunks as they are produced
+                json.dump(report, f, ensure_ascii=False, indent=4)
+            else:
+                write_reports([report], f, fmt)
         return out_path
-    return s
-        
\ No newline at end of file
+    if fmt == "json":
+        return json.dumps(report, ensure_ascii=False, indent=4)
+    if fmt == "text":
+        return report_to_text(report)
+    buf = io.StringIO()
+    write_reports([report], buf, fmt)
+    return buf.getvalue()
+
+
+"""batch export"""
+
+BATCH_FORMATS = {"json": ".json", "text": ".txt"}
+
+def _render(report, fmt):
+    if fmt == "json":
+        return json.dumps(report, ensure_ascii=False, indent=4)
+    return report_to_text(report)
+
+def _student_file_name(report, fmt):
+    return f"student_{report['student']['id']}{BATCH_FORMATS[fmt]}"
+
+def _write_batch(reports, fmt, out_dir):
+    """worker: one file per report in out_dir"""
+    for report in reports:
+        with open(os.path.join(out_dir, _student_file_name(report, fmt)), "w", encoding="utf-8") as f:
+            f.write(_render(report, fmt))
+    return len(reports)
+
+def _render_batch(reports, fmt):
+    """worker: [(archive member name, encoded report)]"""
+    return [(_student_file_name(r, fmt), _render(r, fmt).encode("utf-8")) for r in reports]
+
+def export_student_reports(out, format="json", db_path="db.json", workers=None, archive=False, batch_size=500):
+    """
+    write the report of every student, one file each (student_<id>.json or
+    .txt) in the directory out, or all of them in the zip archive out when
+    archive is true
+    the reports come from one snapshot taken under the database lock, with
+    the advisor, defense and file maps built once (_student_reports);
+    rendering and writing run on a process pool (all cores by default,
+    workers=1 stays in this process)
+    returns {"reports", "seconds", "reports_per_second", "output"}
+    """
+    fmt = format.lower()
+    if fmt not in BATCH_FORMATS:
+        raise ValueError("unsupported format, use 'json' or 'text'")
+    started = time.perf_counter()
+    with transaction(db_path) as tx:
+        db = read_db(db_path, tx)
+        students = sorted((u for u in db.get("users", []) if u.get("role") == "student"), key=lambda u: u.get("id"))
+        # reports point into the live records, copy them before the lock is released
+        reports = copy.deepcopy(list(_student_reports(db, students)))
+    batches = [reports[i:i + batch_size] for i in range(0, len(reports), batch_size)]
+
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(batches) > 1 else None
+    run = pool.map if pool is not None else map
+    try:
+        if archive:
+            parent = os.path.dirname(os.path.abspath(out))
+            os.makedirs(parent, exist_ok=True)
+            with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                for members in run(_render_batch, batches, [fmt] * len(batches)):
+                    for name, data in members:
+                        zf.writestr(name, data)
+        else:
+            os.makedirs(out, exist_ok=True)
+            for _ in run(_write_batch, batches, [fmt] * len(batches), [out] * len(batches)):
+                pass
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    seconds = time.perf_counter() - started
+    return {"reports": len(reports), "seconds": round(seconds, 3),
+            "reports_per_second": round(len(reports) / seconds, 1) if seconds else None, "output": out}
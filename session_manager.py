@@ -0,0 +1,190 @@
+"""
+sessions: one password check, then a signed token for every later call
+
+token = base64url(payload) "." base64url(hmac-sha256(payload))
+the payload holds the user id, the expiry time and a fingerprint of the
+password salt, so changing the password ends the user's sessions
+validating a token is an hmac plus a lookup in the cached user index,
+no pbkdf2 and no disk write
+
+last_login is not written on every login, logins are buffered and
+written together: after FLUSH_EVERY logins, by a timer at most
+FLUSH_INTERVAL seconds after the first buffered one, on flush() and at exit
+"""
+import atexit
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+from database import transaction, update_record, _storage_path
+from user_manager import authenticate_user, get_user_by_id
+
+SESSION_TTL = 8 * 3600
+FLUSH_EVERY = 100
+FLUSH_INTERVAL = 30
+SECRET_SUFFIX = ".session_key"
+
+
+def _b64(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _fingerprint(user):
+    return hashlib.sha256((user.get("password_salt") or "").encode("ascii")).hexdigest()[:16]
+
+def load_secret(db_path="db.json"):
+    """
+    signing key of a database: THESIS_SESSION_SECRET if set, otherwise a
+    random key kept in <db file>.session_key (created on first use)
+    """
+    env = os.environ.get("THESIS_SESSION_SECRET")
+    if env:
+        return env.encode("utf-8")
+    key_path = _storage_path(db_path) + SECRET_SUFFIX
+    try:
+        with open(key_path, "rb") as f:
+            return bytes.fromhex(f.read().decode("ascii").strip())
+    except FileNotFoundError:
+        pass
+    key = secrets.token_bytes(32)
+    try:
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # another process created it first, use that one
+        return load_secret(db_path)
+    with os.fdopen(fd, "w") as f:
+        f.write(key.hex())
+    return key
+
+
+class SessionManager:
+
+    def __init__(self, db_path="db.json", secret=None, ttl=SESSION_TTL,
+                 flush_every=FLUSH_EVERY, flush_interval=FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.secret = secret if secret is not None else load_secret(db_path)
+        self.ttl = ttl
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._last_flush = time.monotonic()
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def issue(self, user):
+        """token for an already authenticated user record"""
+        payload = json.dumps({"uid": user["id"], "exp": int(time.time()) + self.ttl,
+                              "pw": _fingerprint(user)}, separators=(",", ":")).encode("utf-8")
+        return _b64(payload) + "." + _b64(self._sign(payload))
+
+    def login(self, identifier, password):
+        """check the password once, returns (token, user) or None"""
+        user = authenticate_user(identifier, password, self.db_path, record_login=False)
+        if user is None:
+            return None
+        self._record_login(user["id"])
+        return self.issue(user), user
+
+    def validate(self, token):
+        """user record of a valid, unexpired token, else None"""
+        if not isinstance(token, str) or token.count(".") != 1:
+            return None
+        body, sig = token.split(".")
+        try:
+            payload = _unb64(body)
+            given = _unb64(sig)
+        except (ValueError, TypeError):
+            return None
+        if not hmac.compare_digest(given, self._sign(payload)):
+            return None
+        claims = json.loads(payload)
+        if claims.get("exp", 0) < time.time():
+            return None
+        user = get_user_by_id(claims.get("uid"), self.db_path)
+        if not user or not user.get("is_active", True) or claims.get("pw") != _fingerprint(user):
+            return None
+        return user
+
+    def _record_login(self, user_id):
+        now = datetime.datetime.utcnow().isoformat() + "Z"
+        with self._lock:
+            self._pending[user_id] = now
+            due = (len(self._pending) >= self.flush_every
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+            if not due and self._timer is None:
+                # nothing else may come: write this one within flush_interval anyway
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer.start()
+        if due:
+            self.flush()
+
+    def _timed_flush(self):
+        try:
+            self.flush()
+        except Exception:
+            # the logins stay buffered for the next flush
+            pass
+
+    def flush(self):
+        """write buffered last_login values in one transaction, returns how many"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not pending:
+            return 0
+        try:
+            with transaction(self.db_path) as tx:
+                for uid, when in pending.items():
+                    if tx.get("users", uid) is not None:
+                        update_record("users", uid, {"last_login": when}, self.db_path, tx=tx)
+        except Exception:
+            with self._lock:
+                # put them back, newer logins of the same users win
+                self._pending = {**pending, **self._pending}
+            raise
+        return len(pending)
+
+
+_MANAGERS = {}
+_MANAGERS_LOCK = threading.Lock()
+
+def get_session_manager(db_path="db.json"):
+    """process wide session manager of a database"""
+    key = os.path.abspath(_storage_path(db_path))
+    with _MANAGERS_LOCK:
+        mgr = _MANAGERS.get(key)
+        if mgr is None:
+            mgr = _MANAGERS[key] = SessionManager(db_path)
+        return mgr
+
+def login(identifier, password, db_path="db.json"):
+    return get_session_manager(db_path).login(identifier, password)
+
+def validate_token(token, db_path="db.json"):
+    return get_session_manager(db_path).validate(token)
+
+def flush_logins(db_path="db.json"):
+    return get_session_manager(db_path).flush()
+
+@atexit.register
+def _flush_all():
+    for mgr in list(_MANAGERS.values()):
+        try:
+            mgr.flush()
+        except Exception:
+            pass
@@ -0,0 +1,320 @@
+"""
+sqlite storage for the same document layout as db.json
+every record is kept as json in the 'data' column, the fields we query on
+are copied into real columns so lookups use indexes instead of list scans
+"""
+import copy
+import json
+import sqlite3
+import threading
+
+import aggregates
+
+def _name_cf(r):
+    name = r.get("name")
+    return name.strip().casefold() if isinstance(name, str) else None
+
+# collection -> {column: extractor}
+COLUMNS = {
+    "users": {
+        "name_cf": _name_cf,
+        "role": lambda r: r.get("role"),
+        "advisor_id": lambda r: r.get("advisor_id"),
+    },
+    "messages": {
+        "sender_id": lambda r: r.get("sender_id"),
+        "receiver_id": lambda r: r.get("receiver_id"),
+        "created_at": lambda r: r.get("created_at"),
+    },
+    "defenses": {
+        "student_id": lambda r: r.get("student_id"),
+        "date": lambda r: r.get("date"),
+    },
+    "files": {
+        "uploader_id": lambda r: r.get("uploader_id"),
+        "file_type": lambda r: r.get("file_type"),
+    },
+    "blobs": {
+        "sha256": lambda r: r.get("sha256"),
+        "size_bytes": lambda r: r.get("size_bytes"),
+    },
+    "jobs": {
+        "status": lambda r: r.get("status"),
+    },
+}
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS users_name_cf ON users(name_cf)",
+    "CREATE INDEX IF NOT EXISTS users_advisor_id ON users(advisor_id)",
+    "CREATE INDEX IF NOT EXISTS users_role ON users(role)",
+    "CREATE INDEX IF NOT EXISTS messages_sender ON messages(sender_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS messages_receiver ON messages(receiver_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS messages_created_at ON messages(created_at)",
+    "CREATE INDEX IF NOT EXISTS defenses_student_id ON defenses(student_id)",
+    "CREATE INDEX IF NOT EXISTS files_uploader_id ON files(uploader_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS blobs_sha256 ON blobs(sha256)",
+    "CREATE INDEX IF NOT EXISTS blobs_size_bytes ON blobs(size_bytes)",
+    "CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)",
+]
+
+_CONNECTIONS = {}
+_LOCK = threading.RLock()
+# path -> [meta document, changed] while a write transaction is open: the
+# meta row is parsed once per transaction and written once at commit
+_META = {}
+
+
+def _create_table(conn, coll):
+    cols = "".join(f", {c}" for c in COLUMNS.get(coll, {}))
+    conn.execute(f'CREATE TABLE IF NOT EXISTS "{coll}" (id INTEGER PRIMARY KEY{cols}, data TEXT NOT NULL)')
+
+def _tables(conn):
+    rows = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'meta'")
+    return [r[0] for r in rows]
+
+def connect(path):
+    """return the (process wide) connection of a sqlite file, schema created on first use"""
+    with _LOCK:
+        conn = _CONNECTIONS.get(path)
+        if conn is None:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            with conn:
+                for coll in COLUMNS:
+                    _create_table(conn, coll)
+                conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+                for sql in INDEXES:
+                    conn.execute(sql)
+            _CONNECTIONS[path] = conn
+        return conn
+
+def _row_values(coll, record):
+    extract = COLUMNS.get(coll, {})
+    values = [record.get("id")]
+    values.extend(fn(record) for fn in extract.values())
+    values.append(json.dumps(record, ensure_ascii=False))
+    return values
+
+def _upsert(conn, coll, record):
+    _create_table(conn, coll)
+    values = _row_values(coll, record)
+    marks = ", ".join("?" for _ in values)
+    conn.execute(f'INSERT OR REPLACE INTO "{coll}" VALUES ({marks})', values)
+
+def load(path):
+    """whole database as the usual {collection: [records]} document"""
+    with _LOCK:
+        conn = connect(path)
+        data = {}
+        for coll in _tables(conn):
+            data[coll] = [json.loads(r[0]) for r in conn.execute(f'SELECT data FROM "{coll}" ORDER BY id')]
+        meta = _current_meta(conn, path)
+        if meta:
+            data["meta"] = copy.deepcopy(meta)
+        return data
+
+def save(data, path):
+    """replace every table with the content of a document"""
+    with _LOCK:
+        conn = connect(path)
+        _META.pop(path, None)
+        with conn:
+            for coll in _tables(conn):
+                conn.execute(f'DELETE FROM "{coll}"')
+            conn.execute("DELETE FROM meta")
+            for coll, records in data.items():
+                if coll == "meta":
+                    conn.execute("INSERT OR REPLACE INTO meta VALUES ('meta', ?)", (json.dumps(records),))
+                    continue
+                _create_table(conn, coll)
+                for r in records:
+                    _upsert(conn, coll, r)
+
+def apply_ops(ops, path, commit=True):
+    """
+    run insert/update/delete operations (same format as the json journal)
+    commit=False leaves them in the open sqlite transaction, see commit/rollback
+    returns [(collection, record before, record after)] of the records changed
+    """
+    changes = []
+    with _LOCK:
+        conn = connect(path)
+        try:
+            for op in ops:
+                coll = op.get("coll")
+                if coll is not None:
+                    _create_table(conn, coll)
+                kind = op["op"]
+                old = new = None
+                if kind == "seq":
+                    _bump_sequence(path, conn, coll, op["value"])
+                elif kind == "meta":
+                    _meta(path, conn)[op["key"]] = copy.deepcopy(op["value"])
+                    _META[path][1] = True
+                elif kind == "insert":
+                    new = op["record"]
+                    _upsert(conn, coll, new)
+                    if coll in _meta(path, conn).get("sequences", {}):
+                        _bump_sequence(path, conn, coll, new.get("id"))
+                elif kind in ("update", "delete"):
+                    row = conn.execute(f'SELECT data FROM "{coll}" WHERE id = ?', (op["id"],)).fetchone()
+                    if row is None:
+                        raise KeyError(f"record with id {op['id']} not found")
+                    old = json.loads(row[0])
+                    if kind == "update":
+                        new = dict(old)
+                        new.update(op["fields"])
+                        _upsert(conn, coll, new)
+                    else:
+                        conn.execute(f'DELETE FROM "{coll}" WHERE id = ?', (op["id"],))
+                else:
+                    raise ValueError(f"unknown operation: {kind}")
+                if old is not None or new is not None:
+                    changes.append((coll, old, new))
+                    if coll in ("users", "defenses"):
+                        _update_aggregates(path, conn, coll, old, new)
+        except Exception:
+            if commit:
+                _META.pop(path, None)
+                conn.rollback()
+            raise
+        if commit:
+            _flush_meta(path, conn)
+            conn.commit()
+    return changes
+
+def _meta(path, conn):
+    """the meta document of the open write transaction, read on first use"""
+    entry = _META.get(path)
+    if entry is None:
+        entry = _META[path] = [_read_meta(conn), False]
+    return entry[0]
+
+def _current_meta(conn, path):
+    """meta as this connection sees it, pending changes included (read only)"""
+    entry = _META.get(path)
+    return entry[0] if entry is not None else _read_meta(conn)
+
+def _flush_meta(path, conn):
+    entry = _META.pop(path, None)
+    if entry is not None and entry[1]:
+        _write_meta(conn, entry[0])
+
+def _read_meta(conn):
+    row = conn.execute("SELECT value FROM meta WHERE key = 'meta'").fetchone()
+    return json.loads(row[0]) if row else {}
+
+def _write_meta(conn, meta):
+    conn.execute("INSERT OR REPLACE INTO meta VALUES ('meta', ?)", (json.dumps(meta),))
+
+def read_meta(path):
+    with _LOCK:
+        return copy.deepcopy(_current_meta(connect(path), path))
+
+def _update_aggregates(path, conn, coll, old, new):
+    agg = _meta(path, conn).get(aggregates.KEY)
+    if agg is not None:
+        aggregates.apply_change(agg, coll, old, new)
+        _META[path][1] = True
+
+def _bump_sequence(path, conn, coll, value):
+    seqs = _meta(path, conn).setdefault("sequences", {})
+    if isinstance(value, int) and value > seqs.get(coll, 0):
+        seqs[coll] = value
+        _META[path][1] = True
+
+def sequence(path, coll):
+    """last id handed out for a collection, None if no sequence yet"""
+    with _LOCK:
+        return _current_meta(connect(path), path).get("sequences", {}).get(coll)
+
+def commit(path):
+    with _LOCK:
+        conn = connect(path)
+        _flush_meta(path, conn)
+        conn.commit()
+
+def rollback(path):
+    with _LOCK:
+        _META.pop(path, None)
+        connect(path).rollback()
+
+def _where(coll, filters):
+    """split filters into sql conditions on real columns and the rest"""
+    columns = set(COLUMNS.get(coll, {})) | {"id"}
+    conds, params, rest = [], [], {}
+    for k, v in filters.items():
+        if k not in columns:
+            rest[k] = v
+        elif v is None:
+            conds.append(f"{k} IS NULL")
+        else:
+            conds.append(f"{k} = ?")
+            params.append(v)
+    sql = (" WHERE " + " AND ".join(conds)) if conds else ""
+    return sql, params, rest
+
+def find(path, coll, filters):
+    with _LOCK:
+        conn = connect(path)
+        _create_table(conn, coll)
+        sql, params, rest = _where(coll, filters)
+        rows = conn.execute(f'SELECT data FROM "{coll}"{sql} ORDER BY id', params)
+        records = [json.loads(r[0]) for r in rows]
+    if rest:
+        records = [r for r in records if all(r.get(k) == v for k, v in rest.items())]
+    return records
+
+def count(path, coll, filters):
+    sql, params, rest = _where(coll, filters)
+    if rest:
+        return len(find(path, coll, filters))
+    with _LOCK:
+        conn = connect(path)
+        _create_table(conn, coll)
+        return conn.execute(f'SELECT COUNT(*) FROM "{coll}"{sql}', params).fetchone()[0]
+
+def mailbox_page(path, user_id, page_size, before=None, after=None):
+    """
+    messages of a user newest first, before/after are (created_at, id) keys
+    returns (messages, has older, has newer)
+    """
+    mine = "(sender_id = ? OR receiver_id = ?)"
+    params = [user_id, user_id]
+    with _LOCK:
+        conn = connect(path)
+        if after is not None:
+            rows = conn.execute(
+                f"SELECT data FROM messages WHERE {mine} AND (created_at > ? OR (created_at = ? AND id > ?)) "
+                "ORDER BY created_at, id LIMIT ?", params + [after[0], after[0], after[1], page_size + 1]).fetchall()
+            msgs = [json.loads(r[0]) for r in rows[:page_size]]
+            msgs.reverse()
+            return msgs, True, len(rows) > page_size
+        cond = ""
+        if before is not None:
+            cond = " AND (created_at < ? OR (created_at = ? AND id < ?))"
+            params += [before[0], before[0], before[1]]
+        rows = conn.execute(
+            f"SELECT data FROM messages WHERE {mine}{cond} ORDER BY created_at DESC, id DESC LIMIT ?",
+            params + [page_size + 1]).fetchall()
+        msgs = [json.loads(r[0]) for r in rows[:page_size]]
+        return msgs, len(rows) > page_size, before is not None
+
+def max_id(path, coll):
+    with _LOCK:
+        conn = connect(path)
+        _create_table(conn, coll)
+        return conn.execute(f'SELECT MAX(id) FROM "{coll}"').fetchone()[0] or 0
+
+def migrate_json_to_sqlite(json_path="db.json", sqlite_path="thesis.db"):
+    """one shot copy of an existing db.json (journal included) into a sqlite file"""
+    from database import load_db
+    data = load_db(json_path)
+    save(data, sqlite_path)
+    return {coll: len(records) for coll, records in data.items() if coll != "meta"}
+
+
+if __name__ == "__main__":
+    import sys
+    src = sys.argv[1] if len(sys.argv) > 1 else "db.json"
+    dst = sys.argv[2] if len(sys.argv) > 2 else "thesis.db"
+    print("migrated:", migrate_json_to_sqlite(src, dst))
@@ -0,0 +1,108 @@
+"""
+canonical integer forms of the dates we sort and filter on
+records keep their iso strings for display, next to them:
+    messages:  created_ts, read_ts  (unix epoch seconds, utc)
+    defenses:  date_ord             (date.toordinal())
+they are computed once when a record is written, backfill() adds them
+to records written before these fields existed
+"""
+import datetime
+
+from database import transaction
+
+# sorts before every real timestamp, used for missing / broken values
+MIN_TS = -(2 ** 63)
+MIN_ORD = datetime.date.min.toordinal()
+
+_UTC = datetime.timezone.utc
+
+
+def to_epoch(value):
+    """iso string / datetime -> int epoch seconds (naive values are utc), ValueError if unparsable"""
+    if isinstance(value, datetime.datetime):
+        dt = value
+    elif isinstance(value, str):
+        s = value.strip().rstrip("Z")
+        try:
+            dt = datetime.datetime.fromisoformat(s)
+        except ValueError:
+            try:
+                dt = datetime.datetime.strptime(s, "%Y-%m-%dT%H:%M:%S")
+            except ValueError:
+                raise ValueError(f"Cannot parse datetime: {value}")
+    else:
+        raise ValueError(f"Cannot parse datetime: {value}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=_UTC)
+    return int(dt.timestamp())
+
+
+def to_ordinal(value):
+    """iso date string / date -> int ordinal, ValueError if unparsable"""
+    if isinstance(value, datetime.datetime):
+        return value.date().toordinal()
+    if isinstance(value, datetime.date):
+        return value.toordinal()
+    if isinstance(value, str):
+        try:
+            return datetime.date.fromisoformat(value.strip()).toordinal()
+        except ValueError:
+            pass
+    raise ValueError(f"Cannot parse date: {value}")
+
+
+def record_ts(record, field="created_ts", source="created_at"):
+    """stored epoch of a record, parsed from the iso field for old records"""
+    ts = record.get(field)
+    if isinstance(ts, int):
+        return ts
+    try:
+        return to_epoch(record.get(source))
+    except ValueError:
+        return MIN_TS
+
+
+def record_ord(record, field="date_ord", source="date"):
+    """stored ordinal of a record, parsed from the iso field for old records"""
+    o = record.get(field)
+    if isinstance(o, int):
+        return o
+    try:
+        return to_ordinal(record.get(source))
+    except ValueError:
+        return MIN_ORD
+
+
+def _missing(record, field, source, convert):
+    """fields to set so record[field] matches record[source], {} if up to date"""
+    value = record.get(source)
+    if value is None:
+        return {field: None} if record.get(field) is not None else {}
+    try:
+        wanted = convert(value)
+    except ValueError:
+        wanted = None
+    return {field: wanted} if record.get(field) != wanted or field not in record else {}
+
+
+def backfill(db_path="db.json", tx=None):
+    """add the integer fields to every record that lacks them, returns how many records changed"""
+    changed = {"messages": 0, "defenses": 0}
+    with transaction(db_path, tx) as tx:
+        for m in list(tx.find("messages")):
+            fields = _missing(m, "created_ts", "created_at", to_epoch)
+            fields.update(_missing(m, "read_ts", "read_at", to_epoch))
+            if fields:
+                tx.update("messages", m["id"], fields)
+                changed["messages"] += 1
+        for d in list(tx.find("defenses")):
+            fields = _missing(d, "date_ord", "date", to_ordinal)
+            if fields:
+                tx.update("defenses", d["id"], fields)
+                changed["defenses"] += 1
+    return changed
+
+
+if __name__ == "__main__":
+    import sys
+    print("backfilled:", backfill(sys.argv[1] if len(sys.argv) > 1 else "db.json"))
@@ -1,7 +1,11 @@
+import csv
 import datetime
 import hashlib
+import json
+import os
 import secrets
-from database import load_db, save_db
+from concurrent.futures import ProcessPoolExecutor
+from database import transaction, read_db, insert_record, update_record, find_records, get_record, count_records, next_id, register_index, get_index, detached, detached_record
 
 DEFAULT_PBKDF2_ITERS = 150_000
 
@@ -26,39 +30,95 @@ def verify_password(password: str, salt_hex: str, hash_hex: str, iterations: int
     return secrets.compare_digest(dk, expected)
 
 
-def _next_user_id(db):
-    if not db.get("users"):
-        return 1
-    return max(u.get("id", 0) for u in db.get("users", [])) + 1
-
-def get_user_by_id(user_id, db_path="db.json"):
-    db = load_db(db_path)
-    for u in db.get("users", []):
-        if u.get("id") == user_id:
-            return u
-    return None
-
-def get_user_by_name(name, db_path="db.json"):
+def _name_key(name):
+    return name.strip().casefold() if isinstance(name, str) else None
+
+
+class UserIndex:
+    """
+    lookups over the users of one loaded snapshot:
+    id -> record, casefolded name -> ids, advisor id -> student ids, role -> ids
+    built once per snapshot by the database cache and kept up to date on
+    every insert/update/delete of a user
+    its records are the cached ones, the getters below return copies
+    """
+    collection = "users"
+
+    def __init__(self, data):
+        self.by_id = {}
+        self.by_name = {}
+        self.by_advisor = {}
+        self.by_role = {}
+        for u in data.get("users", []):
+            self._add(u)
+
+    def _add(self, u):
+        uid = u.get("id")
+        self.by_id[uid] = u
+        self.by_name.setdefault(_name_key(u.get("name")), []).append(uid)
+        self.by_role.setdefault(u.get("role"), set()).add(uid)
+        if u.get("role") == "student" and u.get("advisor_id") is not None:
+            self.by_advisor.setdefault(u.get("advisor_id"), set()).add(uid)
+
+    def _remove(self, u):
+        uid = u.get("id")
+        self.by_id.pop(uid, None)
+        ids = self.by_name.get(_name_key(u.get("name")))
+        if ids and uid in ids:
+            ids.remove(uid)
+        self.by_role.get(u.get("role"), set()).discard(uid)
+        self.by_advisor.get(u.get("advisor_id"), set()).discard(uid)
+
+    def update(self, old, new):
+        if old is not None:
+            self._remove(old)
+        if new is not None:
+            self._add(new)
+
+    def by_name_first(self, name):
+        ids = self.by_name.get(_name_key(name))
+        return self.by_id[min(ids)] if ids else None
+
+    def students_of(self, teacher_id):
+        return [self.by_id[i] for i in sorted(self.by_advisor.get(teacher_id, ()))]
+
+    def advisee_count(self, teacher_id):
+        return len(self.by_advisor.get(teacher_id, ()))
+
+register_index("users", UserIndex)
+
+def _user_index(db_path, tx=None):
+    """None on sqlite, where the same lookups are indexed sql queries"""
+    return get_index("users", db_path, tx)
+
+
+def _next_user_id(db_path, tx=None):
+    return next_id("users", db_path, tx=tx)
+
+def get_user_by_id(user_id, db_path="db.json", tx=None):
+    idx = _user_index(db_path, tx)
+    if idx is not None:
+        return detached_record(idx.by_id.get(user_id), db_path, tx)
+    return get_record("users", user_id, db_path, tx=tx)
+
+def get_user_by_name(name, db_path="db.json", tx=None):
     if not isinstance(name, str):
         return None
-    db = load_db(db_path)
-    name_norm = name.strip().casefold()
-    for u in db.get("users", []):
-        uname = u.get("name")
-        if isinstance(uname, str) and uname.strip().casefold() == name_norm:
-            return u
-    return None
+    idx = _user_index(db_path, tx)
+    if idx is not None:
+        return detached_record(idx.by_name_first(name), db_path, tx)
+    found = find_records("users", db_path, tx=tx, name_cf=_name_key(name))
+    return found[0] if found else None
 
-def list_users(db_path="db.json"):
-    db = load_db(db_path)
-    return list(db.get("users", []))
+def list_users(db_path="db.json", tx=None):
+    db = read_db(db_path, tx)
+    return detached(db.get("users", []), db_path, tx)
 
 
 
-def add_user(name, role, password,
-             advisor_id=None, defense_date=None,
-             advisee_capacity=None, jury_capacity=None,
-             db_path="db.json"):
+def _user_record(name, role, password, advisor_id=None, defense_date=None,
+                 advisee_capacity=None, jury_capacity=None):
+    """validate the fields of a new user, record without id and password hash"""
     if not isinstance(name, str) or not name.strip():
         raise ValueError("name must be a non-empty string.")
     name = name.strip()
@@ -72,24 +132,16 @@ def add_user(name, role, password,
             defense_date = dd.isoformat()
         except Exception:
             raise ValueError("defense_date must be in YYYY-MM-DD format.")
-    db = load_db(db_path)
-    new_id = _next_user_id(db)
-    salt_hex, hash_hex, iters = hash_password(password)
-    now_iso = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
     user_record = {
-        "id": new_id,
+        "id": None,
         "name": name,
         "role": role,
         "advisor_id": advisor_id,
         "defense_date": defense_date,
-        "password_salt": salt_hex,
-        "password_hash": hash_hex,
-        "password_iterations": iters,
-        "created_at": now_iso,
+        "created_at": datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z",
         "last_login": None,
         "is_active": True
     }
-    
     if role == "teacher":
         if advisee_capacity is not None and int(advisee_capacity) < 0:
             raise ValueError("advisee_capacity must be >= 0")
@@ -97,33 +149,150 @@ def add_user(name, role, password,
             raise ValueError("jury_capacity must be >= 0")
         user_record["advisee_capacity"] = int(advisee_capacity) if advisee_capacity is not None else 5
         user_record["jury_capacity"] = int(jury_capacity) if jury_capacity is not None else 10
-    if role == "student" and advisor_id is not None:
-        advisor = get_user_by_id(advisor_id, db_path)
-        if not advisor or advisor.get("role") != "teacher":
-            raise ValueError(f"advisor_id {advisor_id} not found or not a teacher.")
-        current_advisees = sum(
-            1 for u in db.get("users", [])
-            if u.get("role") == "student" and u.get("advisor_id") == advisor_id
-        )
-        
-        cap = int(advisor.get("advisee_capacity", 5))
-        if current_advisees >= cap:
-            raise ValueError(f"Advisor {advisor_id} has no remaining advisee slots (used {current_advisees} / cap {cap}).")
-   
-    db["users"].append(user_record)
-    save_db(db, db_path)
+    return user_record
+
+def _set_password(user_record, hashed):
+    salt_hex, hash_hex, iters = hashed
+    user_record["password_salt"] = salt_hex
+    user_record["password_hash"] = hash_hex
+    user_record["password_iterations"] = iters
+
+def _check_advisor(advisor_id, current_advisees, db_path, tx):
+    advisor = get_user_by_id(advisor_id, db_path, tx=tx)
+    if not advisor or advisor.get("role") != "teacher":
+        raise ValueError(f"advisor_id {advisor_id} not found or not a teacher.")
+    cap = int(advisor.get("advisee_capacity", 5))
+    if current_advisees >= cap:
+        raise ValueError(f"Advisor {advisor_id} has no remaining advisee slots (used {current_advisees} / cap {cap}).")
+
+def add_user(name, role, password,
+             advisor_id=None, defense_date=None,
+             advisee_capacity=None, jury_capacity=None,
+             db_path="db.json", tx=None):
+    user_record = _user_record(name, role, password, advisor_id, defense_date,
+                               advisee_capacity, jury_capacity)
+    # slow on purpose, done before taking the database lock
+    _set_password(user_record, hash_password(password))
+    with transaction(db_path, tx) as tx:
+        if role == "student" and advisor_id is not None:
+            _check_advisor(advisor_id, count_advisees(advisor_id, db_path, tx=tx), db_path, tx)
+        new_id = _next_user_id(db_path, tx)
+        user_record["id"] = new_id
+        insert_record("users", user_record, db_path, tx=tx)
     return new_id
 
 
-def authenticate_user(identifier, password, db_path="db.json"):
-   
-    
-    db = load_db(db_path)
+IMPORT_FIELDS = ("name", "role", "password", "advisor_id", "defense_date", "advisee_capacity", "jury_capacity")
+
+def read_user_rows(path):
+    """rows of a .csv (with a header line) or .jsonl file (one json object per line)"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            rows = []
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError as e:
+                    rows.append({"_error": f"line {line_no}: invalid json ({e})"})
+            return rows
+        return list(csv.DictReader(f))
+
+def _row_fields(row):
+    """row (csv strings or json values) -> add_user keyword arguments"""
+    if not isinstance(row, dict):
+        raise ValueError("row must be an object")
+    if row.get("_error"):
+        raise ValueError(row["_error"])
+    fields = {}
+    for k in IMPORT_FIELDS:
+        v = row.get(k)
+        if isinstance(v, str):
+            v = v.strip()
+            if v == "" and k != "password":
+                v = None
+        fields[k] = v
+    for k in ("advisor_id", "advisee_capacity", "jury_capacity"):
+        if fields[k] is not None:
+            try:
+                fields[k] = int(fields[k])
+            except (TypeError, ValueError):
+                raise ValueError(f"{k} must be an integer")
+    return fields
+
+def import_users(rows, db_path="db.json", workers=None, tx=None):
+    """
+    add many users at once: rows are dicts with the add_user fields (or a
+    path to a .csv / .jsonl file)
+    passwords are hashed on a process pool (all cores by default), advisee
+    capacities are checked against counts kept in memory, and all users are
+    written in one transaction
+    a bad row does not stop the import, returns
+    {"created": [(row number, user id)], "errors": [(row number, message)]}
+    """
+    if isinstance(rows, str):
+        rows = read_user_rows(rows)
+    created, errors = [], []
+
+    valid = []
+    for row_no, row in enumerate(rows, 1):
+        try:
+            fields = _row_fields(row)
+            record = _user_record(**fields)
+        except ValueError as e:
+            errors.append((row_no, str(e)))
+            continue
+        valid.append((row_no, record, fields["password"]))
+
+    passwords = [p for _, _, p in valid]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(passwords) < 2:
+        hashes = [hash_password(p) for p in passwords]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunk = max(1, len(passwords) // (workers * 4))
+            hashes = list(pool.map(hash_password, passwords, chunksize=chunk))
+
+    with transaction(db_path, tx) as tx:
+        advisees = {}
+        accepted = []
+        for (row_no, record, _), hashed in zip(valid, hashes):
+            advisor_id = record["advisor_id"]
+            if record["role"] == "student" and advisor_id is not None:
+                if advisor_id not in advisees:
+                    advisees[advisor_id] = count_advisees(advisor_id, db_path, tx=tx)
+                try:
+                    _check_advisor(advisor_id, advisees[advisor_id], db_path, tx)
+                except ValueError as e:
+                    errors.append((row_no, str(e)))
+                    continue
+                advisees[advisor_id] += 1
+            _set_password(record, hashed)
+            accepted.append((row_no, record))
+
+        if accepted:
+            ids = tx.allocate_ids("users", len(accepted))
+            for (row_no, record), new_id in zip(accepted, ids):
+                record["id"] = new_id
+                tx.insert("users", record)
+                created.append((row_no, new_id))
+
+    errors.sort()
+    return {"created": created, "errors": errors}
+
+
+def authenticate_user(identifier, password, db_path="db.json", tx=None, record_login=True):
+    """
+    user record if the password matches, else None
+    record_login=False skips the last_login write (session_manager buffers it)
+    """
     user = None
     if isinstance(identifier, int):
-        user = get_user_by_id(identifier, db_path)
+        user = get_user_by_id(identifier, db_path, tx=tx)
     else:
-        user = get_user_by_name(str(identifier), db_path)
+        user = get_user_by_name(str(identifier), db_path, tx=tx)
 
     if not user:
         return None
@@ -138,33 +307,27 @@ def authenticate_user(identifier, password, db_path="db.json"):
         return None
 
     if verify_password(password, salt, hash_hex, iters):
-        
-        for u in db["users"]:
-            if u["id"] == user["id"]:
-                u["last_login"] = datetime.datetime.utcnow().isoformat() + "Z"
-                break
-        save_db(db, db_path)
-        return get_user_by_id(user["id"], db_path)  # return fresh copy
+        if not record_login:
+            return user
+        update_record("users", user["id"], {"last_login": datetime.datetime.utcnow().isoformat() + "Z"}, db_path, tx=tx)
+        return get_user_by_id(user["id"], db_path, tx=tx)  # return fresh copy
     return None
 
-def change_password(user_id, old_password, new_password, db_path="db.json"):
+def change_password(user_id, old_password, new_password, db_path="db.json", tx=None):
     
     
-    db = load_db(db_path)
-    user = get_user_by_id(user_id, db_path)
+    user = get_user_by_id(user_id, db_path, tx=tx)
     if not user:
         raise ValueError("User not found")
     if not verify_password(old_password, user["password_salt"], user["password_hash"], user.get("password_iterations", DEFAULT_PBKDF2_ITERS)):
         raise ValueError("Old password does not match")
 
     salt_hex, hash_hex, iters = hash_password(new_password)
-    for u in db["users"]:
-        if u["id"] == user_id:
-            u["password_salt"] = salt_hex
-            u["password_hash"] = hash_hex
-            u["password_iterations"] = iters
-            break
-    save_db(db, db_path)
+    update_record("users", user_id, {
+        "password_salt": salt_hex,
+        "password_hash": hash_hex,
+        "password_iterations": iters
+    }, db_path, tx=tx)
     return True
 
 
@@ -176,91 +339,89 @@ def require_role(user_obj, role):
     if user_obj.get("role") != role:
         raise PermissionError(f"User must have role '{role}'")
 
-def list_students_of_teacher(teacher_id, db_path="db.json"):
+def list_students_of_teacher(teacher_id, db_path="db.json", tx=None):
     
     
-    db = load_db(db_path)
-    return [u for u in db["users"] if u.get("role") == "student" and u.get("advisor_id") == teacher_id]
+    idx = _user_index(db_path, tx)
+    if idx is not None:
+        return detached(idx.students_of(teacher_id), db_path, tx)
+    return find_records("users", db_path, tx=tx, role="student", advisor_id=teacher_id)
 
 
-def change_advisor(student_id, new_teacher_id, db_path="db.json", changed_by=None):
+def change_advisor(student_id, new_teacher_id, db_path="db.json", changed_by=None, tx=None):
     import datetime
-    db = load_db(db_path)
-
-    student = get_user_by_id(student_id, db_path)
-    teacher = get_user_by_id(new_teacher_id, db_path)
-
-    if not student or student.get("role") != "student":
-        raise ValueError("Student not found.")
-    if not teacher or teacher.get("role") != "teacher":
-        raise ValueError("Teacher not found.")
-
-    current_advisor = student.get("advisor_id")
-    if current_advisor == new_teacher_id:
-        return True  # no-op
-
-    # prevent change after defense date
-    if student.get("defense_date"):
-        defense_date = datetime.datetime.strptime(student["defense_date"], "%Y-%m-%d").date()
-        if datetime.date.today() >= defense_date:
-            raise ValueError("after defense date you cant change teacher")
-
-    # check remaining advisee slots (exclude this student from count)
-    advisee_count = sum(
-        1 for u in db.get("users", [])
-        if u.get("role") == "student" and u.get("advisor_id") == new_teacher_id and u.get("id") != student_id
-    )
-    advisee_capacity = int(teacher.get("advisee_capacity", 5))
-    if advisee_count >= advisee_capacity:
-        raise ValueError(f"Teacher id {new_teacher_id} has no remaining advisee slots (used {advisee_count} / cap {advisee_capacity}).")
-
-    # apply change and record history
-    changed_at = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
-    history_entry = {
-        "old_advisor": current_advisor,
-        "new_advisor": new_teacher_id,
-        "changed_by": changed_by,
-        "changed_at": changed_at
-    }
 
-    for u in db["users"]:
-        if u["id"] == student_id:
-            u["advisor_id"] = new_teacher_id
-            hist = u.get("advisor_history")
-            if not isinstance(hist, list):
-                u["advisor_history"] = []
-                hist = u["advisor_history"]
-            hist.append(history_entry)
-            break
-
-    save_db(db, db_path)
+    with transaction(db_path, tx) as tx:
+        student = get_user_by_id(student_id, db_path, tx=tx)
+        teacher = get_user_by_id(new_teacher_id, db_path, tx=tx)
+
+        if not student or student.get("role") != "student":
+            raise ValueError("Student not found.")
+        if not teacher or teacher.get("role") != "teacher":
+            raise ValueError("Teacher not found.")
+
+        current_advisor = student.get("advisor_id")
+        if current_advisor == new_teacher_id:
+            return True  # no-op
+
+        # prevent change after defense date
+        if student.get("defense_date"):
+            defense_date = datetime.datetime.strptime(student["defense_date"], "%Y-%m-%d").date()
+            if datetime.date.today() >= defense_date:
+                raise ValueError("after defense date you cant change teacher")
+
+        # check remaining advisee slots (this student is not counted, its advisor is not new_teacher_id yet)
+        advisee_count = count_advisees(new_teacher_id, db_path, tx=tx)
+        advisee_capacity = int(teacher.get("advisee_capacity", 5))
+        if advisee_count >= advisee_capacity:
+            raise ValueError(f"Teacher id {new_teacher_id} has no remaining advisee slots (used {advisee_count} / cap {advisee_capacity}).")
+
+        # apply change and record history
+        changed_at = datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+        history_entry = {
+            "old_advisor": current_advisor,
+            "new_advisor": new_teacher_id,
+            "changed_by": changed_by,
+            "changed_at": changed_at
+        }
+
+        hist = student.get("advisor_history")
+        if not isinstance(hist, list):
+            hist = []
+        update_record("users", student_id, {
+            "advisor_id": new_teacher_id,
+            "advisor_history": hist + [history_entry]
+        }, db_path, tx=tx)
     return True
 
 """Several active students under advisor teacher"""
-def count_advisees(teacher_id, db_path="db.json"):
-    db = load_db(db_path)
-    return sum(1 for u in db.get("users", []) if u.get("role") == "student" and u.get("advisor_id") == teacher_id)
+def count_advisees(teacher_id, db_path="db.json", tx=None):
+    idx = _user_index(db_path, tx)
+    if idx is not None:
+        return idx.advisee_count(teacher_id)
+    return count_records("users", db_path, tx=tx, role="student", advisor_id=teacher_id)
 
 """Number of remaining capacities of advisor teacher"""
-def get_remaining_advisee_slots(teacher_id, db_path="db.json"):
-    teacher = get_user_by_id(teacher_id, db_path)
+def get_remaining_advisee_slots(teacher_id, db_path="db.json", tx=None):
+    teacher = get_user_by_id(teacher_id, db_path, tx=tx)
     if not teacher:
         raise ValueError("Teacher not found")
     cap = teacher.get("advisee_capacity", 5)  
-    used = count_advisees(teacher_id, db_path)
+    used = count_advisees(teacher_id, db_path, tx=tx)
     return cap - used
 
-def set_teacher_capacity(teacher_id, advisee_capacity=None, jury_capacity=None, db_path="db.json"):
-    db = load_db(db_path)
-    for u in db.get("users", []):
-        if u.get("id") == teacher_id and u.get("role") == "teacher":
-            if advisee_capacity is not None:
-                u["advisee_capacity"] = int(advisee_capacity)
-            if jury_capacity is not None:
-                u["jury_capacity"] = int(jury_capacity)
-            save_db(db, db_path)
-            return True
-    return False
+def set_teacher_capacity(teacher_id, advisee_capacity=None, jury_capacity=None, db_path="db.json", tx=None):
+    u = get_user_by_id(teacher_id, db_path, tx=tx)
+    if not u or u.get("role") != "teacher":
+        return False
+    fields = {}
+    if advisee_capacity is not None:
+        fields["advisee_capacity"] = int(advisee_capacity)
+    if jury_capacity is not None:
+        fields["jury_capacity"] = int(jury_capacity)
+    if fields:
+        update_record("users", teacher_id, fields, db_path, tx=tx)
+    return True
 
 
 if __name__ == "__main__":